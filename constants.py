@@ -10,3 +10,5 @@ class Constants:
     angle_blob=640
     blur_anchor_x=3
     blur_anchor_y=3
+    tracker_roi=None
+    tracker_scale=1
@@ -13,11 +13,13 @@ if not uname[4].startswith("arm"):
                    mixers,
                    vehicles,
                    pilots,
+                   inference,
                    templates,
                    config) 
 
 else:
     print('Detected running on rasberrypi. Only importing select modules.')
+    #models imports keras, pilots run on the car with inference.
     from . import (actuators, 
                    mixers, 
                    remotes, 
@@ -25,4 +27,4 @@ else:
                    vehicles, 
                    config,
                    pilots,
-                   models)
+                   inference)
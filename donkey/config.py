@@ -4,11 +4,6 @@ import configparser
 
 import donkey as dk
 
-import keras
-
-if int(keras.__version__.split('.')[0]) < 2:
-    raise ImportError('You need keras version 2.0.0 or higher. Run "pip install keras --upgrade"')
-
 config = configparser.ConfigParser()
 
 my_path = os.path.expanduser('~/mydonkey/')
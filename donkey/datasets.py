@@ -26,78 +26,700 @@ import pickle
 import requests
 import io
 import h5py
-import tempfile
 import numpy as np
 import math
+import json
+import shutil
+import hashlib
+import queue
+import fcntl
+import contextlib
+import multiprocessing
 
 import donkey as dk
 
-def load_url(url):
+CACHE_VERSION = 1
+CACHE_MANIFEST = 'manifest.json'
+CACHE_ARRAYS = ('X', 'Y', 'offset', 'angle_out', 'throttle_out')
+
+
+def cache_path(h5_path):
+    ''' Return the folder of the training caches of an hdf5 dataset. '''
+    return os.path.splitext(h5_path)[0] + '.cache'
+
+
+def cache_source(h5_path):
+    st = os.stat(h5_path)
+    return {'path': os.path.realpath(h5_path), 'size': st.st_size, 
+            'mtime_ns': st.st_mtime_ns, 'version': CACHE_VERSION,
+            'bins': dk.utils.bin_Y(np.zeros(1)).shape[1]}
+
+
+@contextlib.contextmanager
+def cache_lock(h5_path):
+    '''
+    Hold the lock of the training caches of an hdf5 dataset. Processes 
+    building, opening or removing a cache hold it so one process builds 
+    while the others wait.
     '''
-    Download an h5py file and return X, Y. 
+    path = cache_path(h5_path)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
-    TODO: save the file to datasets folder and check if its downloaded before downloading again.
+def build_cache(h5_path, block_size=1024):
     '''
-    print('Starting download.')
-    r = requests.get(url)
-    name = tempfile.mktemp()
-    with open(name, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024): 
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
+    Preprocess an hdf5 dataset once into a folder of .npy arrays that 
+    training memory maps:
+
+        X - the images as uint8
+        Y - the angle and throttle
+        offset - the mean/std of each image, so batches are normalized 
+                 with one subtraction and multiplication
+        angle_out, throttle_out - the labels as the models take them
+
+    and a manifest describing the source file. Returns the folder. 
+
+    Each version of the hdf5 file gets its own folder, named after the 
+    manifest's source, inside cache_path(h5_path). A changed file gets a 
+    new folder, and the folders of older versions are removed once the 
+    new one is ready.
+    '''
+    with cache_lock(h5_path):
+        return _build_cache(h5_path, block_size)
+
+
+def _build_cache(h5_path, block_size=1024):
+    #call with the cache lock.
+    source = cache_source(h5_path)
+    key = hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()[:16]
+    root = cache_path(h5_path)
+    path = os.path.join(root, key)
+    if os.path.exists(os.path.join(path, CACHE_MANIFEST)):
+        return path
+
+    print('Building training cache %s' % path)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with h5py.File(h5_path, 'r') as f:
+        n = f['X'].shape[0]
+        shapes = {'X': f['X'].shape, 'Y': f['Y'].shape, 'offset': (n,),
+                  'angle_out': (n, source['bins']), 'throttle_out': (n,)}
+        dtypes = {'X': np.uint8}
+        arrs = {k: np.lib.format.open_memmap(os.path.join(tmp_path, k + '.npy'), mode='w+', 
+                                             dtype=dtypes.get(k, np.float32), shape=shape)
+                for k, shape in shapes.items()}
+
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            X = np.asarray(f['X'][start:stop])
+            Y = np.asarray(f['Y'][start:stop], dtype=np.float32)
+            if X.dtype != np.uint8:
+                #only whole numbers from 0 to 255 are stored as they are.
+                if X.min() < 0 or X.max() > 255 or not np.array_equal(X, np.rint(X)):
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    raise ValueError('The images of %s are %s, not whole numbers from 0 to 255, '
+                                     'so they can not be cached as uint8. Train with cache=False '
+                                     '(--no-cache) to read them from the hdf5 file.' 
+                                     % (h5_path, X.dtype))
+                X = X.astype(np.uint8)
+            arrs['X'][start:stop] = X
+            arrs['Y'][start:stop] = Y
+            arrs['offset'][start:stop] = dk.utils.img_offsets(X)
+            arrs['angle_out'][start:stop] = dk.utils.bin_Y(Y[:, 0])
+            arrs['throttle_out'][start:stop] = Y[:, 1]
+
+    for a in arrs.values():
+        a.flush()
+    del arrs
+
+    manifest = {'source': source, 'n': n, 
+                'arrays': {k: {'file': k + '.npy', 'shape': list(shape)} for k, shape in shapes.items()}}
+    with open(os.path.join(tmp_path, CACHE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmp_path, path)
+
+    #processes open caches while holding the lock, so none is between 
+    #finding an old cache and mapping it. Maps already open stay valid.
+    for f in os.scandir(root):
+        if f.is_dir() and f.name != key:
+            shutil.rmtree(f.path, ignore_errors=True)
+    return path
+
+
+def remove_cache(h5_path):
+    ''' Remove the training caches of an hdf5 dataset, keeping the lock file. '''
+    if not os.path.exists(cache_path(h5_path)):
+        return
+    with cache_lock(h5_path):
+        for f in os.scandir(cache_path(h5_path)):
+            if f.is_dir():
+                shutil.rmtree(f.path, ignore_errors=True)
+
+
+def open_cache(h5_path):
+    '''
+    Return a dictionary of the read only memory mapped arrays of the 
+    training cache of an hdf5 dataset, building it if needed. Processes 
+    opening the same cache share its pages through the OS page cache.
+    '''
+    with cache_lock(h5_path):
+        path = _build_cache(h5_path)
+        cache = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r') for k in CACHE_ARRAYS}
+    cache['n'] = len(cache['X'])
+    return cache
+
+
+DOWNLOAD_CACHE_SIZE = 20 * 1024**3
+DOWNLOAD_CHUNK_SIZE = 1024**2
+DOWNLOAD_INDEX = 'urls.json'
+
+
+def load_url(url, checksum=None, cache_dir=None, max_bytes=DOWNLOAD_CACHE_SIZE):
+    '''
+    Download an h5py file and return its X and Y datasets. They are read 
+    from the file when sliced instead of being loaded into memory, so the 
+    file stays open while they are used. Close it with X.file.close().
+
+    Downloads are saved in cache_dir (datasets_path/downloads by default) 
+    named by the sha256 of their content, with an index of the urls they 
+    came from, so a url or checksum is only downloaded once. A checksum 
+    (sha256 hex) given is verified and lets the file be found without 
+    the url. Interrupted downloads are resumed with range requests. The 
+    least recently used files are deleted when they and their training 
+    caches take more than max_bytes.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(dk.config.datasets_path, 'downloads')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    index_path = os.path.join(cache_dir, DOWNLOAD_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    digest = checksum or index.get(url)
+    path = os.path.join(cache_dir, '%s.h5' % digest)
+    if digest is None or not os.path.exists(path):
+        digest = download(url, cache_dir)
+        if checksum is not None and digest != checksum:
+            os.remove(os.path.join(cache_dir, '%s.h5' % digest))
+            raise ValueError('Checksum of %s is %s, expected %s' %(url, digest, checksum))
+        path = os.path.join(cache_dir, '%s.h5' % digest)
+
+        index[url] = digest
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+
+    #mark the file as recently used.
+    os.utime(path)
+    evict_downloads(cache_dir, max_bytes, keep=path)
+
     print('loading hdf5 file')
-    f = h5py.File(name, "r")
-    X = np.array(f['X'])
-    Y = np.array(f['Y'])
-    return X, Y
+    f = h5py.File(path, "r")
+    return f['X'], f['Y']
 
 
-def row_gen(h5_path, ix):
-    ''' 
-    A generator to loop an hdf5 dataset referencing only
-    the rows given in the index (ix).
+def download(url, cache_dir):
     '''
-    f = h5py.File(h5_path, "r")
-    
+    Download a url into cache_dir and return the sha256 of its content. 
+    A partial download of the same url is continued when the server 
+    supports range requests and the file didn't change.
+    '''
+    part_path = os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.part')
+    meta_path = part_path + '.json'
+
+    headers = {}
+    if os.path.exists(part_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            validator = json.load(f).get('validator')
+        if validator:
+            headers['Range'] = 'bytes=%s-' % os.path.getsize(part_path)
+            headers['If-Range'] = validator
+
+    print('Starting download.')
+    r = requests.get(url, headers=headers, stream=True)
+    if r.status_code == 416:
+        #the partial file isn't a prefix of the url anymore, start over.
+        os.remove(part_path)
+        r = requests.get(url, stream=True)
+    r.raise_for_status()
+
+    sha = hashlib.sha256()
+    if r.status_code == 206:
+        print('Resuming download.')
+        mode = 'ab'
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha.update(block)
+    else:
+        mode = 'wb'
+        validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+        with open(meta_path, 'w') as f:
+            json.dump({'url': url, 'validator': validator}, f)
+
+    with open(part_path, mode) as f:
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            sha.update(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+    digest = sha.hexdigest()
+    os.replace(part_path, os.path.join(cache_dir, '%s.h5' % digest))
+    os.remove(meta_path)
+    return digest
+
+
+def download_size(h5_path):
+    ''' Return the bytes used by a download and its training caches. '''
+    size = os.path.getsize(h5_path)
+    for root, dirs, files in os.walk(cache_path(h5_path)):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def evict_downloads(cache_dir, max_bytes, keep=None):
+    ''' Delete the least recently used downloads and their caches above max_bytes. '''
+    files = [f for f in os.scandir(cache_dir) if f.name.endswith('.h5')]
+    files.sort(key=lambda f: f.stat().st_mtime)
+    sizes = {f.path: download_size(f.path) for f in files}
+    total = sum(sizes.values())
+    for f in files:
+        if total <= max_bytes:
+            break
+        if f.path == keep:
+            continue
+        total -= sizes[f.path]
+        os.remove(f.path)
+        remove_cache(f.path)
+
+
+def read_rows(f, ix, max_gap=None):
+    '''
+    Read the rows ix (in any order, with repeats) of the X and Y 
+    datasets of an open hdf5 file. Rows are sorted and rows close to 
+    each other are read together with one contiguous slice, which is 
+    much faster than reading them one at a time.
+
+    Rows up to max_gap apart are read together. By default the gap grows 
+    by one row for every 1024 rows of the dataset up to 32, so small 
+    datasets, where random rows are close anyway, aren't read many times 
+    over.
+    '''
+    if max_gap is None:
+        max_gap = int(np.clip(f['X'].shape[0] // 1024, 1, 32))
+    rows, inverse = np.unique(ix, return_inverse=True)
+    spans = np.split(rows, np.where(np.diff(rows) > max_gap)[0] + 1)
+    X = []
+    Y = []
+    for span in spans:
+        start, stop = span[0], span[-1] + 1
+        X.append(f['X'][start:stop][span - start])
+        Y.append(f['Y'][start:stop][span - start])
+    X = np.concatenate(X)
+    Y = np.concatenate(Y)
+    return X[inverse], Y[inverse]
+
+
+def epoch_sampler(dataset_list, batch_size):
+    '''
+    Yield the rows of each batch as [(dataset number, ix)] and the order 
+    that puts the concatenated rows in batch order. Every epoch goes 
+    through a new shuffle of the rows of all the datasets, so each row 
+    is used once per epoch and batches mix rows from all over the data.
+    '''
+    which_all = np.concatenate([np.full(len(d['ix']), i) for i, d in enumerate(dataset_list)])
+    ix_all = np.concatenate([d['ix'] for d in dataset_list])
+    if len(ix_all) == 0:
+        raise ValueError('The datasets have no rows to sample.')
+    shuffle = np.zeros(0, dtype=int)
+    pos = 0
+
     while True:
-        i = np.random.choice(ix)
-        yield dk.utils.norm_img(f['X'][i, :]), f['Y'][i, :]
-        
-        
-def batch_gen(dataset_list, batch_size=128):
+        picks = []
+        need = batch_size
+        while need:
+            if pos == len(shuffle):
+                shuffle = np.random.permutation(len(ix_all))
+                pos = 0
+            picks.append(shuffle[pos:pos + need])
+            pos += len(picks[-1])
+            need -= len(picks[-1])
+        picks = np.concatenate(picks)
+
+        which = which_all[picks]
+        rows = []
+        dest = []
+        for i in np.unique(which):
+            rows.append((i, ix_all[picks[which == i]]))
+            dest.append(np.flatnonzero(which == i))
+        yield rows, np.argsort(np.concatenate(dest))
+
+
+def batch_gen(dataset_list, batch_size=128, cache=True, augment=None, reuse=False):
     '''
     Generator to return batches of randomly sampled data given a dictionary 
     of datasets containing their paths and indexes to sample from
+
+    Batches are drawn from a shuffle of the rows of all the datasets that 
+    is made again every epoch (see epoch_sampler). 
+
+    With cache=True the rows are sliced from the memory mapped training 
+    cache of each dataset (see build_cache) with the labels already 
+    binned, otherwise nearby rows are read from the hdf5 file together 
+    and the batch is normalized and binned at once.
+
+    augment is an Augmenter applied to the images and angles before they 
+    are normalized. With reuse=True augmented batches are returned in the 
+    augmenter's buffers, which are overwritten by the next batch.
     '''
-       
-    rgens = [row_gen(d['path'], d['ix']) for d in dataset_list]
-    
+    if cache:
+        sources = [open_cache(d['path']) for d in dataset_list]
+    else:
+        sources = [h5py.File(d['path'], "r") for d in dataset_list]
+
+    for rows, order in epoch_sampler(dataset_list, batch_size):
+        if cache and augment is None:
+            yield cached_batch(sources, rows, order)
+            continue
+
+        if cache:
+            X, angle, throttle = cached_rows(sources, rows, order)
+        else:
+            X = []
+            Y = []
+            for i, ix in rows:
+                x, y = read_rows(sources[i], ix)
+                X.append(x)
+                Y.append(y)
+            X = np.concatenate(X)[order]
+            Y = np.concatenate(Y)[order]
+            angle, throttle = Y[:, 0], Y[:, 1]
+
+        if augment is None:
+            yield dk.utils.norm_imgs(X), {'angle_out': dk.utils.bin_Y(angle), 'throttle_out': throttle}
+            continue
+
+        X, angle = augment(X, angle)
+        X = dk.utils.norm_imgs_offsets(X, dk.utils.img_offsets(X), out=X)
+        if not reuse:
+            X = X.copy()
+        yield X, {'angle_out': dk.utils.bin_Y(angle), 'throttle_out': throttle}
+
+
+def _cache_selections(rows, order):
+    '''
+    Yield the cache number, its rows in file order and where they go in 
+    the batch for the rows [(cache number, ix)] of a batch.
+    '''
+    ix = np.concatenate([r[1] for r in rows])[order]
+    which = np.concatenate([np.full(len(r[1]), r[0]) for r in rows])[order]
+    for i, _ in rows:
+        mask = which == i
+        sel = ix[mask]
+        #page cache friendly: read the rows in file order.
+        sort = np.argsort(sel, kind='stable')
+        yield i, sel[sort], np.flatnonzero(mask)[sort]
+
+
+def cached_batch(caches, rows, order):
+    '''
+    Return a normalized float32 batch of the rows [(cache number, ix)] of 
+    open training caches in the given order.
+    '''
+    cache = caches[rows[0][0]]
+    X = np.empty((len(order),) + cache['X'].shape[1:], dtype=np.float32)
+    angle = np.empty((len(order),) + cache['angle_out'].shape[1:], dtype=np.float32)
+    throttle = np.empty(len(order), dtype=np.float32)
+    for i, sel, dest in _cache_selections(rows, order):
+        c = caches[i]
+        X[dest] = dk.utils.norm_imgs_offsets(c['X'][sel], c['offset'][sel])
+        angle[dest] = c['angle_out'][sel]
+        throttle[dest] = c['throttle_out'][sel]
+    return X, {'angle_out': angle, 'throttle_out': throttle}
+
+
+def cached_rows(caches, rows, order):
+    '''
+    Return the uint8 images, angles and throttles of the rows of a batch 
+    before they are normalized and binned.
+    '''
+    cache = caches[rows[0][0]]
+    X = np.empty((len(order),) + cache['X'].shape[1:], dtype=np.uint8)
+    angle = np.empty(len(order), dtype=np.float32)
+    throttle = np.empty(len(order), dtype=np.float32)
+    for i, sel, dest in _cache_selections(rows, order):
+        c = caches[i]
+        X[dest] = c['X'][sel]
+        angle[dest] = c['Y'][sel, 0]
+        throttle[dest] = c['throttle_out'][sel]
+    return X, angle, throttle
+
+
+class Augmenter():
+    '''
+    Random changes applied to whole batches of images (n, height, width, 
+    channels) and their angles to get more variety from the same laps:
+
+        flip - probability an image is mirrored and its angle negated
+        shift - max pixels images are moved sideways, the angle is 
+                corrected by shift_angle per pixel
+        vshift - max pixels images are moved up or down
+        brightness - max fraction of 255 added or removed
+        contrast - max fraction the contrast is changed
+        shadow - probability a random side of a line across the image 
+                 is darkened to between shadow_dark and 1
+
+    Images are copied once into a padded buffer with their borders 
+    repeated, and every shifted image is then selected from a strided 
+    view of all the shifts. Buffers are kept between batches of the same 
+    shape, so the images returned are overwritten by the next call. The 
+    same seed gives the same batches.
+    '''
+
+    def __init__(self, flip=.5, shift=8, shift_angle=.004, vshift=4, brightness=.2, 
+                 contrast=.2, shadow=.3, shadow_dark=.5, seed=None):
+        self.flip = flip
+        self.shift = shift
+        self.shift_angle = shift_angle
+        self.vshift = vshift
+        self.brightness = brightness
+        self.contrast = contrast
+        self.shadow = shadow
+        self.shadow_dark = shadow_dark
+        self.random = np.random.RandomState(seed)
+        self.shape = None
+
+
+    def _buffers(self, shape):
+        if shape == self.shape:
+            return
+        n, h, w, c = shape
+        S, V = self.shift, self.vshift
+        self.shape = shape
+        self.padded = np.empty((n, h + 2*V, w + 2*S, c), dtype=np.uint8)
+        #pixels as single items so they are copied whole.
+        self.padded_px = self.padded.view(np.dtype((np.void, c)))[..., 0]
+        #view of every shifted image: shifts[i, V - dy, S - dx] is image i moved by dx, dy.
+        s0, s1, s2 = self.padded_px.strides
+        self.shifts = np.lib.stride_tricks.as_strided(self.padded_px, shape=(n, 2*V + 1, 2*S + 1, h, w),
+                                                      strides=(s0, s1, s2, s1, s2), writeable=False)
+        self.out = np.empty(shape, dtype=np.float32)
+        self.mask = np.empty((n, h, w * c), dtype=bool)
+        self.channel_cols = np.arange(w * c, dtype=np.float32)
+        self.row_frac = (np.arange(h) / max(h - 1, 1)).astype(np.float32)
+
+
+    def __call__(self, X, angle):
+        '''
+        Return the augmented float32 images with values from 0 to 255 and 
+        their angles.
+        '''
+        X = np.ascontiguousarray(X, dtype=np.uint8)
+        n, h, w, c = X.shape
+        S, V = self.shift, self.vshift
+        self._buffers(X.shape)
+        rs = self.random
+        angle = np.array(angle, dtype=np.float32)
+
+        flip = np.flatnonzero(rs.rand(n) < self.flip)
+        dx = rs.randint(-S, S + 1, size=n)
+        dy = rs.randint(-V, V + 1, size=n)
+        gain = 1 + rs.uniform(-self.contrast, self.contrast, size=n).astype(np.float32)
+        bright = 255 * rs.uniform(-self.brightness, self.brightness, size=n).astype(np.float32)
+        shadow = np.flatnonzero(rs.rand(n) < self.shadow)
+        dark = rs.uniform(self.shadow_dark, 1, size=len(shadow)).astype(np.float32)
+        top = rs.uniform(0, w, size=len(shadow)).astype(np.float32)
+        bottom = rs.uniform(0, w, size=len(shadow)).astype(np.float32)
+        side = rs.rand(len(shadow)) < .5
+
+        #flip, then pad by repeating the borders so shifts don't leave holes.
+        P = self.padded
+        X_px = X.view(np.dtype((np.void, c)))[..., 0]
+        self.padded_px[:, V:V+h, S:S+w] = X_px
+        self.padded_px[flip, V:V+h, S:S+w] = X_px[flip, :, ::-1]
+        P[:, V:V+h, :S] = P[:, V:V+h, S:S+1]
+        P[:, V:V+h, S+w:] = P[:, V:V+h, S+w-1:S+w]
+        P[:, :V] = P[:, V:V+1]
+        P[:, V+h:] = P[:, V+h-1:V+h]
+        pixels = self.shifts[np.arange(n), V - dy, S - dx]
+        pixels = pixels.view(np.uint8).reshape(n, h, w * c)
+
+        angle[flip] *= -1
+        angle += dx * self.shift_angle
+        np.clip(angle, -1, 1, out=angle)
+
+        #contrast around mid grey and brightness in one multiply add.
+        out = self.out.reshape(n, h, w * c)
+        np.multiply(pixels, gain[:, None, None], out=out)
+        out += (128 * (1 - gain) + bright)[:, None, None]
+
+        #darken one side of a line from a random top to bottom column.
+        if len(shadow):
+            edge = np.floor(top[:, None] + (bottom - top)[:, None] * self.row_frac) * c
+            mask = self.mask[:len(shadow)]
+            np.less(self.channel_cols, edge[:, :, None], out=mask)
+            mask ^= side[:, None, None]
+            shaded = out[shadow]
+            np.multiply(shaded, dark[:, None, None], out=shaded, where=mask)
+            out[shadow] = shaded
+
+        np.clip(out, 0, 255, out=out)
+        return self.out, angle
+
+
+class PrefetchLoader():
+    '''
+    Iterator returning the same batches as batch_gen, made ahead of time 
+    by worker processes so the training process doesn't wait on reading, 
+    normalizing and binning.
+
+    Each worker opens its own hdf5 files and is seeded with seed + its 
+    number. Batches are written into a ring of preallocated shared memory 
+    slots and only the slot number goes through the queues, so the arrays 
+    are never pickled. Workers wait when every slot is full.
+
+    augment is a dictionary of Augmenter arguments, each worker augments 
+    its batches with an Augmenter seeded like the worker.
+
+    Waiting for a batch checks every timeout seconds that the workers are 
+    alive and raises a RuntimeError when one died. cache is passed to 
+    batch_gen.
+    '''
+
+    def __init__(self, dataset_list, batch_size=128, workers=2, slots=None, seed=None, augment=None,
+                 timeout=1.0, cache=True):
+        self.batch_size = batch_size
+        self.timeout = timeout
+        slots = slots or workers * 2
+        if seed is None:
+            seed = np.random.randint(2**31 - workers)
+
+        with h5py.File(dataset_list[0]['path'], "r") as f:
+            img_shape = f['X'].shape[1:]
+        bins = dk.utils.bin_Y(np.zeros(1)).shape[1]
+
+        self.shapes = {'X': (batch_size,) + img_shape, 
+                       'angle_out': (batch_size, bins),
+                       'throttle_out': (batch_size,)}
+
+        self.slots = []
+        for i in range(slots):
+            self.slots.append({k: multiprocessing.RawArray('f', int(np.prod(shape))) 
+                               for k, shape in self.shapes.items()})
+
+        self.free = multiprocessing.Queue()
+        self.ready = multiprocessing.Queue()
+        for i in range(slots):
+            self.free.put(i)
+
+        self.workers = []
+        for i in range(workers):
+            p = multiprocessing.Process(target=_prefetch_worker, 
+                                        args=(dataset_list, batch_size, seed + i, augment, cache,
+                                              self.slots, self.shapes, self.free, self.ready))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        while True:
+            try:
+                i = self.ready.get(timeout=self.timeout)
+                break
+            except queue.Empty:
+                for p in self.workers:
+                    if not p.is_alive():
+                        raise RuntimeError('Prefetch worker %s died with exit code %s' 
+                                           %(p.pid, p.exitcode))
+                if not self.workers:
+                    raise RuntimeError('The loader was closed.')
+        arrs = _slot_arrays(self.slots[i], self.shapes)
+        X = arrs['X'].copy()
+        Y = {'angle_out': arrs['angle_out'].copy(), 
+             'throttle_out': arrs['throttle_out'].copy()}
+        self.free.put(i)
+        return X, Y
+
+
+    def close(self):
+        for p in self.workers:
+            p.terminate()
+        self.workers = []
+
+
+
+def _slot_arrays(slot, shapes):
+    ''' Return numpy views of the shared arrays of a slot. '''
+    return {k: np.frombuffer(slot[k], dtype=np.float32).reshape(shape) 
+            for k, shape in shapes.items()}
+
+
+def _prefetch_worker(dataset_list, batch_size, seed, augment, cache, slots, shapes, free, ready):
+    np.random.seed(seed)
+    if augment is not None:
+        augment = Augmenter(seed=seed, **augment)
+    #batches are copied to a slot right away so the buffers can be reused.
+    gen = batch_gen(dataset_list, batch_size, cache=cache, augment=augment, reuse=True)
     while True:
-        X = []
-        Y = []
-        for i in range(batch_size):
-            rg = np.random.choice(rgens)
-            x, y = next(rg)
-            X.append(x)
-            Y.append(y)
-
-        X = np.array(X)
-        Y = np.array(Y)
-
-        yield X, {'angle_out': dk.utils.bin_Y(Y[:, 0]), 'throttle_out': Y[:, 1]}
-    
-    
-def split_datasets(h5_paths, val_frac=.1, test_frac=.1, batch_size=128):
+        X, Y = next(gen)
+        i = free.get()
+        arrs = _slot_arrays(slots[i], shapes)
+        arrs['X'][:] = X
+        arrs['angle_out'][:] = Y['angle_out']
+        arrs['throttle_out'][:] = Y['throttle_out']
+        ready.put(i)
+
+
+
+class LazyLoader():
+    ''' Iterator that makes its generator with make() on the first batch. '''
+
+    def __init__(self, make):
+        self.make = make
+        self.gen = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.gen is None:
+            self.gen = self.make()
+        return next(self.gen)
+
+    def close(self):
+        if self.gen is not None:
+            self.gen.close()
+            self.gen = None
+
+
+
+def split_indexes(h5_paths, val_frac=.1, test_frac=.1):
     '''
-    Return three shuffled generators for train, val and test.
+    Return the train, val and test lists of datasets. Each dataset is a 
+    dictionary with its path and the sorted rows (ix) in that split.
     '''
 
     #create a dictionary of the datasets and their suffled indexes
     ds = []
     for p in h5_paths:
         d = {}
-        file = h5py.File(p, "r")
-        n = file['X'].shape[0]
+        with h5py.File(p, "r") as file:
+            n = file['X'].shape[0]
         ix = np.arange(n)
         np.random.shuffle(ix)
         
@@ -133,10 +755,53 @@ def split_datasets(h5_paths, val_frac=.1, test_frac=.1, batch_size=128):
         ds_val.append(d_val)
         ds_test.append(d_test)
 
+    return ds_train, ds_val, ds_test
+
+
+def split_datasets(h5_paths, val_frac=.1, test_frac=.1, batch_size=128, workers=0, split=None,
+                   augment=None, seed=None, cache=True):
+    '''
+    Return three shuffled generators for train, val and test.
+
+    With workers > 0 each generator is a PrefetchLoader using that 
+    many processes. The test generator is only made when its first batch 
+    is asked for. A split returned by split_indexes can be given to 
+    use the same rows as a previous run. augment is a dictionary of 
+    Augmenter arguments used for the training batches only. With a seed 
+    the split, the batches and the augmentation are the same every run.
+    With cache=False batches are read from the hdf5 files instead of 
+    the training caches (see build_cache).
+
+    The generators have a close() method that stops their workers.
+    '''
+
+    if seed is not None:
+        np.random.seed(seed)
+
+    if split is None:
+        split = split_indexes(h5_paths, val_frac=val_frac, test_frac=test_frac)
+    ds_train, ds_val, ds_test = split
+
+    #build the training caches once, before any prefetching process opens them.
+    if cache:
+        for p in h5_paths:
+            build_cache(p)
+
     #return a generator that combines all the datasets. 
-    train = {'gen': batch_gen(ds_train), 'n': sum([i['n'] for i in ds_train])}
-    val = {'gen': batch_gen(ds_val), 'n': sum([i['n'] for i in ds_val])}
-    test = {'gen': batch_gen(ds_test), 'n': sum([i['n'] for i in ds_test])}
+    #each loader's workers get their own seeds.
+    def gen(ds, number, augment=None):
+        gen_seed = None if seed is None else seed + number * max(workers, 1)
+        if workers > 0:
+            return PrefetchLoader(ds, batch_size, workers=workers, seed=gen_seed, augment=augment,
+                                  cache=cache)
+        if augment is not None:
+            augment = Augmenter(seed=gen_seed, **augment)
+        return batch_gen(ds, batch_size, cache=cache, augment=augment)
+
+    train = {'gen': gen(ds_train, 0, augment), 'n': sum([i['n'] for i in ds_train])}
+    val = {'gen': gen(ds_val, 1), 'n': sum([i['n'] for i in ds_val])}
+    #most runs never test, so the test workers aren't started until they are used.
+    test = {'gen': LazyLoader(lambda: gen(ds_test, 2)), 'n': sum([i['n'] for i in ds_test])}
 
     return train, val, test   
 
@@ -0,0 +1,300 @@
+'''
+inference.py
+
+Runs categorical models with numpy only so pilots can be loaded on the
+car without keras or tensorflow. Models are either exports made by
+models.export_model or keras .hdf5 files whose layers are described by
+the conv and dense configs given to models.categorical_model_factory.
+
+An export is an .npz file with the layers of the model as json in 'spec'
+and their weights as 'w0', 'b0', 'w1', ... Weights are saved as float16 or
+as int8 with a float32 scale per output channel ('s0', ...) and turned
+back into float32 when loaded. Pruned weights are saved as zeros which
+the compressed file stores in almost no space.
+'''
+
+import json
+
+import numpy as np
+import h5py
+from numpy.lib.stride_tricks import as_strided
+
+
+def quantize(w, dtype='int8'):
+    '''
+    Return the arrays to save for the weights w: the int8 weights and the
+    scale of each output channel (last axis), or the float16 weights.
+    '''
+    if dtype == 'float16':
+        return {'w': w.astype(np.float16)}
+    if dtype == 'float32':
+        return {'w': w.astype(np.float32)}
+    if dtype != 'int8':
+        raise ValueError('Unknown weight type: %s' % dtype)
+
+    axes = tuple(range(w.ndim - 1))
+    scale = np.abs(w).max(axis=axes) / 127
+    scale[scale == 0] = 1
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return {'w': q, 's': scale.astype(np.float32)}
+
+
+def dequantize(w, scale=None):
+    if scale is None:
+        return w.astype(np.float32)
+    return w.astype(np.float32) * scale
+
+
+def prune(w, fraction):
+    ''' Return a copy of w with the smallest fraction of the weights zeroed. '''
+    w = np.array(w, dtype=np.float32)
+    if fraction > 0:
+        w[np.abs(w) < np.percentile(np.abs(w), fraction * 100)] = 0
+    return w
+
+
+def save(path, spec, weights, dtype='int8', prune_fraction=0.0):
+    '''
+    Save an export. spec is the list of layers and weights the list of
+    (kernel, bias) of the layers that have weights, in the same order.
+    '''
+    arrays = {'spec': np.array(json.dumps(spec)), 'dtype': np.array(dtype)}
+    for i, (w, b) in enumerate(weights):
+        q = quantize(prune(w, prune_fraction), dtype)
+        arrays['w%d' % i] = q['w']
+        if 's' in q:
+            arrays['s%d' % i] = q['s']
+        arrays['b%d' % i] = b.astype(np.float32)
+    np.savez_compressed(path, **arrays)
+
+
+def load(path):
+    ''' Return the Network saved in an export. '''
+    with np.load(path) as f:
+        spec = json.loads(str(f['spec']))
+        weights = []
+        i = 0
+        while 'w%d' % i in f.files:
+            scale = f['s%d' % i] if 's%d' % i in f.files else None
+            weights.append((dequantize(f['w%d' % i], scale), f['b%d' % i]))
+            i += 1
+    return Network(spec, weights)
+
+
+#the output layers added by models.categorical_model_factory.
+CATEGORICAL_OUTPUTS = [('angle_out', 'softmax'), ('throttle_out', 'relu')]
+
+
+def spec_from_config(conv, dense, outputs=CATEGORICAL_OUTPUTS):
+    '''
+    Return the layer spec of a model made by categorical_model_factory
+    from the same conv and dense layer configs.
+    '''
+    spec = []
+    for c in conv:
+        spec.append({'type': 'conv', 'strides': list(c['strides']),
+                     'activation': c.get('activation', 'relu'),
+                     'filters': c['filters'], 'kernal': list(c['kernal'])})
+        if c.get('pool') is not None:
+            spec.append({'type': 'pool', 'size': list(c['pool']), 'strides': list(c['pool'])})
+    spec.append({'type': 'flatten'})
+    for d in dense:
+        spec.append({'type': 'dense', 'activation': d.get('activation', 'relu'),
+                     'units': d['units']})
+    for name, activation in outputs:
+        spec.append({'type': 'output', 'name': name, 'activation': activation})
+    return spec
+
+
+def config_from_keras(h5_path):
+    '''
+    Return the conv and dense layer configs and the outputs of a model
+    saved by keras, read from the model config stored in the file.
+    '''
+    with h5py.File(h5_path, 'r') as f:
+        model_config = f.attrs['model_config']
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf8')
+    model_config = json.loads(model_config)['config']
+
+    output_names = [o[0] for o in model_config['output_layers']]
+    conv, dense, outputs = [], [], {}
+    for layer in model_config['layers']:
+        kind, config = layer['class_name'], layer['config']
+        if kind in ('Conv2D', 'Convolution2D'):
+            if config.get('padding', 'valid') != 'valid':
+                raise ValueError('Only valid padding is supported: %s' % config['name'])
+            conv.append({'filters': config['filters'], 'kernal': tuple(config['kernel_size']),
+                         'strides': tuple(config['strides']), 'activation': config['activation']})
+        elif kind == 'MaxPooling2D':
+            if tuple(config['strides']) != tuple(config['pool_size']):
+                raise ValueError('Only pools without overlap are supported: %s' % config['name'])
+            conv[-1]['pool'] = tuple(config['pool_size'])
+        elif kind == 'Dense' and config['name'] in output_names:
+            outputs[config['name']] = config['activation']
+        elif kind == 'Dense':
+            dense.append({'units': config['units'], 'activation': config['activation']})
+        elif kind not in ('InputLayer', 'Flatten', 'Dropout'):
+            raise ValueError('Layer is not supported: %s' % config['name'])
+
+    return conv, dense, [(name, outputs[name]) for name in output_names]
+
+
+def keras_weights(h5_path):
+    ''' Return the (layer name, weights) of the layers with weights in a keras file. '''
+    def decode(names):
+        return [n.decode('utf8') if isinstance(n, bytes) else n for n in names]
+
+    with h5py.File(h5_path, 'r') as f:
+        #files saved with model.save keep the weights in a group.
+        group = f['model_weights'] if 'model_weights' in f else f
+        layers = []
+        for name in decode(group.attrs['layer_names']):
+            weight_names = decode(group[name].attrs['weight_names'])
+            if weight_names:
+                layers.append((name, [group[name][w][()] for w in weight_names]))
+    return layers
+
+
+def from_config(conv, dense, weights_path, outputs=CATEGORICAL_OUTPUTS):
+    '''
+    Return the Network of a model made by categorical_model_factory 
+    from its conv and dense configs and the weights saved by keras.
+    '''
+    spec = spec_from_config(conv, dense, outputs)
+    layers = keras_weights(weights_path)
+
+    heads = dict((name, w) for name, w in layers if name in dict(outputs))
+    trunk = [w for name, w in layers if name not in heads]
+    weighted = [l for l in spec if l['type'] in ('conv', 'dense')]
+    if len(trunk) != len(weighted) or len(heads) != len(outputs):
+        raise ValueError('The configs have %s layers with weights but %s has %s'
+                         % (len(weighted) + len(outputs), weights_path, len(layers)))
+
+    for layer, (kernel, bias) in zip(weighted, trunk):
+        if layer['type'] == 'conv':
+            expected = tuple(layer['kernal']) + (kernel.shape[2], layer['filters'])
+        else:
+            expected = (kernel.shape[0], layer['units'])
+        if kernel.shape != expected:
+            raise ValueError('Expected a kernel of shape %s but found %s' % (expected, kernel.shape))
+
+    weights = [(k.astype(np.float32), b.astype(np.float32)) for k, b in trunk]
+    weights += [tuple(w.astype(np.float32) for w in heads[name]) for name, _ in outputs]
+    return Network(spec, weights)
+
+
+def load_keras(h5_path, conv=None, dense=None):
+    '''
+    Return the Network of a keras model file. The conv and dense configs
+    are read from the file when they aren't given.
+    '''
+    outputs = CATEGORICAL_OUTPUTS
+    if conv is None or dense is None:
+        conv, dense, outputs = config_from_keras(h5_path)
+    return from_config(conv, dense, h5_path, outputs)
+
+
+
+'''
+LAYERS
+'''
+
+def windows(x, size, strides):
+    '''
+    Return a view of the (height, width) windows of a batch of images
+    with shape (n, out_height, out_width, size[0], size[1], channels).
+    '''
+    n, h, w, c = x.shape
+    oh = (h - size[0]) // strides[0] + 1
+    ow = (w - size[1]) // strides[1] + 1
+    sn, sh, sw, sc = x.strides
+    return as_strided(x, shape=(n, oh, ow, size[0], size[1], c),
+                      strides=(sn, sh * strides[0], sw * strides[1], sh, sw, sc),
+                      writeable=False)
+
+
+def conv2d(x, kernel, bias, strides=(1, 1)):
+    ''' Valid convolution of images (n, h, w, c) with a keras kernel. '''
+    #the windows are copied into one matrix (im2col) and multiplied at once.
+    cols = windows(x, kernel.shape[:2], strides)
+    out = np.tensordot(cols, kernel, axes=([3, 4, 5], [0, 1, 2]))
+    out += bias
+    return out
+
+
+def max_pool(x, size, strides=None):
+    strides = strides or size
+    if tuple(strides) == tuple(size):
+        #non overlapping pools are a reshape of the image.
+        n, h, w, c = x.shape
+        oh, ow = h // size[0], w // size[1]
+        x = x[:, :oh * size[0], :ow * size[1]]
+        return x.reshape(n, oh, size[0], ow, size[1], c).max(axis=(2, 4))
+    return windows(x, size, strides).max(axis=(3, 4))
+
+
+def dense(x, kernel, bias):
+    out = x.dot(kernel)
+    out += bias
+    return out
+
+
+def activate(x, activation):
+    if activation in (None, 'linear'):
+        return x
+    if activation == 'relu':
+        return np.maximum(x, 0, out=x)
+    if activation == 'softmax':
+        e = np.exp(x - x.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+    if activation == 'sigmoid':
+        return 1 / (1 + np.exp(-x))
+    if activation == 'tanh':
+        return np.tanh(x)
+    raise ValueError('Unknown activation: %s' % activation)
+
+
+class Network():
+    '''
+    Forward pass of a model made of a stack of layers shared by one or
+    more dense output layers. spec is a list of layers like
+
+        {'type': 'conv', 'strides': [2, 2], 'activation': 'relu'}
+        {'type': 'pool', 'size': [2, 2], 'strides': [2, 2]}
+        {'type': 'flatten'}
+        {'type': 'dense', 'activation': 'relu'}
+        {'type': 'output', 'name': 'angle_out', 'activation': 'softmax'}
+
+    and weights the (kernel, bias) of each conv, dense and output layer
+    in order. Dropout isn't used when predicting so it has no layer.
+    '''
+
+    def __init__(self, spec, weights):
+        self.spec = spec
+        self.weights = weights
+        self.output_names = [l['name'] for l in spec if l['type'] == 'output']
+
+    def predict(self, X):
+        ''' Return the list of outputs for a batch of images. '''
+        x = np.asarray(X, dtype=np.float32)
+        outputs = []
+        weights = iter(self.weights)
+        for layer in self.spec:
+            kind = layer['type']
+            if kind == 'conv':
+                kernel, bias = next(weights)
+                x = activate(conv2d(x, kernel, bias, layer['strides']), layer['activation'])
+            elif kind == 'pool':
+                x = max_pool(x, layer['size'], layer.get('strides'))
+            elif kind == 'flatten':
+                x = x.reshape(len(x), -1)
+            elif kind == 'dense':
+                kernel, bias = next(weights)
+                x = activate(dense(x, kernel, bias), layer['activation'])
+            elif kind == 'output':
+                kernel, bias = next(weights)
+                outputs.append(activate(dense(x, kernel, bias), layer['activation']))
+            else:
+                raise ValueError('Unknown layer type: %s' % kind)
+        return outputs
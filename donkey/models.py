@@ -4,7 +4,19 @@ models.py
 Functions to create and train Keras models plus a few common model Architectures.
 
 """
+import os
+import sys
+import time
+import signal
+import resource
+import threading
+import collections
+
+import numpy as np
 import keras
+if int(keras.__version__.split('.')[0]) < 2:
+    raise ImportError('You need keras version 2.0.0 or higher. Run "pip install keras --upgrade"')
+
 from keras.layers import Input, Dense, merge
 from keras.models import Model
 from keras.models import Sequential
@@ -12,6 +24,8 @@ from keras.layers import Convolution2D, MaxPooling2D, SimpleRNN, Reshape, BatchN
 from keras.layers import Activation, Dropout, Flatten, Dense
 from keras.regularizers import l2
 
+import donkey as dk
+
 
 
 def conv_layer_factory(x, filters=None, kernal=None, 
@@ -90,9 +104,10 @@ nvidia_arch = {'conv': nvidia_conv, 'dense':nvidia_dense}
 
 
 
-def train_gen(model, model_path, train_gen, val_gen, steps=10, epochs=100, ):
+def train_gen(model, model_path, train_gen, val_gen, steps=10, epochs=100, callbacks=None):
     '''
     Function to train models and save their best models after each epoch.
+    Extra keras callbacks can be given to run with the default ones.
     Return the hist object.
     '''
 
@@ -105,7 +120,7 @@ def train_gen(model, model_path, train_gen, val_gen, steps=10, epochs=100, ):
     early_stop = keras.callbacks.EarlyStopping(monitor='val_loss', min_delta=.0005, patience=4, 
                                          verbose=1, mode='auto')
 
-    callbacks_list = [save_best, early_stop]
+    callbacks_list = [save_best, early_stop] + list(callbacks or [])
 
 
     hist = model.fit_generator(
@@ -117,4 +132,226 @@ def train_gen(model, model_path, train_gen, val_gen, steps=10, epochs=100, ):
                             validation_data=val_gen, 
                             nb_val_samples=steps*.2)
 
-    return hist
\ No newline at end of file
+    return hist
+
+
+
+def export_model(model, export_path, dtype='int8', prune=0.0):
+    '''
+    Save a categorical model (or the path of one) as an export that
+    inference.load runs with numpy only. Weights are saved as int8 or
+    float16, after zeroing the prune fraction of the smallest ones.
+    Return the layer spec of the export.
+    '''
+    from donkey import inference
+
+    if isinstance(model, str):
+        model = keras.models.load_model(model)
+
+    spec = []
+    weights = []
+    heads = {}
+    for layer in model.layers:
+        config = layer.get_config()
+        if isinstance(layer, (keras.layers.InputLayer, Dropout)):
+            continue
+        elif isinstance(layer, Convolution2D):
+            if config['padding'] != 'valid':
+                raise ValueError('Only valid padding can be exported: %s' % layer.name)
+            spec.append({'type': 'conv', 'strides': list(config['strides']),
+                         'activation': config['activation']})
+            weights.append(layer.get_weights())
+        elif isinstance(layer, MaxPooling2D):
+            spec.append({'type': 'pool', 'size': list(config['pool_size']),
+                         'strides': list(config['strides'])})
+        elif isinstance(layer, Flatten):
+            spec.append({'type': 'flatten'})
+        elif isinstance(layer, Dense) and layer.name in model.output_names:
+            heads[layer.name] = ({'type': 'output', 'name': layer.name,
+                                  'activation': config['activation']}, layer.get_weights())
+        elif isinstance(layer, Dense):
+            spec.append({'type': 'dense', 'activation': config['activation']})
+            weights.append(layer.get_weights())
+        else:
+            raise ValueError('Layer can not be exported: %s' % layer.name)
+
+    #the output layers all read the last layer, in the order of the model's outputs.
+    for name in model.output_names:
+        spec.append(heads[name][0])
+        weights.append(heads[name][1])
+
+    inference.save(export_path, spec, weights, dtype=dtype, prune_fraction=prune)
+    return spec
+
+
+
+class TrainingProfiler(keras.callbacks.Callback):
+    '''
+    Records for every training step the time keras waited for the batch 
+    generator (from the end of the previous step, or the start of the 
+    epoch, to the start of this one) and the time of the step itself.
+
+    Steps are appended to a csv at log_path with the samples in the batch 
+    and the peak resident memory of the process. summary() returns the 
+    totals of the run for results tables.
+
+    With profile_steps > 0 the python stacks of the training process are 
+    sampled every profile_interval seconds during the first profile_steps 
+    steps and written to log_path + '.stacks' as folded stacks (one 
+    "frame;frame;frame count" line per stack) for flame graph tools.
+    '''
+
+    def __init__(self, log_path=None, profile_steps=0, profile_interval=.005):
+        super().__init__()
+        self.log_path = log_path
+        self.profile_steps = profile_steps
+        self.profile_interval = profile_interval
+        self.sampler = None
+
+        self.steps = 0
+        self.samples = 0
+        self.wait_time = 0.0
+        self.step_time = 0.0
+        self.last_end = None
+        self.step_start = None
+        self.epoch = 0
+        self.log_file = None
+
+
+    def on_train_begin(self, logs=None):
+        self.train_start = time.time()
+        if self.log_path is not None:
+            self.log_file = open(self.log_path, 'w')
+            self.log_file.write('epoch,step,wait_ms,step_ms,samples,peak_rss_mb\n')
+        if self.profile_steps:
+            self.sampler = StackSampler(self.profile_interval).start()
+
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.last_end = time.time()
+
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step_start = time.time()
+
+
+    def on_batch_end(self, batch, logs=None):
+        end = time.time()
+        wait = self.step_start - self.last_end
+        step = end - self.step_start
+        size = int((logs or {}).get('size', 0))
+
+        self.steps += 1
+        self.samples += size
+        self.wait_time += wait
+        self.step_time += step
+        self.last_end = end
+
+        if self.log_file is not None:
+            self.log_file.write('%d,%d,%.2f,%.2f,%d,%.1f\n' %(self.epoch, batch, wait * 1000, 
+                                                             step * 1000, size, peak_rss_mb()))
+
+        if self.sampler is not None and self.steps >= self.profile_steps:
+            self.stop_sampler()
+
+
+    def on_train_end(self, logs=None):
+        self.train_end = time.time()
+        self.stop_sampler()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+    def stop_sampler(self):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        if self.log_path is not None:
+            self.sampler.save(self.log_path + '.stacks')
+        self.sampler = None
+
+
+    def summary(self):
+        busy = self.wait_time + self.step_time
+        return {'steps': self.steps,
+                'samples_per_sec': self.samples / busy if busy else 0.0,
+                'wait_ms_per_step': self.wait_time / self.steps * 1000 if self.steps else 0.0,
+                'step_ms_per_step': self.step_time / self.steps * 1000 if self.steps else 0.0,
+                'data_stall_frac': self.wait_time / busy if busy else 0.0,
+                'peak_rss_mb': peak_rss_mb()}
+
+
+class MedianPruner(keras.callbacks.Callback):
+    '''
+    Logs the validation loss of a trial after each epoch and stops the
+    trial when it's worse than the median of the other trials at the
+    same epoch.
+    '''
+
+    def __init__(self, trial_id, progress_path, prune_after=5, min_trials=2):
+        super().__init__()
+        self.trial_id = trial_id
+        self.progress_path = progress_path
+        self.prune_after = prune_after
+        self.min_trials = min_trials
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_loss = float(logs['val_loss'])
+        dk.utils.append_jsonl(self.progress_path, {'trial': self.trial_id, 'epoch': epoch, 'val_loss': val_loss})
+
+        if not self.prune_after or epoch + 1 < self.prune_after:
+            return
+        others = [r['val_loss'] for r in dk.utils.read_jsonl(self.progress_path)
+                  if r['epoch'] == epoch and r['trial'] != self.trial_id]
+        if len(others) >= self.min_trials and val_loss > np.median(others):
+            print('pruning %s: val_loss %s is worse than the median %s'
+                  %(self.trial_id, val_loss, np.median(others)))
+            self.pruned = True
+            self.model.stop_training = True
+
+
+def peak_rss_mb():
+    ''' Return the peak resident memory of this process in MB. '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #linux reports kilobytes, macOS bytes.
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+class StackSampler():
+    '''
+    Counts the python stack of the main thread every interval seconds of 
+    cpu time using a profiling timer signal.
+    '''
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def start(self):
+        if threading.current_thread() is not threading.main_thread():
+            #signals are only delivered to the main thread.
+            return self
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' %(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' %(stack, count))
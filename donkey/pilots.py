@@ -9,8 +9,13 @@ models to help direct the vehicles motion.
 
 """
 from datetime import datetime
+import time
+import threading
+import queue
+import collections
+from concurrent.futures import Future
 
-import keras
+import numpy as np
 import os
 
 from donkey import utils
@@ -30,41 +35,223 @@ class BasePilot:
         speed = 0.0
         return angle, speed
 
+    def decide_batch(self, img_arrs):
+        ''' Return a list of (angle, throttle) for a batch of images. '''
+        return [self.decide(img_arr) for img_arr in img_arrs]
+
     def load(self):
         pass
 
 
 class KerasCategorical(BasePilot):
+    '''
+    Pilot using a categorical Keras model. Frames are copied into a 
+    preallocated input and run through the model's backend function, 
+    skipping the per call overhead of model.predict. The model is warmed 
+    up when loaded so the first frame doesn't pay for building the graph.
+    '''
     def __init__(self, model_path, **kwargs):
         self.model_path = model_path
         self.model = None  # load() loads the model
+        self.predict_fn = None
+        self.input_buffer = None
+        self.lock = threading.Lock()
+        self.latency = utils.LatencyStats()
         super().__init__(**kwargs)
 
     def decide(self, img_arr):
-        img_arr = img_arr.reshape((1,) + img_arr.shape)
-        angle_binned, throttle = self.model.predict(img_arr)
-        angle_certainty = max(angle_binned[0])
+        start = time.time()
+        with self.lock:
+            self.input_buffer[0] = img_arr
+            angle_binned, throttle = self.run(self.input_buffer)
         angle_unbinned = utils.unbin_Y(angle_binned)
+        self.latency.record(time.time() - start)
         return angle_unbinned[0], throttle[0][0]
 
-    def load(self):
+    def decide_batch(self, img_arrs):
+        start = time.time()
+        img_arrs = np.asarray(img_arrs, dtype=np.float32)
+        with self.lock:
+            angle_binned, throttle = self.run(img_arrs)
+        angle_unbinned = utils.unbin_Y(angle_binned)
+        self.latency.record(time.time() - start)
+        return list(zip(angle_unbinned, throttle[:, 0]))
+
+    def run(self, img_arrs):
+        ''' Return the model's outputs for a batch of images. '''
+        return self.predict_fn([img_arrs, 0])
+
+    def load(self, warmup=3):
+        #keras is only imported by pilots that use it so the car can run
+        #exported models without it.
+        import keras
         self.model = keras.models.load_model(self.model_path)
+        self.predict_fn = keras.backend.function(
+            self.model.inputs + [keras.backend.learning_phase()], 
+            self.model.outputs)
+        self.input_buffer = np.zeros((1,) + tuple(self.model.input_shape[1:]), 
+                                     dtype=np.float32)
+        for i in range(warmup):
+            self.run(self.input_buffer)
+
+    def latency_stats(self):
+        ''' Return percentiles of the time decide takes in milliseconds. '''
+        return self.latency.percentiles()
+
+
+class NumpyCategorical(BasePilot):
+    '''
+    Pilot using a categorical model exported by models.export_model (.npz) 
+    or saved by keras. The model is run with numpy by inference.Network so 
+    neither keras nor tensorflow are imported. The conv and dense layer 
+    configs of a keras model are read from its file unless given.
+    '''
+    def __init__(self, model_path, conv=None, dense=None, **kwargs):
+        self.model_path = model_path
+        self.conv = conv
+        self.dense = dense
+        self.model = None  # load() loads the model
+        self.latency = utils.LatencyStats()
+        super().__init__(**kwargs)
+
+    def decide(self, img_arr):
+        angle, throttle = self.decide_batch(img_arr[np.newaxis])[0]
+        return angle, throttle
+
+    def decide_batch(self, img_arrs):
+        start = time.time()
+        angle_binned, throttle = self.run(img_arrs)
+        angle_unbinned = utils.unbin_Y(angle_binned)
+        self.latency.record(time.time() - start)
+        return list(zip(angle_unbinned, throttle[:, 0]))
+
+    def run(self, img_arrs):
+        ''' Return the model's outputs for a batch of images. '''
+        return self.model.predict(img_arrs)
+
+    def load(self):
+        from donkey import inference
+        if self.model_path.endswith('.npz'):
+            self.model = inference.load(self.model_path)
+        else:
+            self.model = inference.load_keras(self.model_path, self.conv, self.dense)
+
+    def latency_stats(self):
+        ''' Return percentiles of the time decide takes in milliseconds. '''
+        return self.latency.percentiles()
+
+
+class BatchingPilot(BasePilot):
+    '''
+    Shares a pilot between many vehicles. Frames submitted while the 
+    pilot is busy wait up to max_wait seconds for others to arrive and 
+    are then decided together as one batch of up to max_batch frames. 
+    Each caller gets a future with its own angle and throttle.
+
+    Frames of different shapes are decided in separate batches so a 
+    vehicle sending the wrong size only fails its own futures.
+    '''
+    def __init__(self, pilot, max_batch=16, max_wait=.005):
+        self.pilot = pilot
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.loaded = False
+
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.frames = 0
+        self.max_batch_seen = 0
+        self.queue_wait = utils.LatencyStats()
+
+        super().__init__(name=pilot.name, last_modified=pilot.last_modified)
+
+        t = threading.Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+
+    def load(self):
+        #vehicles sharing the pilot load it once.
+        if not self.loaded:
+            self.pilot.load()
+            self.loaded = True
+
+    def submit(self, img_arr):
+        ''' Queue a frame and return a future of its (angle, throttle). '''
+        future = Future()
+        self.queue.put((time.time(), img_arr, future))
+        return future
+
+    def decide(self, img_arr):
+        return self.submit(img_arr).result()
+
+    def update(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = batch[0][0] + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        now = time.time()
+        shapes = collections.OrderedDict()
+        for submitted, img_arr, future in batch:
+            self.queue_wait.record(now - submitted)
+            shapes.setdefault(np.shape(img_arr), []).append((img_arr, future))
+
+        for group in shapes.values():
+            try:
+                results = self.pilot.decide_batch([img_arr for img_arr, _ in group])
+            except Exception as err:
+                for _, future in group:
+                    future.set_exception(err)
+                continue
+
+            for (_, future), result in zip(group, results):
+                future.set_result(result)
+
+            self.batches += 1
+            self.frames += len(group)
+            self.max_batch_seen = max(self.max_batch_seen, len(group))
+
+    def stats(self):
+        ''' Return the batch sizes and time frames waited to be batched. '''
+        return {'batches': self.batches,
+                'frames': self.frames,
+                'mean_batch_size': self.frames / max(self.batches, 1),
+                'max_batch_size': self.max_batch_seen,
+                'queue_wait_ms': self.queue_wait.percentiles()}
 
 
 class PilotHandler:
     """ 
     Convenience class to load default pilots 
     """
-    def __init__(self, models_path):
+    def __init__(self, models_path, numpy=False):
         self.models_path = os.path.expanduser(models_path)
+        #run keras models with numpy, like on the car.
+        self.numpy = numpy
 
     def pilots_from_models(self):
-        """ Load pilots from keras models saved in the models directory. """
+        """ 
+        Load pilots from keras models and exported models (.npz) saved in 
+        the models directory. 
+        """
         models_list = [f for f in os.scandir(self.models_path)]
         pilot_list = []
         for d in models_list:
             last_modified = datetime.fromtimestamp(d.stat().st_mtime)
-            pilot = KerasCategorical(d.path, name=d.name, last_modified=last_modified)
+            if self.numpy or d.name.endswith('.npz'):
+                pilot = NumpyCategorical(d.path, name=d.name, last_modified=last_modified)
+            else:
+                pilot = KerasCategorical(d.path, name=d.name, last_modified=last_modified)
             pilot_list.append(pilot)
 
         print(pilot_list)
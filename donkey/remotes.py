@@ -5,19 +5,25 @@ The client and web server needed to control a car remotely.
 """
 
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import io
 import os
 import copy
 import math
-from threading import Thread
+import struct
+import zipfile
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 
 import requests
 import tornado.ioloop
 import tornado.web
 import tornado.gen
+import tornado.websocket
+import tornado.locks
+import tornado.iostream
 
 from PIL import Image
 
@@ -29,15 +35,45 @@ class RemoteClient():
     '''
     Class used by a vehicle to send (http post requests) driving data and 
     recieve predictions from a remote webserver.
+
+    Requests reuse one connection and have to finish within deadline 
+    seconds, two control loop periods by default. When the server can't be 
+    reached the client waits before trying again, doubling the wait up to 
+    max_backoff seconds. Late or missing answers fall back to the last 
+    answer with its throttle decaying from decay_after seconds to a full 
+    stop at stop_after seconds.
     '''
+
+    #upper edges in milliseconds of the lag histogram bins
+    LAG_BINS = [10, 20, 50, 100, 200, 500, 1000]
     
-    def __init__(self, remote_url: str, vehicle_id='mycar'):
+    def __init__(self, remote_url: str, vehicle_id='mycar', loop_period=.05, 
+                 deadline=None, decay_after=.25, stop_after=1.0, max_backoff=5.0,
+                 log_path='lag_log.csv', log_interval=10):
 
         self.control_url = remote_url + '/api/vehicles/control/' + vehicle_id + '/'
         self.last_milliseconds = 0
         self.session = requests.Session()
 
-        self.log('time,lag\n', write_method='w')
+        self.loop_period = loop_period
+        self.deadline = deadline or loop_period * 2
+        self.decay_after = decay_after
+        self.stop_after = stop_after
+        self.max_backoff = max_backoff
+
+        #lag of each request, kept in memory and written to the log periodically.
+        self.lag = dk.utils.LatencyStats()
+        self.lag_counts = np.zeros(len(self.LAG_BINS) + 1, dtype=int)
+        self.log_path = log_path
+        self.log_interval = log_interval
+        self.last_log = time.time()
+        header = ['<%sms' %b for b in self.LAG_BINS] + ['>=%sms' %self.LAG_BINS[-1]]
+        self.log('time,' + ','.join(header) + '\n', write_method='w')
+
+        #last answer from the server and when it arrived
+        self.answer = (0.0, 0.0, 'user')
+        self.answer_time = 0
+        self.next_attempt = 0
 
         #initialize state variables (used for threading)
         state = {'img_arr': np.zeros(shape=(120,160)),
@@ -51,11 +87,26 @@ class RemoteClient():
         self.start()
 
 
-    def log(self, line, path='lag_log.csv', write_method='a'):
-        with open('lag_log.csv', write_method) as f:
+    def log(self, line, write_method='a'):
+        with open(self.log_path, write_method) as f:
             f.write(line)
 
 
+    def record_lag(self, lag):
+        self.lag.record(lag)
+        self.lag_counts[np.searchsorted(self.LAG_BINS, lag * 1000, side='right')] += 1
+        if time.time() - self.last_log > self.log_interval:
+            self.flush_log()
+
+
+    def flush_log(self):
+        ''' Append the lag histogram to the log and start a new one. '''
+        counts = ','.join(str(c) for c in self.lag_counts)
+        self.log('{},{}\n'.format(datetime.now().time(), counts))
+        self.lag_counts[:] = 0
+        self.last_log = time.time()
+
+
     def start(self):
         # start the thread send images to and updates from remote
         t = Thread(target=self.update, args=())
@@ -66,13 +117,13 @@ class RemoteClient():
         
     def update(self):
         '''
-        Loop run in separate thread to request input from remote server.
-
-        TODO: show the lag from the server to allow for safety stops, if 
-        running local pilot.
+        Loop run in separate thread to request input from remote server
+        once per loop period.
         '''
 
         while True:
+            start = time.time()
+
             #get latest value from server
             resp  = self.decide(self.state['img_arr'], 
                                 self.state['angle'],
@@ -85,18 +136,31 @@ class RemoteClient():
             self.state['angle'] = angle
             self.state['throttle'] = throttle
             self.state['drive_mode'] = drive_mode
-            time.sleep(.02)
+            time.sleep(max(0, self.loop_period - (time.time() - start)))
+
+
+    def staleness(self):
+        ''' Seconds since the last answer from the server arrived. '''
+        return time.time() - self.answer_time
+
+
+    def fallback(self):
+        '''
+        Return the last answer with its throttle decaying linearly to zero 
+        between decay_after and stop_after seconds after it arrived.
+        '''
+        return decay_answer(self.answer, self.staleness(), self.decay_after, self.stop_after)
 
 
     def decide_threaded(self, img_arr, angle, throttle, milliseconds):
         ''' 
-        Return the last state given from the remote server.
+        Return the last state given from the remote server, slowing down
+        when it's stale. See staleness() for its age.
         '''
         #update the state's image
         self.state['img_arr'] = img_arr
 
-        #return last returned last remote response.
-        return self.state['angle'], self.state['throttle'], self.state['drive_mode']
+        return self.fallback()
 
         
     def decide(self, img_arr, angle, throttle, milliseconds):
@@ -105,8 +169,9 @@ class RemoteClient():
         angle and throttle recommendations. 
         '''
 
-        if self.state['connect_attempts'] >= 3:
-            return angle, 0, None
+        if time.time() < self.next_attempt:
+            #wait before trying to reconnect.
+            return self.fallback()
 
         #load features
         data = {
@@ -115,56 +180,269 @@ class RemoteClient():
                 'milliseconds': str(milliseconds)
                 }
 
-        r = None
-        # while r == None:
-        #     #Try connecting to server until connection is made.
-        #     start = time.time()
-            
-        #     try:
-        #         r = self.session.post(self.control_url, 
-        #                         files={'img': dk.utils.arr_to_binary(img_arr), 
-        #                                'json': json.dumps(data)},
-        #                                timeout=0.25)
-        #         self.state['connect_attempts'] = 0
-            
-        #     except (requests.ConnectionError) as err:
-        #         #try to reconnect every 3 seconds
-        #         print("\n Vehicle could not connect to server. Make sure you've " + 
-        #             "started your server and you're referencing the right port.")
-        #         self.state['connect_attempts'] = self.state['connect_attempts'] + 1
-        #         # slow it down, so we can try connecting a few times before stopping it
-        #         return angle, throttle * .8, None
-            
-        #     except (requests.exceptions.ReadTimeout) as err:
-        #         #Lower throttle if their is a long lag.
-        #         print("\n Request took too long. Retrying")
-        #         return angle, throttle * .8, None
-                
-
-        # end = time.time()
-        # lag = end-start
-        # self.log('{}, {} \n'.format(datetime.now().time() , lag ))
-        #print('remote lag: %s' %lag)
-
-        # data = json.loads(r.text)
-        # angle = float(data['angle'])
-        # throttle = float(data['throttle'])
-        # drive_mode = str(data['drive_mode'])
-        angle = 0
-        throttle = 0
-        drive_mode = "local"
+        start = time.time()
+        try:
+            r = self.session.post(self.control_url, 
+                                  files={'img': dk.utils.arr_to_binary(img_arr), 
+                                         'json': json.dumps(data)},
+                                  timeout=self.deadline)
+            r.raise_for_status()
+
+        except requests.ConnectionError as err:
+            self.state['connect_attempts'] += 1
+            backoff = backoff_delay(self.state['connect_attempts'], self.loop_period, self.max_backoff)
+            self.next_attempt = time.time() + backoff
+            print("\n Vehicle could not connect to server. Make sure you've " + 
+                  "started your server and you're referencing the right port. " +
+                  "Retrying in %.2fs" %backoff)
+            return self.fallback()
+
+        except requests.Timeout as err:
+            #count late answers in the lag at the deadline.
+            self.record_lag(time.time() - start)
+            return self.fallback()
+
+        except requests.RequestException as err:
+            print("\n Remote server error: %s" %err)
+            return self.fallback()
+
+        self.state['connect_attempts'] = 0
+        self.record_lag(time.time() - start)
+
+        data = json.loads(r.text)
+        self.answer = (float(data['angle']), float(data['throttle']), str(data['drive_mode']))
+        self.answer_time = time.time()
         
-        return angle, throttle, drive_mode
+        return self.answer
+
+
+
+
+def decay_answer(answer, staleness, decay_after, stop_after):
+    '''
+    Return an (angle, throttle, drive_mode) answer that is staleness 
+    seconds old with its throttle decaying linearly to zero between 
+    decay_after and stop_after seconds.
+    '''
+    angle, throttle, drive_mode = answer
+    if staleness >= stop_after:
+        throttle = 0.0
+    elif staleness > decay_after:
+        throttle *= (stop_after - staleness) / (stop_after - decay_after)
+    return angle, throttle, drive_mode
+
+
+def backoff_delay(attempts, loop_period, max_backoff):
+    ''' Seconds to wait after attempts failed connections, doubling each time. '''
+    return min(max_backoff, loop_period * 2 ** attempts)
+
+
+
+
+#Binary messages of the websocket control channel. A vehicle sends a 
+#header followed by the jpeg of its frame, the server replies with the 
+#sequence number of the frame it decided.
+FRAME_HEADER = struct.Struct('<Iffd') #seq, angle, throttle, milliseconds
+REPLY = struct.Struct('<IffB') #seq, angle, throttle, drive mode
+DRIVE_MODES = ['user', 'auto_angle', 'auto', 'local']
+
+
+def pack_frame(seq, angle, throttle, milliseconds, img_bytes):
+    return FRAME_HEADER.pack(seq, angle, throttle, milliseconds) + img_bytes
+
+
+def unpack_frame(msg):
+    ''' Returns seq, angle, throttle, milliseconds, img_bytes '''
+    return FRAME_HEADER.unpack_from(msg) + (msg[FRAME_HEADER.size:],)
+
+
+def pack_reply(seq, angle, throttle, drive_mode):
+    mode = DRIVE_MODES.index(drive_mode) if drive_mode in DRIVE_MODES else 0
+    return REPLY.pack(seq, angle, throttle, mode)
+
+
+def unpack_reply(msg):
+    ''' Returns seq, angle, throttle, drive_mode '''
+    seq, angle, throttle, mode = REPLY.unpack(msg)
+    return seq, angle, throttle, DRIVE_MODES[mode]
+
+
+
+class RemoteSocketClient():
+    '''
+    Class used by a vehicle to send driving data and recieve predictions 
+    over a persistent websocket instead of one http post per frame.
+
+    Frames are pipelined: up to max_in_flight frames can be sent before 
+    their replies arrive, so the vehicle never waits on the previous 
+    reply. Replies carry the frame's sequence number, older replies than 
+    the last one used are ignored. Frames without a reply after 
+    reply_timeout seconds are counted as lost and stop taking a place.
+
+    Like RemoteClient, the throttle of the last reply decays from 
+    decay_after seconds to a full stop at stop_after seconds when no 
+    newer reply arrives.
+    '''
+
+    def __init__(self, remote_url, vehicle_id='mycar', max_in_flight=2, 
+                 reply_timeout=.5, decay_after=.25, stop_after=1.0):
+        url = remote_url.replace('https://', 'wss://').replace('http://', 'ws://')
+        self.control_url = url + '/api/vehicles/ws/' + vehicle_id + '/'
+        self.max_in_flight = max_in_flight
+        self.reply_timeout = reply_timeout
+        self.decay_after = decay_after
+        self.stop_after = stop_after
+
+        self.conn = None
+        self.seq = 0
+        #send times of the frames waiting for replies, shared by the 
+        #vehicle's thread and the connection's thread.
+        self.sent = {}
+        self.lock = Lock()
+        self.lost = 0
+        self.lag = dk.utils.LatencyStats()
+
+        #last reply recieved from the server and when it arrived
+        self.state = {'seq': 0,
+                      'angle': 0.0,
+                      'throttle': 0.0,
+                      'drive_mode': 'user',
+                      'time': 0}
+
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.start()
+
+
+    def start(self):
+        # run the connection on its own ioloop in a separate thread
+        t = Thread(target=self.update, args=())
+        t.daemon = True
+        t.start()
+        return self
+
+
+    def update(self):
+        self.ioloop.make_current()
+        self.ioloop.add_callback(self.connect)
+        self.ioloop.start()
+
+
+    @tornado.gen.coroutine
+    def connect(self):
+        '''
+        Keep a connection to the server open and read its replies.
+        '''
+        while True:
+            try:
+                conn = yield tornado.websocket.websocket_connect(self.control_url)
+            except Exception as err:
+                print("\n Vehicle could not connect to server. Make sure you've " + 
+                      "started your server and you're referencing the right port.")
+                yield tornado.gen.sleep(1)
+                continue
+
+            with self.lock:
+                self.sent = {}
+            self.conn = conn
+            while True:
+                msg = yield conn.read_message()
+                if msg is None:
+                    break
+                self.on_reply(msg)
+            self.conn = None
+
+
+    def on_reply(self, msg):
+        seq, angle, throttle, drive_mode = unpack_reply(msg)
+        with self.lock:
+            sent = self.sent.pop(seq, None)
+        if sent is not None:
+            self.lag.record(time.time() - sent)
+
+        if seq > self.state['seq']:
+            self.state = {'seq': seq, 
+                          'angle': angle, 
+                          'throttle': throttle, 
+                          'drive_mode': drive_mode,
+                          'time': time.time()}
+
+
+    def send(self, msg):
+        if self.conn is not None:
+            self.conn.write_message(msg, binary=True)
+
+
+    def expire_sent(self):
+        ''' Forget frames waiting longer than reply_timeout. Call with the lock. '''
+        now = time.time()
+        for seq, sent in list(self.sent.items()):
+            if now - sent > self.reply_timeout:
+                del self.sent[seq]
+                self.lost += 1
+
+
+    def staleness(self):
+        ''' Seconds since the last reply from the server arrived. '''
+        return time.time() - self.state['time']
+
+
+    def fallback(self):
+        ''' Return the last reply with its throttle decaying when it's stale. '''
+        state = self.state
+        answer = (state['angle'], state['throttle'], state['drive_mode'])
+        return decay_answer(answer, time.time() - state['time'], self.decay_after, self.stop_after)
+
+
+    def decide_threaded(self, img_arr, angle, throttle, milliseconds):
+        '''
+        Send the frame if fewer than max_in_flight frames are waiting for 
+        replies and return the last reply from the server, slowing down 
+        when it's stale.
+        '''
+        with self.lock:
+            self.expire_sent()
+            send = self.conn is not None and len(self.sent) < self.max_in_flight
+            if send:
+                self.seq += 1
+                seq = self.seq
+                self.sent[seq] = time.time()
+
+        if send:
+            msg = pack_frame(seq, angle, throttle, milliseconds, 
+                             dk.utils.arr_to_binary(img_arr))
+            self.ioloop.add_callback(self.send, msg)
+
+        return self.fallback()
 
 
 
 
 class DonkeyPilotApplication(tornado.web.Application):
 
-    def __init__(self, mydonkey_path='~/mydonkey/'):
+    def __init__(self, mydonkey_path='~/mydonkey/', session_queue_size=100,
+                 session_queue_policy='drop', pilot_batch_size=16, pilot_batch_wait=.005,
+                 control_executor='thread', control_workers=4, control_max_pending=8,
+                 thumbnail_size=(80, 60), thumbnail_cache_size=64*1024*1024, thumbnail_workers=4):
         ''' 
         Create and publish variables needed on many of 
         the web handlers.
+
+        Recorded frames are saved by a background writer per vehicle. 
+        session_queue_policy decides if frames are dropped ('drop') or the 
+        request waits ('block') when session_queue_size frames are waiting.
+
+        Pilots are shared by the vehicles using them. Frames from different 
+        vehicles are decided together in batches of up to pilot_batch_size 
+        frames collected for at most pilot_batch_wait seconds.
+
+        Control requests decode images in a pool of control_workers threads 
+        or processes (control_executor) and run pilots in threads so the IO 
+        loop stays free. When control_max_pending requests are already 
+        being worked on, new ones get the vehicle's last pilot values.
+
+        Session pages show thumbnails of thumbnail_size made by 
+        thumbnail_workers threads and cached on disk up to 
+        thumbnail_cache_size bytes.
         '''
 
         print('Starting Donkey Server...')
@@ -173,6 +451,21 @@ class DonkeyPilotApplication(tornado.web.Application):
 
 
         self.vehicles = {}
+        self.session_queue_size = session_queue_size
+        self.session_queue_policy = session_queue_policy
+
+        if control_executor == 'process':
+            self.decode_executor = ProcessPoolExecutor(control_workers)
+        elif control_executor == 'thread':
+            self.decode_executor = ThreadPoolExecutor(control_workers)
+        else:
+            raise ValueError('Unknown control executor: %s' %control_executor)
+        self.decide_executor = ThreadPoolExecutor(control_workers)
+        self.control_max_pending = control_max_pending
+        self.control_pending = 0
+        self.control_skipped = 0
+        self.control_latency = {k: dk.utils.LatencyStats() 
+                                for k in ('queue', 'decode', 'inference', 'total')}
 
         this_dir = os.path.dirname(os.path.realpath(__file__))
         self.static_file_path = os.path.join(this_dir, 'templates', 'static')
@@ -180,9 +473,13 @@ class DonkeyPilotApplication(tornado.web.Application):
         self.mydonkey_path = os.path.expanduser(mydonkey_path)
         self.sessions_path = os.path.join(self.mydonkey_path, 'sessions')
         self.models_path = os.path.join(self.mydonkey_path, 'models')
+        self.thumbnails = dk.sessions.ThumbnailCache(
+            os.path.join(self.mydonkey_path, 'cache', 'thumbnails'),
+            size=thumbnail_size, max_bytes=thumbnail_cache_size, workers=thumbnail_workers)
 
         ph = dk.pilots.PilotHandler(self.models_path)
-        self.pilots = ph.default_pilots()
+        self.pilots = [dk.pilots.BatchingPilot(p, max_batch=pilot_batch_size, max_wait=pilot_batch_wait)
+                       for p in ph.default_pilots()]
 
 
         handlers = [
@@ -210,19 +507,30 @@ class DonkeyPilotApplication(tornado.web.Application):
             (r"/api/vehicles/control/?(?P<vehicle_id>[A-Za-z0-9-]+)?/", 
                 ControlAPI),
 
+            (r"/api/vehicles/ws/?(?P<vehicle_id>[A-Za-z0-9-]+)?/", 
+                ControlSocket),
+
+            (r"/api/control/stats/", ControlStatsAPI),
+
 
             (r"/sessions/", SessionListView),
-            (r"/sessions/?(?P<session_id>[^/]+)?/?(?P<page>[^/]+)?/download", SessionDownload),
+            (r"/sessions/?(?P<session_id>[^/]+)?/?(?P<page>[^/]+)?/download", 
+                SessionDownload, {"path": self.sessions_path}),
 
             (r"/sessions/?(?P<session_id>[^/]+)?/?(?P<page>[^/]+)?", 
                 SessionView),
 
+            (r"/session_image/?(?P<session_id>[^/]+)?/?(?P<img_name>[^/]+)?/thumb", 
+                SessionThumbView
+            ),
+
             (r"/session_image/?(?P<session_id>[^/]+)?/?(?P<img_name>[^/]+)?", 
-                SessionImageView
+                SessionImageView, {"path": self.sessions_path}
             ),
 
 
             (r"/pilots/", PilotListView),
+            (r"/api/pilots/stats/", PilotStatsAPI),
 
 
 
@@ -239,7 +547,77 @@ class DonkeyPilotApplication(tornado.web.Application):
         print(port)
         self.port = int(port)
         self.listen(self.port)
-        tornado.ioloop.IOLoop.instance().start()
+        try:
+            tornado.ioloop.IOLoop.instance().start()
+        finally:
+            self.close_sessions()
+
+
+    def close_sessions(self):
+        ''' Save the frames still waiting to be written to the sessions. '''
+        for V in self.vehicles.values():
+            V['session'].close()
+
+
+    @tornado.gen.coroutine
+    def control(self, V, img_bytes):
+        '''
+        Decide the angle and throttle a vehicle should use given the 
+        jpeg it sent. Depending on the drive mode the values can come 
+        from the user or an autopilot.
+        '''
+        start = time.time()
+        V['video'].publish(img_bytes)
+
+        if self.control_pending >= self.control_max_pending:
+            #the workers are saturated, reuse the last pilot values
+            #instead of queueing more work.
+            self.control_skipped += 1
+        else:
+            self.control_pending += 1
+            try:
+                img_arr, decode_start, decode_end = yield self.decode_executor.submit(decode_img, img_bytes)
+
+                #Get angle/throttle from pilot loaded by the server.
+                if isinstance(V['pilot'], dk.pilots.BatchingPilot):
+                    #wait for the batch with this frame.
+                    pilot_angle, pilot_throttle = yield V['pilot'].submit(img_arr)
+                elif V['pilot'] is not None:
+                    pilot_angle, pilot_throttle = yield self.decide_executor.submit(V['pilot'].decide, img_arr)
+                else: 
+                    print('no pilot')
+                    pilot_angle, pilot_throttle = 0.0, 0.0
+            finally:
+                self.control_pending -= 1
+
+            end = time.time()
+            self.control_latency['queue'].record(decode_start - start)
+            self.control_latency['decode'].record(decode_end - decode_start)
+            self.control_latency['inference'].record(end - decode_end)
+            self.control_latency['total'].record(end - start)
+
+            V['pilot_angle'] = pilot_angle
+            V['pilot_throttle'] = pilot_throttle
+
+        #depending on the drive mode, return user or pilot values
+
+        angle, throttle  = V['user_angle'], V['user_throttle']
+        if V['drive_mode'] == 'auto_angle':
+            angle, throttle  = V['pilot_angle'], V['user_throttle']
+        elif V['drive_mode'] == 'auto':
+            angle, throttle  = V['pilot_angle'], V['pilot_throttle']
+
+        print('\r REMOTE: angle: {:+04.2f}   throttle: {:+04.2f}   drive_mode: {}'.format(angle, throttle, V['drive_mode']), end='')
+
+
+        if V['recording'] == True:
+            #queue the jpeg as it was received to be saved with the angle/throttle values
+            V['session'].put(img_bytes, 
+                             angle=angle,
+                             throttle=throttle, 
+                             milliseconds=0.0)
+
+        return angle, throttle
 
 
     def get_vehicle(self, vehicle_id):
@@ -254,9 +632,14 @@ class DonkeyPilotApplication(tornado.web.Application):
                         'user_throttle': 0,  
                         'drive_mode':'user', 
                         'milliseconds': 0,
+                        'pilot_angle': 0.0,
+                        'pilot_throttle': 0.0,
                         'recording': False,
                         'pilot': dk.pilots.BasePilot(),
-                        'session': sh.new()})
+                        'video': FrameBroadcaster(),
+                        'session': dk.sessions.SessionWriter(sh.new(),
+                                            max_queue=self.session_queue_size,
+                                            policy=self.session_queue_policy)})
 
         #eprint(self.vehicles)
         return self.vehicles[vehicle_id]
@@ -350,6 +733,7 @@ class DriveAPI(tornado.web.RequestHandler):
 
 class ControlAPI(tornado.web.RequestHandler):
 
+    @tornado.gen.coroutine
     def post(self, vehicle_id):
         '''
         Receive post requests from a vehicle and returns 
@@ -359,76 +743,147 @@ class ControlAPI(tornado.web.RequestHandler):
         '''    
 
         V = self.application.get_vehicle(vehicle_id)
+        img_bytes = self.request.files['img'][0]['body']
 
-        img = self.request.files['img'][0]['body']
-        img = Image.open(io.BytesIO(img))
-        img_arr = dk.utils.img_to_arr(img)
+        angle, throttle = yield self.application.control(V, img_bytes)
 
+        #retun angel/throttle values to vehicle with json response
+        self.write(json.dumps({'angle': str(angle), 'throttle': str(throttle), 'drive_mode': str(V['drive_mode']) }))
 
-        #Get angle/throttle from pilot loaded by the server.
-        if V['pilot'] is not None:
-            pilot_angle, pilot_throttle = V['pilot'].decide(img_arr)
-        else: 
-            print('no pilot')
-            pilot_angle, pilot_throttle = 0.0, 0.0
 
-        V['img'] = img
-        V['pilot_angle'] = pilot_angle
-        V['pilot_throttle'] = pilot_throttle
 
-        #depending on the drive mode, return user or pilot values
+class ControlSocket(tornado.websocket.WebSocketHandler):
+    '''
+    Persistent binary control channel for a vehicle. Each message is a 
+    frame packed by pack_frame, answered with a reply packed by 
+    pack_reply carrying the same sequence number.
+    '''
 
-        angle, throttle  = V['user_angle'], V['user_throttle']
-        if V['drive_mode'] == 'auto_angle':
-            angle, throttle  = V['pilot_angle'], V['user_throttle']
-        elif V['drive_mode'] == 'auto':
-            angle, throttle  = V['pilot_angle'], V['pilot_throttle']
+    def open(self, vehicle_id):
+        self.vehicle_id = vehicle_id
 
-        print('\r REMOTE: angle: {:+04.2f}   throttle: {:+04.2f}   drive_mode: {}'.format(angle, throttle, V['drive_mode']), end='')
 
+    @tornado.gen.coroutine
+    def on_message(self, msg):
+        #every frame gets a reply so the vehicle doesn't wait for it, 
+        #frames that can't be decided are answered with a stop.
+        seq = 0
+        try:
+            seq, _, _, _, img_bytes = unpack_frame(msg)
+            V = self.application.get_vehicle(self.vehicle_id)
+            angle, throttle = yield self.application.control(V, img_bytes)
+            drive_mode = V['drive_mode']
+        except Exception as err:
+            print('\n Could not decide frame %s: %s' %(seq, err))
+            angle, throttle, drive_mode = 0.0, 0.0, 'user'
+
+        try:
+            self.write_message(pack_reply(seq, angle, throttle, drive_mode), binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+
+
+def decode_img(img_bytes):
+    '''
+    Decode a jpeg into an array. Runs in the control executor and 
+    returns when it started and finished to measure queueing.
+    '''
+    start = time.time()
+    img = Image.open(io.BytesIO(img_bytes))
+    img_arr = dk.utils.img_to_arr(img)
+    return img_arr, start, time.time()
 
-        if V['recording'] == True:
-            #save image with encoded angle/throttle values
-            V['session'].put(img, 
-                             angle=angle,
-                             throttle=throttle, 
-                             milliseconds=0.0)
 
-        #retun angel/throttle values to vehicle with json response
-        self.write(json.dumps({'angle': str(angle), 'throttle': str(throttle), 'drive_mode': str(V['drive_mode']) }))
+
+class ControlStatsAPI(tornado.web.RequestHandler):
+    def get(self):
+        '''
+        Return how long control requests spend queued, decoding and 
+        deciding in milliseconds and how many were answered with the 
+        last values because the workers were saturated.
+        '''
+        app = self.application
+        stats = {k: v.percentiles() for k, v in app.control_latency.items()}
+        stats['pending'] = app.control_pending
+        stats['skipped'] = app.control_skipped
+        self.write(json.dumps(stats))
+
+
+
+class FrameBroadcaster():
+    '''
+    Holds the last jpeg a vehicle sent, as it was received, and a version 
+    number counting the frames. Video viewers wait for a newer version 
+    instead of polling and all write the same bytes. A viewer that is 
+    slower than the vehicle gets the newest frame when it's ready again 
+    and skips the ones in between.
+    '''
+
+    def __init__(self):
+        self.jpeg = None
+        self.version = 0
+        self.condition = tornado.locks.Condition()
+
+    def publish(self, jpeg):
+        ''' Replace the frame and wake the viewers. Call on the IO loop. '''
+        self.jpeg = jpeg
+        self.version += 1
+        self.condition.notify_all()
+
+    @tornado.gen.coroutine
+    def wait(self, version, timeout=None):
+        ''' 
+        Return the version and jpeg of the first frame newer than version
+        or None when there's none after timeout seconds.
+        '''
+        if timeout is not None:
+            timeout = timedelta(seconds=timeout)
+        while self.version <= version:
+            notified = yield self.condition.wait(timeout)
+            if not notified:
+                return None
+        return self.version, self.jpeg
 
 
 
 class VideoAPI(tornado.web.RequestHandler):
     '''
-    Serves a MJPEG of the images posted from the vehicle. 
+    Serves a MJPEG of the images posted from the vehicle. Viewers check 
+    every wait_timeout seconds if they are still connected while the 
+    vehicle sends no frames.
     '''
-    @tornado.web.asynchronous
+    wait_timeout = 1.0
+
     @tornado.gen.coroutine
     def get(self, vehicle_id):
 
-        ioloop = tornado.ioloop.IOLoop.current()
+        V = self.application.vehicles.get(vehicle_id)
+        if V is None:
+            raise tornado.web.HTTPError(404)
+        video = V['video']
         self.set_header("Content-type", "multipart/x-mixed-replace;boundary=--boundarydonotcross")
 
-        self.served_image_timestamp = time.time()
         my_boundary = "--boundarydonotcross"
-        while True:
-            
-            interval = .2
-            if self.served_image_timestamp + interval < time.time():
-
-
-                img = self.application.vehicles[vehicle_id]['img']
-                img = dk.utils.img_to_binary(img)
-
-                self.write(my_boundary)
-                self.write("Content-type: image/jpeg\r\n")
-                self.write("Content-length: %s\r\n\r\n" % len(img)) 
-                self.write(img)
-                self.served_image_timestamp = time.time()
-                yield tornado.gen.Task(self.flush)
-            else:
-                yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + interval)
+        version = 0
+        self.closed = False
+        while not self.closed:
+            frame = yield video.wait(version, timeout=self.wait_timeout)
+            if frame is None:
+                continue
+            version, img = frame
+
+            self.write(my_boundary)
+            self.write("Content-type: image/jpeg\r\n")
+            self.write("Content-length: %s\r\n\r\n" % len(img)) 
+            self.write(img)
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+
+    def on_connection_close(self):
+        self.closed = True
 
 
 #####################
@@ -451,6 +906,17 @@ class PilotListView(tornado.web.RequestHandler):
 
 
 
+class PilotStatsAPI(tornado.web.RequestHandler):
+    def get(self):
+        '''
+        Return the batch sizes and queue waits of the shared pilots.
+        '''
+        stats = {p.name: p.stats() for p in self.application.pilots}
+        self.write(json.dumps(stats))
+
+
+
+
 #####################
 #                   #
 #     sessions      #
@@ -459,21 +925,55 @@ class PilotListView(tornado.web.RequestHandler):
 
 
 
-class SessionImageView(tornado.web.RequestHandler):
+class SessionImageView(tornado.web.StaticFileHandler):
+    '''
+    Returns the jpg images of a session as they were saved. Images saved 
+    as files are streamed from disk, images in session logs are read from 
+    their chunk. Both get ETag and Last-Modified headers so browsers only 
+    download them once.
+    '''
+
+    @tornado.gen.coroutine
     def get(self, session_id, img_name):
-        ''' Returns jpg images from a session folder '''
+        rel_path = os.path.join(session_id, img_name)
+        path = os.path.join(self.application.sessions_path, rel_path)
+        if os.path.isfile(path):
+            yield super().get(rel_path)
+            return
 
-        sessions_path = self.application.sessions_path
-        path = os.path.join(sessions_path, session_id, img_name)
-        f = Image.open(path)
-        o = io.BytesIO()
-        f.save(o, format="JPEG")
-        s = o.getvalue()
-
-        self.set_header('Content-type', 'image/jpg')
-        self.set_header('Content-length', len(s))   
-        
-        self.write(s)   
+        try:
+            version, mtime = dk.sessions.img_version(path)
+        except (KeyError, IOError):
+            raise tornado.web.HTTPError(404)
+        send_img(self, dk.sessions.load_img_bytes(path), version, mtime)
+
+
+class SessionThumbView(tornado.web.RequestHandler):
+    ''' Returns a cached thumbnail of a session image. '''
+
+    @tornado.gen.coroutine
+    def get(self, session_id, img_name):
+        path = os.path.join(self.application.sessions_path, session_id, img_name)
+        try:
+            data, key, mtime = yield self.application.thumbnails.submit(path)
+        except (KeyError, IOError):
+            raise tornado.web.HTTPError(404)
+        send_img(self, data, key, mtime)
+
+
+def send_img(handler, data, version, mtime):
+    '''
+    Write jpg bytes to a request or Not Modified when the client 
+    already has this version.
+    '''
+    handler.set_header('Content-Type', 'image/jpeg')
+    handler.set_header('Cache-Control', 'no-cache')
+    handler.set_header('Last-Modified', datetime.utcfromtimestamp(int(mtime)))
+    handler.set_header('Etag', '"%s"' % version)
+    if handler.check_etag_header():
+        handler.set_status(304)
+        return
+    handler.write(data)
 
 
 
@@ -497,12 +997,9 @@ class SessionView(tornado.web.RequestHandler):
         '''
         Shows all the images saved in the session. 
         '''    
-        from operator import itemgetter
-
-        sessions_path = self.application.sessions_path
-        path = os.path.join(sessions_path, session_id)
-        imgs = [dk.utils.merge_two_dicts({'name':f.name}, dk.sessions.parse_img_filepath(f.path)) for f in os.scandir(path) if f.is_file() ]
-        img_count = len(imgs)
+        sh = dk.sessions.SessionHandler(self.application.sessions_path)
+        s = sh.load(session_id)
+        img_count = s.img_count()
 
         perpage = 500
         pages = math.ceil(img_count/perpage)
@@ -515,9 +1012,11 @@ class SessionView(tornado.web.RequestHandler):
         end = min(end, img_count)
 
 
-        sorted_imgs = sorted(imgs, key=itemgetter('name')) 
         page_list = [p+1 for p in range(pages)]
-        session = {'name':session_id, 'imgs': sorted_imgs[start:end]}
+        session = {'name':session_id, 'imgs': s.page(start, end)}
+        #start making the thumbnails before the browser asks for them.
+        self.application.thumbnails.build(
+            [os.path.join(s.session_dir, img['name']) for img in session['imgs']])
         data = {'session': session, 'page_list': page_list, 'this_page':page}
         self.render("templates/session.html", **data)
 
@@ -534,36 +1033,88 @@ class SessionView(tornado.web.RequestHandler):
             sessions_path = self.application.sessions_path
             path = os.path.join(sessions_path, session_id)
 
-            for i in data['imgs']:
-                os.remove(os.path.join(path, i))
-                #print('%s removed' %i)
+            dk.sessions.delete_imgs(path, data['imgs'])
 
-#@tornado.gen.coroutine
-class SessionDownload(tornado.web.RequestHandler):
+class SessionDownload(tornado.web.StaticFileHandler):
+    '''
+    Sends a zip of a session. The archive is streamed while it's being 
+    made and saved next to the session as a cache. A cached archive newer 
+    than every file of the session is served as a static file so range 
+    requests can resume interrupted downloads.
+
+    Images are already compressed so they are stored in the archive 
+    without compressing them again.
+    '''
 
+    STORED_EXTENSIONS = ('.jpg', '.dat')
+    BLOCK_SIZE = 256 * 1024
+
+    @tornado.gen.coroutine
     def get(self, session_id, page):
         sessions_path = self.application.sessions_path
         session_path = os.path.join(sessions_path, session_id)
-        
-        zip_path = os.path.join(sessions_path, session_id + '.zip')
-        dk.utils.zip_dir(session_path, zip_path)
-                
-        self.set_header('Content-Type', 'application/force-download')
-        self.set_header('Content-Disposition', 'attachment; filename=%s' % session_id+ ".zip")    
-        with open(zip_path, "rb") as f:
-            #try:
-            while True:
-                _buffer = f.read(4096)
-                if _buffer:
-                    self.write(_buffer)
-                else:
-                    f.close()
-                    self.finish()
-                    return
-            #except:
-            #    raise HTTPError(404)
-        raise HTTPError(500)
+        zip_name = session_id + '.zip'
+        zip_path = os.path.join(sessions_path, zip_name)
 
+        files = sorted(f.path for f in os.scandir(session_path) if f.is_file())
 
+        if os.path.exists(zip_path) and \
+                os.path.getmtime(zip_path) >= dk.sessions.last_modified(session_path):
+            yield super().get(zip_name)
+            return
 
+        self.set_header('Content-Type', 'application/force-download')
+        self.set_header('Content-Disposition', 'attachment; filename=%s' % zip_name)
+
+        self.client_closed = False
+        part_path = '%s.%s.part' %(zip_path, id(self))
+        try:
+            with open(part_path, 'wb') as cache:
+                stream = dk.utils.ZipStream(cache=cache)
+                zf = zipfile.ZipFile(stream, 'w', allowZip64=True)
+                for p in files:
+                    zinfo = zipfile.ZipInfo.from_file(p, arcname=os.path.join(session_id, os.path.basename(p)))
+                    if p.endswith(self.STORED_EXTENSIONS):
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                    else:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+                    with open(p, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                        while True:
+                            block = src.read(self.BLOCK_SIZE)
+                            if not block:
+                                break
+                            dst.write(block)
+                            yield self.send(stream.pop())
+                zf.close()
+                yield self.send(stream.pop())
+
+            #the cache is finished even if the client left so it can resume.
+            os.replace(part_path, zip_path)
+        finally:
+            #a failed archive doesn't leave its part behind.
+            if os.path.exists(part_path):
+                os.remove(part_path)
 
+
+    @tornado.gen.coroutine
+    def send(self, data):
+        ''' Write and wait until the client took the data. '''
+        if self.client_closed or not data:
+            return
+        self.write(data)
+        try:
+            yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            self.client_closed = True
+
+
+    def set_extra_headers(self, path):
+        self.set_header('Content-Disposition', 'attachment; filename=%s' % os.path.basename(path))
+
+
+    def compute_etag(self):
+        #streamed archives don't have an etag yet.
+        if getattr(self, 'absolute_path', None) is None:
+            return None
+        return super().compute_etag()
@@ -2,7 +2,8 @@
 import io
 import os
 import time
-from threading import Thread
+import hashlib
+from threading import Thread, Condition
 from itertools import cycle
 
 import numpy as np
@@ -13,10 +14,17 @@ from donkey import utils
 
  
 class BaseCamera:
+    '''
+    Cameras keep their latest frame with the time it was captured and 
+    its sequence number, counting from 1. read() returns the three of them.
+    '''
+
+    seq = 0
+    latest = (None, 0.0, 0)
 
     def __init__(self, resolution=(160, 120)):
         self.resolution = resolution
-        self.frame = np.zeros(shape=(self.resolution[1], self.resolution[0], 3))
+        self.publish(np.zeros(shape=(self.resolution[1], self.resolution[0], 3)))
         
     def start(self):
         # start the thread to read frames from the video stream
@@ -30,11 +38,17 @@ class BaseCamera:
         while True:
             pass
 
+    def publish(self, frame):
+        ''' Make frame the latest frame. '''
+        self.seq += 1
+        self.latest = (frame, time.time(), self.seq)
+
     def read(self):
-        return self.frame
+        ''' Return the latest frame, its timestamp and sequence number. '''
+        return self.latest
 
     def capture_arr(self):
-        return self.read()
+        return self.read()[0]
 
     def capture_img(self):
         arr = self.capture_arr()
@@ -49,22 +63,100 @@ class BaseCamera:
 
 
 
+class FrameRing:
+    '''
+    Preallocated buffers for the last frames of a camera. The camera 
+    writes the next frame straight into a free slot, using this as the 
+    output of picamera's capture_continuous, and publish() makes it the 
+    latest frame by replacing one tuple so the camera never waits for 
+    readers.
+
+    read() copies the latest frame out of its slot and returns it with its 
+    timestamp and sequence number. A slot is written again after slots - 1 
+    more frames, so read() copies again when that happened during the copy.
+
+    picamera pads the rows of raw frames to a multiple of 16 or 32 pixels, 
+    depending on its version, and the frames to a multiple of 16 rows. The 
+    slots have room for the largest padding and the row stride of each 
+    frame is worked out from the bytes written for it.
+    '''
+
+    def __init__(self, resolution=(160, 120), slots=4, channels=3):
+        if slots < 2:
+            raise ValueError('A FrameRing needs at least 2 slots.')
+        width, height = resolution
+        self.shape = (height, width, channels)
+        self.rows = -(-height // 16) * 16
+        self.flat = np.zeros((slots, self.rows * -(-width // 32) * 32 * channels), dtype=np.uint8)
+
+        self.slot = 0
+        self.offset = 0
+        self.seq = 0
+        self.latest = (self.frame(slots - 1, height * width * channels), 0.0, 0)
+
+    def frame(self, slot, size):
+        ''' Return the view of the frame of size bytes written to a slot. '''
+        height, width, channels = self.shape
+        #frames are either unpadded or padded to a multiple of 16 rows.
+        rows = height if size == height * width * channels else self.rows
+        stride = size // rows
+        if stride < width * channels:
+            raise ValueError('A frame of %s bytes is too small for %sx%s pixels.' % (size, width, height))
+        rows = self.flat[slot, :rows * stride].reshape(rows, stride)
+        return rows[:height, :width * channels].reshape(self.shape)
+
+    def write(self, buf):
+        ''' Copy bytes of the frame being captured into the free slot. '''
+        data = np.frombuffer(buf, dtype=np.uint8)
+        end = min(self.offset + len(data), self.flat.shape[1])
+        self.flat[self.slot, self.offset:end] = data[:end - self.offset]
+        self.offset = end
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def put(self, arr):
+        ''' Copy a whole frame into the free slot and publish it. '''
+        self.offset = int(np.prod(self.shape))
+        self.frame(self.slot, self.offset)[:] = arr
+        self.publish()
+
+    def publish(self, timestamp=None):
+        ''' Make the frame written to the free slot the latest one. '''
+        frame = self.frame(self.slot, self.offset)
+        self.seq += 1
+        self.latest = (frame, timestamp or time.time(), self.seq)
+        self.slot = (self.slot + 1) % len(self.flat)
+        self.offset = 0
+
+    def read(self, out=None):
+        '''
+        Return a copy of the latest frame, its timestamp and sequence number. 
+        The frame is copied into out when it's given.
+        '''
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+        while True:
+            frame, timestamp, seq = self.latest
+            out[:] = frame
+            if self.seq - seq < len(self.flat) - 1:
+                return out, timestamp, seq
+
+
 class PiVideoStream(BaseCamera):
-    def __init__(self, resolution=(160, 120), framerate=20):
-        from picamera.array import PiRGBArray
+    def __init__(self, resolution=(160, 120), framerate=20, slots=4):
         from picamera import PiCamera
 
         # initialize the camera and stream
         self.camera = PiCamera()
         self.camera.resolution = resolution
         self.camera.framerate = framerate
-        self.rawCapture = PiRGBArray(self.camera, size=resolution)
-        self.stream = self.camera.capture_continuous(self.rawCapture,
+        self.ring = FrameRing(resolution, slots=slots)
+        self.stream = self.camera.capture_continuous(self.ring,
             format="rgb", use_video_port=True)
  
-        # initialize the frame and the variable used to indicate
         # if the thread should be stopped
-        self.frame = None
         self.stopped = False
         
         print('PiVideoStream loaded.. .warming camera')
@@ -77,20 +169,22 @@ class PiVideoStream(BaseCamera):
     def update(self):
         # keep looping infinitely until the thread is stopped
         for f in self.stream:
-            # grab the frame from the stream and clear the stream in
-            # preparation for the next frame
-            self.frame = f.array
-            self.rawCapture.truncate(0)
+            # the frame was written to a slot of the ring, publish it
+            self.ring.publish()
  
             # if the thread indicator variable is set, stop the thread
             # and resource camera resources
             if self.stopped:
                 self.stream.close()
-                self.rawCapture.close()
                 self.camera.close()
                 return
 
 
+    def read(self):
+        ''' Return the latest frame, its timestamp and sequence number. '''
+        return self.ring.read()
+
+
     def stop(self):
         # indicate that the thread should be stopped
         self.stopped = True
@@ -103,7 +197,7 @@ class ImgArrayCamera(BaseCamera):
 
     def __init__(self, X):
         self.X = X
-        self.frame = X[0]
+        self.publish(X[0])
         self.start()
 
 
@@ -117,7 +211,7 @@ class ImgArrayCamera(BaseCamera):
         for x in self.generator():
             # grab the frame from the stream and clear the stream in
             # preparation for the next frame
-            self.frame = x
+            self.publish(x)
             time.sleep(.2) 
 
 
@@ -136,8 +230,6 @@ class FakeCamera(BaseCamera):
         self.file_cycle = cycle(self.file_list) #create infinite iterator
         self.counter = 0
 
-        # if the thread should be stopped
-        self.frame = None
         self.start()
 
 
@@ -146,9 +238,132 @@ class FakeCamera(BaseCamera):
         for f in self.file_cycle:
             # grab the frame from the stream and clear the stream in
             # preparation for the next frame
-            self.frame = np.array(Image.open(f))
+            self.publish(np.array(Image.open(f)))
             self.counter += 1
             time.sleep(.2) 
 
 
 
+class ReplayCamera(BaseCamera):
+    '''
+    Plays the frames of a recorded session like a camera. Used to load 
+    test the server and pilots with real images.
+
+    The session is decoded once into a uint8 .npy file in cache_dir that 
+    is memory mapped, so replays don't decode images and several cameras 
+    share the same pages. The file is named after the session and a hash 
+    of its full path, and is made again when the session changes.
+
+    Frames are played at the times they were recorded divided by speed 
+    or, when the session has no times, at fps frames per second. 
+    speed=None plays them as fast as possible.
+
+    read() returns the frame, the time it was played and its sequence 
+    number like the other cameras. stats() reports the effective fps and 
+    how many frames were played without being read.
+    '''
+
+    def __init__(self, session_path, speed=1.0, fps=20, loop=True,
+                 cache_dir='~/mydonkey/cache/replay'):
+        from donkey import sessions
+
+        self.session_path = os.path.expanduser(session_path)
+        self.speed = speed
+        self.loop = loop
+
+        cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        #sessions in different folders can have the same name.
+        folder = os.path.realpath(self.session_path)
+        digest = hashlib.sha1(folder.encode('utf8')).hexdigest()[:12]
+        self.cache_path = os.path.join(cache_dir, '%s_%s.npy' % (os.path.basename(folder), digest))
+
+        paths = sessions.img_paths(self.session_path)
+        if not paths:
+            raise ValueError('Session %s has no images to replay.' % self.session_path)
+        self.frames = self.load_cache(paths, sessions)
+
+        ms = np.array([sessions.parse_img_filepath(p)['milliseconds'] for p in paths], dtype=np.float64)
+        if len(ms) > 1 and ms[-1] > ms[0] and (np.diff(ms) >= 0).all():
+            self.offsets = (ms - ms[0]) / 1000
+        else:
+            self.offsets = np.arange(len(paths)) / fps
+
+        self.new_frame = Condition()
+        self.latest = (self.frames[0], time.time(), 0)
+        self.played = 0
+        self.last_read = 0
+        self.skipped = 0
+        self.loops = 0
+        self.started = time.time()
+        self.stopped = False
+        self.start()
+
+
+    def load_cache(self, paths, sessions):
+        ''' Return the memory mapped frames, decoding them if needed. '''
+        if os.path.exists(self.cache_path) and \
+                os.path.getmtime(self.cache_path) >= sessions.last_modified(self.session_path):
+            frames = np.load(self.cache_path, mmap_mode='r')
+            if len(frames) == len(paths):
+                return frames
+
+        print('Decoding %s frames of %s' % (len(paths), self.session_path))
+        first = np.array(sessions.load_img(paths[0]))
+        tmp_path = '%s.%s.tmp' % (self.cache_path, os.getpid())
+        frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(paths),) + first.shape)
+        for i, p in enumerate(paths):
+            with sessions.load_img(p) as img:
+                frames[i] = np.asarray(img)
+        frames.flush()
+        del frames
+        os.replace(tmp_path, self.cache_path)
+        return np.load(self.cache_path, mmap_mode='r')
+
+
+    def update(self):
+        while not self.stopped:
+            start = time.time()
+            for i in range(len(self.frames)):
+                if self.stopped:
+                    return
+                if self.speed:
+                    delay = start + self.offsets[i] / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.played += 1
+                with self.new_frame:
+                    self.latest = (self.frames[i], time.time(), self.played)
+                    self.new_frame.notify_all()
+            self.loops += 1
+            if not self.loop:
+                return
+
+
+    def read(self):
+        ''' Return the latest frame, its timestamp and sequence number. '''
+        latest = self.latest
+        seq = latest[2]
+        if seq > self.last_read:
+            self.skipped += seq - self.last_read - 1
+            self.last_read = seq
+        return latest
+
+    def wait(self, last_seq=0, timeout=None):
+        ''' Block until a frame newer than last_seq is played and read it. '''
+        with self.new_frame:
+            self.new_frame.wait_for(lambda: self.latest[2] > last_seq, timeout)
+        return self.read()
+
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {'frames': self.played,
+                'fps': self.played / elapsed if elapsed else 0.0,
+                'skipped': self.skipped,
+                'loops': self.loops}
+
+
+    def stop(self):
+        self.stopped = True
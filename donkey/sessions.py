@@ -9,8 +9,15 @@ something like ROSBAGS.
 '''
 
 import os
+import io
 import time
 import itertools
+import threading
+import queue
+import collections
+import multiprocessing
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
 from PIL import Image
@@ -26,19 +33,43 @@ class Session():
     as arrays or generators.
     '''
 
-    def __init__(self, path):
+    def __init__(self, path, backend=None):
         print('Loading Session: %s' %path)
         self.session_dir = path
         self.frame_count = 0
 
+        if backend is None:
+            backend = detect_backend(path)
+        self.backend = backend
+
+        self.log = None
+        if self.backend == LOG_BACKEND:
+            self.log = open_log(path)
+            self.frame_count = self.log.last_frame()
+
     def put(self, img, angle=None, throttle=None, milliseconds=None):
         
         ''' 
-        Save image with encoded angle, throttle and time data in the filename
+        Save an image with its angle, throttle and time data. Log sessions 
+        append the frame to a chunk file, jpeg sessions encode the data 
+        in the filename.
+
+        img can be a PIL image or the bytes of an already encoded jpeg, 
+        which are saved without being encoded again.
         '''
         self.frame_count += 1
-        filepath = create_img_filepath(self.session_dir, self.frame_count, angle, throttle, milliseconds)
-        img.save(filepath, 'jpeg')
+        if isinstance(img, bytes):
+            img_bytes = img
+        else:
+            img_bytes = dk.utils.img_to_binary(img)
+
+        if self.log is not None:
+            self.log.append(img_bytes, self.frame_count,
+                            angle, throttle, milliseconds)
+        else:
+            filepath = create_img_filepath(self.session_dir, self.frame_count, angle, throttle, milliseconds)
+            self.index().put(filepath, img_bytes, self.frame_count, 
+                             angle, throttle, milliseconds)
 
 
     def get(self, file_path):
@@ -58,7 +89,23 @@ class Session():
 
 
     def img_count(self):
-        return len(self.img_paths())
+        return self.index().count()
+
+
+    def index(self):
+        ''' Return the persistent index of the frames in the session. '''
+        #the backend is known, the folder isn't scanned to find it again.
+        if self.log is not None:
+            return self.log
+        return open_jpeg_index(self.session_dir)
+
+
+    def page(self, start, stop):
+        '''
+        Return the name and telemetry of frames start:stop without 
+        reading the rest of the index.
+        '''
+        return self.index().page(start, stop)
 
 
     def load_dataset(self, angle_only=True):
@@ -78,6 +125,101 @@ class Session():
 
 
 
+class SessionWriter():
+    '''
+    Saves frames to a session from a background thread so callers, like 
+    the web server's request handlers, don't wait on disk I/O.
+
+    Frames wait in a bounded queue. When the queue is full the 'drop' 
+    policy discards the new frame and the 'block' policy waits for space.
+    '''
+
+    def __init__(self, session, max_queue=100, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError('Unknown session writer policy: %s' %policy)
+
+        self.session = session
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __getattr__(self, name):
+        #read everything else (img_paths, session_dir...) from the session
+        if name == 'session':
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
+
+    def put(self, img, angle=None, throttle=None, milliseconds=None):
+        '''
+        Queue a frame to be saved. Returns False if the frame was dropped.
+        '''
+        if self.closed:
+            raise ValueError('Cannot put frames on a closed session writer.')
+
+        item = (img, angle, throttle, milliseconds)
+        try:
+            self.queue.put(item, block=(self.policy == 'block'))
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.queued += 1
+        return True
+
+
+    def update(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.session.put(*item)
+                self.written += 1
+            except Exception as err:
+                print('Session writer could not save frame: %s' %err)
+            finally:
+                self.queue.task_done()
+
+
+    def flush(self):
+        '''
+        Wait until all queued frames have been saved.
+        '''
+        self.queue.join()
+
+
+    def close(self):
+        '''
+        Save the queued frames and stop the writer thread.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.session.log is not None:
+            self.session.log.close()
+
+
+    def stats(self):
+        return {'queued': self.queued,
+                'written': self.written,
+                'dropped': self.dropped,
+                'pending': self.queue.qsize()}
+
+
+
+
 class SessionHandler():
     '''
     Convienience class to create and load sessions.
@@ -112,10 +254,10 @@ class SessionHandler():
         '''
         Return the last created session.
         '''
-        dirs = [ name for name in os.listdir(self.sessions_path) if os.path.isdir(os.path.join(self.sessions_path, name)) ]
+        dirs = [f.name for f in os.scandir(self.sessions_path) if f.is_dir()]
         dirs.sort()
-        path = os.join(self.sessions_path, dirs[-1])
-        session = Seession(path)
+        path = os.path.join(self.sessions_path, dirs[-1])
+        session = Session(path)
         return session
 
 
@@ -141,23 +283,599 @@ class SessionHandler():
 
 
 
+LOG_BACKEND = 'log'
+JPEG_BACKEND = 'jpeg'
+
+LOG_INDEX_NAME = 'index.dat'
+LOG_CHUNK_NAME = 'chunk_%05d.dat'
+
+#one fixed width record per frame, appended to the index file
+LOG_INDEX_DTYPE = np.dtype([('frame', '<u4'),
+                            ('chunk', '<u4'),
+                            ('offset', '<u8'),
+                            ('length', '<u4'),
+                            ('angle', '<f4'),
+                            ('throttle', '<f4'),
+                            ('milliseconds', '<f8')])
+
+
+class SessionLog():
+    '''
+    Append-only storage for a session. Encoded frames are appended to large 
+    chunk files and each frame gets a fixed width record in a small index 
+    file holding its location and telemetry. This avoids creating a file 
+    per frame.
+
+    Frames are addressed with the same file names jpeg sessions use so
+    code that passes image paths around works with both backends.
+    '''
+
+    def __init__(self, path, chunk_size=64*1024*1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.index_path = os.path.join(path, LOG_INDEX_NAME)
+
+        self.lock = threading.RLock()
+        self.index_file = None
+        self.chunk_file = None
+        self.chunk_id = 0
+        self.chunk_offset = 0
+        self.readers = {}
+
+        self._records = np.zeros(0, dtype=LOG_INDEX_DTYPE)
+        self._records_key = None
+        self._positions = {}
+
+
+    def records(self):
+        '''
+        Return the index as a structured array with one row per frame. The 
+        index is only reread from disk when it has grown. 
+        '''
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                return self._records
+            st = os.stat(self.index_path)
+            key = (st.st_ino, st.st_size)
+            if key != self._records_key:
+                count = st.st_size // LOG_INDEX_DTYPE.itemsize
+                self._records = np.fromfile(self.index_path, dtype=LOG_INDEX_DTYPE, count=count)
+                self._records_key = key
+                self._positions = {}
+            return self._records
+
+
+    def last_frame(self):
+        ''' Return the number of the last frame saved in the log. '''
+        count = self.count()
+        if count == 0:
+            return 0
+        return int(read_records(self.index_path, LOG_INDEX_DTYPE, count - 1, count)['frame'][0])
+
+
+    def append(self, img_bytes, frame, angle=None, throttle=None, milliseconds=None):
+        '''
+        Append an encoded image and its telemetry to the log.
+        '''
+        with self.lock:
+            if self.chunk_file is None:
+                self._open_for_append()
+
+            if self.chunk_offset > 0 and self.chunk_offset + len(img_bytes) > self.chunk_size:
+                self.chunk_file.close()
+                self.chunk_id += 1
+                self.chunk_offset = 0
+                self.chunk_file = open(self.chunk_path(self.chunk_id), 'ab')
+
+            self.chunk_file.write(img_bytes)
+            self.chunk_file.flush()
+
+            record = np.zeros(1, dtype=LOG_INDEX_DTYPE)
+            record['frame'] = frame
+            record['chunk'] = self.chunk_id
+            record['offset'] = self.chunk_offset
+            record['length'] = len(img_bytes)
+            record['angle'] = _to_float(angle)
+            record['throttle'] = _to_float(throttle)
+            record['milliseconds'] = _to_float(milliseconds)
+
+            #write the index after the data so readers never see a record
+            #pointing to bytes that aren't on disk yet.
+            self.index_file.write(record.tobytes())
+            self.index_file.flush()
+            self.chunk_offset += len(img_bytes)
+
+
+    def read(self, frame):
+        '''
+        Return the encoded bytes of a frame.
+        '''
+        with self.lock:
+            record = self.record(frame)
+            f = self.readers.get(int(record['chunk']))
+            if f is None:
+                f = open(self.chunk_path(int(record['chunk'])), 'rb')
+                self.readers[int(record['chunk'])] = f
+            f.seek(int(record['offset']))
+            return f.read(int(record['length']))
+
+
+    def record(self, frame):
+        ''' Return the index record of a frame. '''
+        with self.lock:
+            records = self.records()
+            if not self._positions:
+                self._positions = {int(f): i for i, f in enumerate(records['frame'])}
+            if frame not in self._positions:
+                raise KeyError('Frame %s is not in session log %s' %(frame, self.path))
+            return records[self._positions[frame]]
+
+
+    def names(self):
+        ''' Return the file names of the frames in the log. '''
+        return [record_name(r) for r in self.records()]
+
+
+    def count(self):
+        return record_count(self.index_path, LOG_INDEX_DTYPE)
+
+
+    def page(self, start, stop):
+        records = read_records(self.index_path, LOG_INDEX_DTYPE, start, stop)
+        return [record_info(r, record_name(r)) for r in records]
+
+
+    def delete(self, frames):
+        '''
+        Remove frames from the index. The image bytes stay in the chunk 
+        files but can no longer be read through the session.
+        '''
+        with self.lock:
+            records = self.records()
+            keep = records[~np.isin(records['frame'], list(frames))]
+
+            tmp_path = self.index_path + '.tmp'
+            keep.tofile(tmp_path)
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+            os.replace(tmp_path, self.index_path)
+            if self.chunk_file is not None:
+                self.index_file = open(self.index_path, 'ab')
+
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.path, LOG_CHUNK_NAME % chunk_id)
+
+
+    def close(self):
+        with self.lock:
+            for f in [self.chunk_file, self.index_file] + list(self.readers.values()):
+                if f is not None:
+                    f.close()
+            self.chunk_file = None
+            self.index_file = None
+            self.readers = {}
+
+
+    def _open_for_append(self):
+        records = self.records()
+        if len(records) > 0:
+            self.chunk_id = int(records['chunk'].max())
+        path = self.chunk_path(self.chunk_id)
+        self.chunk_offset = os.path.getsize(path) if os.path.exists(path) else 0
+        self.chunk_file = open(path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+
+
+
+JPEG_INDEX_NAME = 'jpeg_index.dat'
+
+JPEG_INDEX_DTYPE = np.dtype([('frame', '<u4'),
+                             ('angle', '<f4'),
+                             ('throttle', '<f4'),
+                             ('milliseconds', '<f8'),
+                             ('name', 'S128')])
+
+
+class JpegIndex():
+    '''
+    Persistent index of the images in a jpeg session, sorted by name, so 
+    counting and paging don't list the folder or parse file names. 
+
+    The index is built the first time it's used and rebuilt when the folder 
+    changed after the index was last written, ie. images were copied in. 
+    Changes within the same mtime tick as the index are found by counting 
+    the images.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, JPEG_INDEX_NAME)
+        self.lock = threading.RLock()
+
+
+    def stale(self):
+        if not os.path.exists(self.index_path):
+            return True
+        folder_mtime = os.stat(self.path).st_mtime_ns
+        index_mtime = os.stat(self.index_path).st_mtime_ns
+        if folder_mtime != index_mtime:
+            return folder_mtime > index_mtime
+        #images copied in during the tick the index was written.
+        images = sum(1 for f in os.scandir(self.path) if f.name.endswith('.jpg'))
+        return images != record_count(self.index_path, JPEG_INDEX_DTYPE)
+
+
+    def build(self):
+        '''
+        Parse the file names of all images in the folder and save the index.
+        '''
+        with self.lock:
+            names = sorted(f.name for f in os.scandir(self.path) if f.name.endswith('.jpg'))
+            records = np.zeros(len(names), dtype=JPEG_INDEX_DTYPE)
+            for i, name in enumerate(names):
+                data = parse_img_filepath(name)
+                records[i] = (frame_number(name), data['angle'], data['throttle'], 
+                              data['milliseconds'], name.encode())
+            self._save(records)
+
+
+    def ensure(self):
+        with self.lock:
+            if self.stale():
+                self.build()
+
+
+    def count(self):
+        self.ensure()
+        return record_count(self.index_path, JPEG_INDEX_DTYPE)
+
+
+    def page(self, start, stop):
+        self.ensure()
+        records = read_records(self.index_path, JPEG_INDEX_DTYPE, start, stop)
+        return [record_info(r, r['name'].decode()) for r in records]
+
+
+    def names(self):
+        self.ensure()
+        records = read_records(self.index_path, JPEG_INDEX_DTYPE)
+        return [n.decode() for n in records['name']]
+
+
+    def put(self, filepath, img_bytes, frame, angle=None, throttle=None, milliseconds=None):
+        '''
+        Save an image to the folder and add it to the index. Stale indexes 
+        are rebuilt with the new image so the next put only appends.
+        '''
+        with self.lock:
+            #check before the new file touches the folder.
+            fresh = not self.stale()
+
+            with open(filepath, 'wb') as f:
+                f.write(img_bytes)
+
+            if not fresh:
+                self.build()
+                return
+
+            record = np.zeros(1, dtype=JPEG_INDEX_DTYPE)
+            record[0] = (frame, _to_float(angle), _to_float(throttle), 
+                         _to_float(milliseconds), os.path.basename(filepath).encode())
+            with open(self.index_path, 'ab') as f:
+                f.write(record.tobytes())
+
+
+    def delete(self, names):
+        with self.lock:
+            self.ensure()
+            records = read_records(self.index_path, JPEG_INDEX_DTYPE)
+            for n in names:
+                os.remove(os.path.join(self.path, n))
+            keep = records[~np.isin(records['name'], [n.encode() for n in names])]
+            self._save(keep)
+
+
+    def _save(self, records):
+        tmp_path = self.index_path + '.tmp'
+        records.tofile(tmp_path)
+        os.replace(tmp_path, self.index_path)
+        #renaming the file touches the folder, keep the index the newest.
+        os.utime(self.index_path)
+
+
+
+_logs = {}
+_indexes = {}
+_logs_lock = threading.Lock()
+
+def open_log(path):
+    '''
+    Return the SessionLog of a session folder. Logs are shared so the 
+    writer and the readers of a session use the same file handles.
+    '''
+    path = os.path.realpath(os.path.expanduser(path))
+    with _logs_lock:
+        if path not in _logs:
+            _logs[path] = SessionLog(path)
+        return _logs[path]
+
+
+def open_index(folder):
+    '''
+    Return the index of a session folder, the log itself for log sessions.
+    '''
+    if detect_backend(folder) == LOG_BACKEND:
+        return open_log(folder)
+    return open_jpeg_index(folder)
+
+
+def open_jpeg_index(folder):
+    ''' Return the shared JpegIndex of a jpeg session folder. '''
+    path = os.path.realpath(os.path.expanduser(folder))
+    with _logs_lock:
+        if path not in _indexes:
+            _indexes[path] = JpegIndex(path)
+        return _indexes[path]
+
+
+def is_log(folder):
+    return os.path.exists(os.path.join(folder, LOG_INDEX_NAME))
+
+
+def detect_backend(folder):
+    '''
+    Return the storage backend of a session folder. Folders that already 
+    contain jpegs keep using them, everything else uses the session log.
+    '''
+    if is_log(folder):
+        return LOG_BACKEND
+    if os.path.exists(os.path.join(folder, JPEG_INDEX_NAME)):
+        return JPEG_BACKEND
+    if os.path.isdir(folder):
+        for f in os.scandir(folder):
+            if f.name.endswith('.jpg'):
+                return JPEG_BACKEND
+    return LOG_BACKEND
+
+
+def record_name(record):
+    ''' Return the file name used to address a frame saved in a log. '''
+    return os.path.basename(create_img_filepath('', int(record['frame']), 
+                                                _from_float(record['angle']),
+                                                _from_float(record['throttle']),
+                                                _from_float(record['milliseconds'])))
+
+
+def frame_number(file_path):
+    '''
+    Return the frame number encoded in an image file name or raise a 
+    KeyError, like a missing frame, when the name has none.
+    '''
+    try:
+        return int(os.path.basename(file_path).split('_')[1])
+    except (IndexError, ValueError):
+        raise KeyError('%s is not the name of a frame.' % os.path.basename(file_path))
+
+
+def record_info(record, name):
+    ''' Return the name and telemetry of an index record as a dictionary. '''
+    return {'name': name,
+            'frame': int(record['frame']),
+            'angle': _from_float(record['angle']),
+            'throttle': _from_float(record['throttle']),
+            'milliseconds': _from_float(record['milliseconds'])}
+
+
+def record_count(path, dtype):
+    ''' Return the number of records in an index file. '''
+    if not os.path.exists(path):
+        return 0
+    return os.path.getsize(path) // dtype.itemsize
+
+
+def read_records(path, dtype, start=0, stop=None):
+    '''
+    Read records start:stop of an index file without reading the rest 
+    of the file.
+    '''
+    count = record_count(path, dtype)
+    start = max(0, min(start, count))
+    stop = count if stop is None else max(start, min(stop, count))
+    if stop == start:
+        return np.zeros(0, dtype=dtype)
+    with open(path, 'rb') as f:
+        f.seek(start * dtype.itemsize)
+        return np.frombuffer(f.read((stop - start) * dtype.itemsize), dtype=dtype)
+
+
+def _to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def _from_float(value):
+    return None if np.isnan(value) else round(float(value), 4)
+
+
 def img_paths(folder):
     """ 
     Returns a list of file paths for the images in the session. 
     """
-    files = os.listdir(folder)
-    files = [f for f in files if f[-3:] =='jpg']
+    files = open_index(folder).names()
     files.sort()
     file_paths = [os.path.join(folder, f) for f in files]
     return file_paths
 
 
+def load_img_bytes(file_path):
+    '''
+    Return the encoded bytes of an image saved in a jpeg or log session.
+    '''
+    if os.path.isfile(file_path):
+        with open(file_path, 'rb') as f:
+            return f.read()
+    log = open_log(os.path.dirname(file_path))
+    return log.read(frame_number(file_path))
+
+
+def load_img(file_path):
+    '''
+    Return a PIL image saved in a jpeg or log session.
+    '''
+    if os.path.isfile(file_path):
+        return Image.open(file_path)
+    return Image.open(io.BytesIO(load_img_bytes(file_path)))
+
+
+def delete_imgs(folder, names):
+    '''
+    Delete images from a session given their file names.
+    '''
+    if is_log(folder):
+        open_log(folder).delete([frame_number(n) for n in names])
+    else:
+        open_index(folder).delete(names)
+
+
+def last_modified(folder):
+    ''' Return the newest modification time of a session folder and its files. '''
+    times = [f.stat().st_mtime for f in os.scandir(folder) if f.is_file()]
+    return max(times + [os.path.getmtime(folder)])
+
+
+def img_version(file_path):
+    '''
+    Return a string that changes when the image saved at file_path changes 
+    and the time it was saved.
+    '''
+    if os.path.isfile(file_path):
+        st = os.stat(file_path)
+        return '%d-%d' %(st.st_mtime_ns, st.st_size), st.st_mtime
+    log = open_log(os.path.dirname(file_path))
+    r = log.record(frame_number(file_path))
+    mtime = os.path.getmtime(log.chunk_path(int(r['chunk'])))
+    return '%d-%d-%d' %(r['chunk'], r['offset'], r['length']), mtime
+
+
+class ThumbnailCache():
+    '''
+    Small jpeg copies of session images saved in a folder that is kept 
+    under max_bytes by deleting the least recently used thumbnails. 
+    Thumbnails are made in a pool of threads and only once for every 
+    version of an image.
+    '''
+
+    def __init__(self, path, size=(80, 60), max_bytes=64*1024*1024, workers=4, quality=75):
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.size = size
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        #file name -> size of the thumbnails already cached, oldest used first.
+        self.entries = collections.OrderedDict()
+        files = sorted(os.scandir(self.path), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if f.name.endswith('.jpg'):
+                self.entries[f.name] = f.stat().st_size
+        self.total_bytes = sum(self.entries.values())
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, file_path):
+        ''' Return the cache key and the mtime of an image. '''
+        version, mtime = img_version(file_path)
+        name = '%s:%s:%sx%s' %(os.path.realpath(file_path), version, self.size[0], self.size[1])
+        return hashlib.sha1(name.encode()).hexdigest(), mtime
+
+
+    def submit(self, file_path):
+        '''
+        Return a concurrent.futures.Future of the thumbnail bytes, its key 
+        and the mtime of the image.
+        '''
+        key, mtime = self.key(file_path)
+        name = key + '.jpg'
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+            else:
+                self.misses += 1
+            future = self.executor.submit(self.load, file_path, key, mtime)
+            self.pending[key] = future
+        future.add_done_callback(lambda f: self._done(key))
+        return future
+
+
+    def build(self, file_paths):
+        ''' Start making the thumbnails of many images at once. '''
+        return [self.submit(p) for p in file_paths]
+
+
+    def load(self, file_path, key, mtime):
+        thumb_path = os.path.join(self.path, key + '.jpg')
+        try:
+            with open(thumb_path, 'rb') as f:
+                data = f.read()
+            os.utime(thumb_path)
+            return data, key, mtime
+        except FileNotFoundError:
+            pass
+
+        o = io.BytesIO()
+        with load_img(file_path) as img:
+            #decode a jpeg at the smallest scale larger than the thumbnail.
+            img.draft('RGB', self.size)
+            img.thumbnail(self.size)
+            img.convert('RGB').save(o, format='JPEG', quality=self.quality)
+        data = o.getvalue()
+
+        tmp_path = '%s.%s.tmp' %(thumb_path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, thumb_path)
+        self._add(key + '.jpg', len(data))
+        return data, key, mtime
+
+
+    def _done(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+
+    def _add(self, name, size):
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                try:
+                    os.remove(os.path.join(self.path, old))
+                except FileNotFoundError:
+                    pass
+
+
+    def stats(self):
+        with self.lock:
+            return {'thumbnails': len(self.entries), 'bytes': self.total_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
 def load_frame(file_path):
     ''' 
     Retrieve an image and its telemetry data.
     '''
 
-    with Image.open(file_path) as img:
+    with load_img(file_path) as img:
         img_arr = np.array(img)
 
     data = dk.sessions.parse_img_filepath(file_path)
@@ -179,9 +897,10 @@ def frame_generator(img_paths):
             yield img_arr, data_arr
 
 
-def batch_generator(img_paths, batch_size=32):
+def batch_generator(img_paths, batch_size=32, augment=None):
     '''
-    Generator that returns batches of X, Y data.
+    Generator that returns batches of X, Y data. augment is an optional 
+    dk.datasets.Augmenter applied to each batch.
     '''
     frame_gen = frame_generator(img_paths)
 
@@ -196,6 +915,10 @@ def batch_generator(img_paths, batch_size=32):
         X = np.array(X)
         Y = np.array(Y)
 
+        if augment is not None:
+            X, Y[:, 0] = augment(X, Y[:, 0])
+            X = X.copy()
+
         yield X, Y
 
 
@@ -240,6 +963,76 @@ def sessions_to_dataset(session_names):
     return X, Y
 
 
+def sessions_to_hdf5(session_names, file_path, block_size=256, processes=None):
+    '''
+    Stream the frames of many sessions into an hdf5 file without holding 
+    them all in memory. Blocks of images are decoded by a pool of 
+    processes and appended to resizable datasets in order. Only a few 
+    blocks are in memory at any time.
+
+    Returns the number of frames saved.
+    '''
+    sh = dk.sessions.SessionHandler(dk.config.sessions_path)
+    paths = []
+    for name in session_names:
+        paths += sh.load(name).img_paths()
+
+    blocks = [paths[i:i + block_size] for i in range(0, len(paths), block_size)]
+    processes = processes or multiprocessing.cpu_count()
+
+    print('Saving HDF5 file to %s' %file_path)
+    f = h5py.File(file_path, "w")
+    start = time.time()
+    count = 0
+
+    pool = multiprocessing.Pool(processes, initializer=_reset_logs)
+    try:
+        pending = collections.deque()
+        blocks = iter(blocks)
+        while True:
+            #keep a bounded number of blocks in flight.
+            while len(pending) < processes * 2:
+                block = next(blocks, None)
+                if block is None:
+                    break
+                pending.append(pool.apply_async(_load_block, (block,)))
+
+            if not pending:
+                break
+
+            X, Y = pending.popleft().get()
+            if count == 0:
+                f.create_dataset("X", shape=(0,) + X.shape[1:], maxshape=(None,) + X.shape[1:], 
+                                 chunks=(min(block_size, 64),) + X.shape[1:], dtype=X.dtype)
+                f.create_dataset("Y", shape=(0,) + Y.shape[1:], maxshape=(None,) + Y.shape[1:], 
+                                 dtype=Y.dtype)
+
+            for key, arr in (('X', X), ('Y', Y)):
+                f[key].resize(count + len(arr), axis=0)
+                f[key][count:count + len(arr)] = arr
+            count += len(X)
+
+            rate = count / max(time.time() - start, 1e-6)
+            print('\r Saved {} of {} frames ({:.0f} frames/s)'.format(count, len(paths), rate), end='')
+    finally:
+        pool.terminate()
+        f.close()
+
+    print('')
+    return count
+
+
+def _load_block(img_paths):
+    ''' Decode a block of frames, run in the sessions_to_hdf5 pool. '''
+    return load_dataset(img_paths)
+
+
+def _reset_logs():
+    #forked processes must not share file offsets with the parent's logs.
+    _logs.clear()
+    _indexes.clear()
+
+
 def dataset_to_hdf5(X, Y, file_path):
     print('Saving HDF5 file to %s' %file_path)
     f = h5py.File(file_path, "w")
@@ -248,10 +1041,18 @@ def dataset_to_hdf5(X, Y, file_path):
     f.close()
     
 
-def hdf5_to_dataset(file_path):
-    f = h5py.File(file_path, "r")
-    X = np.array(f['X'])
-    Y = np.array(f['Y'])
+def hdf5_to_dataset(file_path, cache=False):
+    '''
+    Return X and Y of an hdf5 dataset read into memory or, with cache=True, 
+    as read only memory maps of its training cache, which is built next 
+    to the file if needed (see datasets.build_cache).
+    '''
+    if cache:
+        arrays = dk.datasets.open_cache(file_path)
+        return arrays['X'], arrays['Y']
+    with h5py.File(file_path, "r") as f:
+        X = np.array(f['X'])
+        Y = np.array(f['Y'])
     return X, Y
 
 
@@ -13,6 +13,7 @@ import glob
 import socket
 import math
 import zipfile
+import json
 
 import itertools
 
@@ -82,6 +83,44 @@ def norm_img(img):
     return (img - img.mean() / np.std(img))/255.0
 
 
+def norm_imgs(imgs):
+    '''
+    accepts: array of images with shape (n, Hight, Width, Channels)
+    returns: float32 array with each image normalized like norm_img
+    '''
+    imgs = np.asarray(imgs)
+    out = imgs.astype(np.float32)
+    return norm_imgs_offsets(out, img_offsets(out), out=out)
+
+
+def img_offsets(imgs):
+    '''
+    Return the float32 mean/std of each image that norm_imgs subtracts.
+    '''
+    flat = np.asarray(imgs).reshape(len(imgs), -1)
+    if flat.dtype != np.float32:
+        flat = flat.astype(np.float32)
+
+    #per image mean and std from the sums of values and squares
+    size = flat.shape[1]
+    mean = flat.dot(np.ones(size, dtype=np.float32)).astype(np.float64) / size
+    sq_mean = np.einsum('ij,ij->i', flat, flat).astype(np.float64) / size
+    std = np.sqrt(np.maximum(sq_mean - mean**2, 0))
+    return (mean / std).astype(np.float32)
+
+
+def norm_imgs_offsets(imgs, offsets, out=None):
+    '''
+    Normalize images like norm_imgs given their offsets from img_offsets.
+    uint8 images are converted to float32 in the same pass.
+    '''
+    if out is None:
+        out = np.empty(imgs.shape, dtype=np.float32)
+    np.subtract(imgs, offsets.reshape((-1,) + (1,) * (imgs.ndim - 1)), out=out, casting='unsafe')
+    out *= np.float32(1/255.0)
+    return out
+
+
 def create_video(img_dir_path, output_video_path):
     import envoy
     # Setup path to the images with telemetry.
@@ -144,6 +183,39 @@ def zip_dir(dir_path, zip_path):
     return zip_path
 
 
+class ZipStream():
+    '''
+    Unseekable file object for zipfile.ZipFile to write to. The written 
+    bytes are kept until read with pop() so an archive can be sent while 
+    it's being made. Everything is also written to cache if given.
+    '''
+
+    def __init__(self, cache=None):
+        self.buffer = []
+        self.size = 0
+        self.cache = cache
+
+    def write(self, data):
+        data = bytes(data)
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.cache is not None:
+            self.cache.write(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        ''' Return and forget the bytes written since the last pop. '''
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
 
 
 '''
@@ -151,31 +223,42 @@ BINNING
 functions to help converte between floating point numbers and categories.
 '''
 
-def linear_bin(a):
-    a = a + 1
-    b = round(a / (2/14))
-    return int(b)
+def linear_bin(a, bins=15, low=-1.0, high=1.0):
+    '''
+    accepts: number or array of numbers between low and high
+    returns: index of the closest of the bins evenly spaced from low to high
+    '''
+    b = np.round((np.asarray(a) - low) / ((high - low) / (bins - 1)))
+    b = np.clip(b, 0, bins - 1).astype(int)
+    if b.ndim == 0:
+        return int(b)
+    return b
 
-def linear_unbin(b):
-    a = b *(2/14) - 1
-    return a
+def linear_unbin(b, bins=15, low=-1.0, high=1.0):
+    '''
+    accepts: bin index or array of bin indexes
+    returns: value(s) of the bins evenly spaced from low to high
+    '''
+    return np.asarray(b) * ((high - low) / (bins - 1)) + low
 
 
-def bin_Y(Y):
-    d = []
-    for y in Y:
-        arr = np.zeros(15)
-        arr[linear_bin(y)] = 1
-        d.append(arr)
-    return np.array(d) 
+def bin_Y(Y, bins=15, low=-1.0, high=1.0):
+    '''
+    accepts: array of n values
+    returns: array with shape (n, bins) one hot encoding the bin of each value
+    '''
+    Y = np.asarray(Y).ravel()
+    d = np.zeros((len(Y), bins))
+    d[np.arange(len(Y)), linear_bin(Y, bins, low, high)] = 1
+    return d
         
-def unbin_Y(Y):
-    d=[]
-    for y in Y:
-        v = np.argmax(y)
-        v = linear_unbin(v)
-        d.append(v)
-    return np.array(d)
+def unbin_Y(Y, low=-1.0, high=1.0):
+    '''
+    accepts: array with shape (n, bins) of bin weights
+    returns: array of n values of the bins with the highest weights
+    '''
+    Y = np.asarray(Y)
+    return linear_unbin(np.argmax(Y, axis=1), Y.shape[1], low, high)
 
 
 
@@ -193,9 +276,66 @@ def my_ip():
 
 
 
+'''
+TIMING
+'''
+
+class LatencyStats():
+    '''
+    Keeps the durations of the last calls of something in a ring buffer
+    and reports their percentiles in milliseconds.
+    '''
+
+    def __init__(self, size=1000):
+        self.times = np.zeros(size)
+        self.count = 0
+
+    def record(self, seconds):
+        self.times[self.count % len(self.times)] = seconds
+        self.count += 1
+
+    def percentiles(self, q=(50, 90, 99)):
+        times = self.times[:min(self.count, len(self.times))] * 1000
+        stats = {'count': self.count}
+        for p in q:
+            stats['p%s' %p] = float(np.percentile(times, p)) if len(times) else None
+        stats['max'] = float(times.max()) if len(times) else None
+        return stats
+
+
+
+
 '''
 OTHER
 '''
+def read_jsonl(path):
+    ''' Return the records of an append-only json lines file. '''
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                #the last line of a crashed run can be incomplete.
+                pass
+    return records
+
+
+def append_jsonl(path, record):
+    line = (json.dumps(record, default=str) + '\n').encode('utf8')
+    with open(path, 'ab+') as f:
+        #start a new line after the incomplete last line of a crashed run.
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = b'\n' + line
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
 def merge_two_dicts(x, y):
     """Given two dicts, merge them into a new dict as a shallow copy."""
     z = x.copy()
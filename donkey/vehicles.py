@@ -10,7 +10,6 @@ import numpy as np
 import time
 
 from picamera import PiCamera
-from picamera.array import PiRGBArray
 from random import uniform
 
 import donkey as dk
@@ -18,21 +17,22 @@ import donkey as dk
 from donkey.actuators import PWMSteeringActuator
 from donkey.pilots import KerasCategorical
 from donkey.remotes import RemoteClient
-from donkey.sensors import PiVideoStream
-from threading import Thread
+from donkey.sensors import PiVideoStream, FrameRing
+from threading import Thread, Condition, Lock
 from constants import Constants
 
 
 class CameraStream:
-    def __init__(self):
-        # initialize the camera and grab a reference to the raw camera capture
+    def __init__(self, slots=4):
+        # initialize the camera and a ring of buffers to capture into
         self.camera = PiCamera()
         self.camera.resolution = (Constants.res_length, Constants.res_width)
         self.camera.framerate = Constants.frame_rate
         self.camera.hflip = True
-        self.frame = np.zeros(shape=(Constants.res_length, Constants.res_width, 3))
+        self.ring = FrameRing((Constants.res_length, Constants.res_width), slots=slots)
 
-        self.rawCapture = PiRGBArray(self.camera, size=(Constants.res_length, Constants.res_width))
+        # readers wait on new_frame for the next frame.
+        self.new_frame = Condition()
 
         # allow the camera to warmup
         time.sleep(0.1)
@@ -44,23 +44,131 @@ class CameraStream:
         return self
 
     def update(self):
-        # capture frames from the camera
-        start_time = time.time()
-        count = 0
-        for frame in self.camera.capture_continuous(self.rawCapture, format="bgr", use_video_port=True):
-            count += 1
-            now = time.time()
-            elapsed_ms = int((now - start_time) * 1000)
-            self.frame = frame.array
-            self.rawCapture.truncate(0)
-            # print('\n Frame, count={}, elapsed_ms={}, fps={}', count, elapsed_ms, 1000 * count/elapsed_ms)
+        # capture frames from the camera straight into the ring
+        for _ in self.camera.capture_continuous(self.ring, format="bgr", use_video_port=True):
+            self.ring.publish()
+            with self.new_frame:
+                self.new_frame.notify_all()
     
     def read(self):
-        return self.frame
+        ''' Return the latest frame, its timestamp and sequence number. '''
+        return self.ring.read()
+
+    def wait(self, last_seq=0, timeout=None):
+        '''
+        Block until a frame newer than last_seq is captured and return 
+        it like read().
+        '''
+        with self.new_frame:
+            self.new_frame.wait_for(lambda: self.ring.seq > last_seq, timeout)
+        return self.ring.read()
+
+
+# BGR ranges of the colours of the followed blob.
+BLOB_COLOURS = [
+    ((40, 5, 85), (70, 35, 115)),     # light
+    ((0, 0, 35), (10, 10, 70)),       # dark
+    ((10, 0, 60), (60, 30, 90)),      # mid
+    ((75, 25, 145), (135, 55, 185)),  # pink
+]
+
+
+class BlobTracker:
+    '''
+    Finds the centroid and area of the pixels with any of the colours in 
+    ranges (up to 8 (lower, upper) BGR bounds).
+
+    The colours are combined in one lookup table per channel where bit k 
+    of an entry is set when the value is inside range k. A pixel is part 
+    of the blob when the bits of its three channels have one in common.
+
+    Only the region of interest roi=(x0, y0, x1, y1) of the frame is used 
+    and it's downscaled by taking every scale'th pixel before blurring. 
+    Coordinates and areas are returned in full frame pixels and the area 
+    is the sum of a 0/255 mask, like the old tracker, so the thresholds 
+    in Constants still apply.
+    '''
+
+    def __init__(self, ranges=BLOB_COLOURS, roi=None, scale=1, blur=(3, 3)):
+        if len(ranges) > 8:
+            raise ValueError('BlobTracker supports up to 8 colour ranges.')
+        self.roi = roi
+        self.scale = scale
+        self.blur = blur
+
+        values = np.arange(256)
+        self.luts = []
+        for channel in range(3):
+            lut = np.zeros(256, dtype=np.uint8)
+            for k, (lower, upper) in enumerate(ranges):
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+                lut[inside] |= 1 << k
+            self.luts.append(lut)
+
+        self.buffers = None
+        self.latency = dk.utils.LatencyStats()
+
+
+    def crop(self, image):
+        ''' Return a view of the region of interest, downscaled. '''
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            image = image[y0:y1, x0:x1]
+        if self.scale > 1:
+            image = image[::self.scale, ::self.scale]
+        return image
+
+
+    def mask(self, image):
+        ''' Return a 0/255 uint8 mask of the blob pixels of an image. '''
+        shape = image.shape[:2]
+        if self.buffers is None or self.buffers[0].shape != shape:
+            self.buffers = [np.empty(shape, dtype=np.uint8) for i in range(3)]
+        bits, channel, mask = self.buffers
+
+        np.take(self.luts[0], image[..., 0], out=bits)
+        for i in (1, 2):
+            np.take(self.luts[i], image[..., i], out=channel)
+            np.bitwise_and(bits, channel, out=bits)
+        np.not_equal(bits, 0, out=mask.view(bool))
+        np.multiply(mask, 255, out=mask)
+        return mask
+
+
+    def track(self, image):
+        '''
+        Return the centroid (cx, cy) and area of the blob or None and 0 
+        when the frame has no blob pixels.
+        '''
+        start = time.time()
+        small = self.crop(image)
+        if self.blur:
+            small = cv2.blur(small, self.blur)
+        mask = self.mask(small)
+
+        m = cv2.moments(mask, binaryImage=True)
+        centroid = None
+        area = 0
+        if m['m00'] > 0:
+            x0, y0 = (self.roi[0], self.roi[1]) if self.roi is not None else (0, 0)
+            cx = x0 + m['m10'] / m['m00'] * self.scale
+            cy = y0 + m['m01'] / m['m00'] * self.scale
+            centroid = (int(cx), int(cy))
+            area = int(m['m00']) * 255 * self.scale * self.scale
+
+        self.latency.record(time.time() - start)
+        return centroid, area
+
 
 class ImageProcessingThread:
-    def __init__(self, actuator_mixer):
+    def __init__(self, actuator_mixer, roi=Constants.tracker_roi, scale=Constants.tracker_scale,
+                 report_every=1.0):
         self.actuator_mixer = actuator_mixer
+        self.tracker = BlobTracker(roi=roi, scale=scale,
+                                   blur=(Constants.blur_anchor_x, Constants.blur_anchor_y))
+        self.report_every = report_every
+        self.last_report = 0.0
+        self.track_ms = 0.0
 
     def start(self, image):
         # t = Thread(target=self.calculate_throttle_and_angle(image), args=())
@@ -70,42 +178,18 @@ class ImageProcessingThread:
 
 
     def calculate_throttle_and_angle(self, image):
-        blur = cv2.blur(image, (Constants.blur_anchor_x, Constants.blur_anchor_y))
-            
-        # pink
-        lower_light = np.array([40, 5, 85], dtype="uint8")
-        upper_light = np.array([70, 35, 115], dtype="uint8")
-        thresh_light = cv2.inRange(blur, lower_light, upper_light)
-
-        lower_dark = np.array([0, 0, 35], dtype="uint8")
-        upper_dark = np.array([10, 10, 70], dtype="uint8")
-        thresh_dark = cv2.inRange(blur, lower_dark, upper_dark)
-
-        lower_mid = np.array([10, 0, 60], dtype="uint8")
-        upper_mid = np.array([60, 30, 90], dtype="uint8")
-        thresh_mid = cv2.inRange(blur, lower_mid, upper_mid)
-        
-        lower_pink = np.array([75, 25, 145], dtype="uint8")
-        upper_pink = np.array([135, 55, 185], dtype="uint8")
-        thresh_pink = cv2.inRange(blur, lower_pink, upper_pink)
-
-        thresh = thresh_light + thresh_dark + thresh_mid + thresh_pink
-        thresh2 = thresh.copy()
-        
-        y = range(0, thresh.shape[0])
-        x = range(0, thresh.shape[1])
-
-        (X,Y) = np.meshgrid(x,y)
-
-        max_area = 0
+        throttle, angle = self.process(image)
+        self.actuator_mixer.update(throttle, angle)
+
+
+    def process(self, image):
+        ''' Return the throttle and angle to follow the blob in an image. '''
+        centroid, max_area = self.tracker.track(image)
+
         cx = Constants.angle_blob
         cy = Constants.angle_blob
-        if thresh.sum() > 0:
-            cx = int((X*thresh).sum() / thresh.sum())
-            cy = int((Y*thresh).sum() / thresh.sum())
-            max_area = thresh.sum()
-                        
-        cv2.circle(blur,(cx,cy),10,(0,0,255),-1)
+        if centroid is not None:
+            cx, cy = centroid
 
         # Note: using blob here
         angle = ((Constants.angle_blob - cx) / Constants.angle_blob * 2) - 1
@@ -114,11 +198,6 @@ class ImageProcessingThread:
         # breaks faster (even tho it can't go backwards)
         throttle = 0
         if max_area > 0:
-            # (x, y), radius = cv2.minEnclosingCircle(best_cnt)
-            # center = (int(x), int(y))
-            # radius = int(radius)
-            # cv2.circle(thresh2, center, radius, (0, 0, 255), 2)
-
             # Note: Using circle here
             # If it's too small don't follow
             # If it's too big don't follow
@@ -134,16 +213,128 @@ class ImageProcessingThread:
             # if radius > min_radius and radius < max_radius:
             #     throttle = max_throttle - ((max_throttle - min_throttle) * ((radius - min_radius) / (max_radius - min_radius)))
 
+        #the median tracking time is only worked out every report_every seconds.
+        now = time.time()
+        if now - self.last_report > self.report_every:
+            self.last_report = now
+            self.track_ms = self.tracker.latency.percentiles((50,))['p50']
+        print('\r DSP: cx: {}, cy: {}, max_area: {}, angle: {:+04.2f}, throttle: {:+04.2f}, track: {:.1f}ms'.format(
+            cx, cy, max_area, angle, throttle, self.track_ms), end='')
+
+        return throttle, angle
+
+
+class DriveLoop:
+    '''
+    Runs the image processing only when the camera has a new frame and 
+    updates the actuators at a fixed rate of one tick every delay seconds.
+
+    With parallel=True the newest frame is processed in its own thread 
+    while the result of the previous one is actuated. Otherwise each tick 
+    processes the newest frame, if there is one, and actuates the result.
+
+    stats() reports how late the ticks were (jitter), camera frames that 
+    were never processed (dropped) and the time from capturing a frame 
+    to actuating its result (latency).
+    '''
+
+    def __init__(self, camera, image_processing, actuator_mixer,
+                 delay=Constants.drive_loop_delay, parallel=True, report_every=5.0):
+        self.camera = camera
+        self.image_processing = image_processing
+        self.actuator_mixer = actuator_mixer
+        self.delay = delay
+        self.parallel = parallel
+        self.report_every = report_every
+
+        self.lock = Lock()
+        self.processed_seq = 0
+        self.result = None      # (throttle, angle, seq, capture time)
+        self.actuated_seq = 0
+
+        self.ticks = 0
+        self.frames = 0
+        self.dropped = 0
+        self.jitter = dk.utils.LatencyStats()
+        self.latency = dk.utils.LatencyStats()
+        self.running = False
+
+
+    def start(self):
+        ''' Run the drive loop until stop() is called. '''
+        self.running = True
+        if self.parallel:
+            t = Thread(target=self.update, args=())
+            t.daemon = True
+            t.start()
+
+        next_tick = time.time()
+        last_report = next_tick
+        while self.running:
+            next_tick += self.delay
+            wait = next_tick - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            now = time.time()
+            self.jitter.record(now - next_tick)
+            if now - next_tick > self.delay:
+                #skip the ticks that were missed instead of running them late.
+                next_tick = now
+
+            if not self.parallel:
+                self.process(timeout=0)
+            self.tick(now)
+
+            if now - last_report > self.report_every:
+                last_report = now
+                print('\n Drive loop: {}'.format(self.stats()))
+
+
+    def stop(self):
+        self.running = False
+
+
+    def update(self):
+        while self.running:
+            self.process(timeout=self.delay)
+
+
+    def process(self, timeout=None):
+        ''' Process the newest frame if it wasn't processed yet. '''
+        frame, timestamp, seq = self.camera.wait(self.processed_seq, timeout)
+        if seq <= self.processed_seq:
+            return
+        self.frames += 1
+        self.dropped += seq - self.processed_seq - 1
+        self.processed_seq = seq
+
+        throttle, angle = self.image_processing.process(frame)
+        with self.lock:
+            self.result = (throttle, angle, seq, timestamp)
+
+
+    def tick(self, now):
+        ''' Send the newest result to the actuators. '''
+        self.ticks += 1
+        with self.lock:
+            result = self.result
+        if result is None:
+            return
+        throttle, angle, seq, timestamp = result
         self.actuator_mixer.update(throttle, angle)
-        print('\r DSP: cx: {}, cy: {}, max_area: {}, angle: {:+04.2f}, throttle: {:+04.2f}'.format(
-            cx, cy, max_area, angle, throttle), end='')
+        if seq > self.actuated_seq:
+            self.actuated_seq = seq
+            self.latency.record(time.time() - timestamp)
+
+
+    def stats(self):
+        return {'ticks': self.ticks, 
+                'frames': self.frames, 
+                'dropped': self.dropped,
+                'jitter_ms': self.jitter.percentiles(),
+                'latency_ms': self.latency.percentiles()}
 
-        # cv2.imshow("Frame", blur)
-        # cv2.imshow('thresh', thresh2)
-        # show the frame
-        # key = cv2.waitKey(1) & 0xFF
 
-        return
 
 
 class BaseVehicle:
@@ -156,6 +347,5 @@ class BaseVehicle:
     def start(self):
         self.camera.start()
 
-        while(True):
-            # print('\n Main process loop')
-            self.image_processing.start(self.camera.read())
+        self.drive_loop = DriveLoop(self.camera, self.image_processing, self.actuator_mixer)
+        self.drive_loop.start()
@@ -0,0 +1,149 @@
+"""
+benchmark.py
+
+Micro-benchmarks of the functions that run on every training batch or
+every frame.
+
+Usage:
+    benchmark.py binning [--loops=<loops>]
+    benchmark.py augment [--loops=<loops>]
+    benchmark.py inference [--model=<model>] [--loops=<loops>]
+
+
+Options:
+  --loops=<loops>   times each benchmark is repeated [default: 10]
+  --model=<model>   keras model in the models folder compared with the numpy pilot, 
+                    by default the nvidia architecture with random weights is timed
+"""
+
+import os
+import time
+
+from docopt import docopt
+import numpy as np
+
+import donkey as dk
+
+
+def timeit(fn, loops):
+    ''' Return the average seconds fn takes to run. '''
+    fn()
+    start = time.time()
+    for i in range(loops):
+        fn()
+    return (time.time() - start) / loops
+
+
+def report(name, batch_size, old, new):
+    print('{:<8} batch {:>7}: loop {:10.6f}s  vectorized {:10.6f}s  speedup {:8.1f}x'.format(
+        name, batch_size, old, new, old / new))
+
+
+def loop_bin_Y(Y):
+    #the python loop bin_Y used to run.
+    d = []
+    for y in Y:
+        arr = np.zeros(15)
+        arr[int(round((y + 1) / (2/14)))] = 1
+        d.append(arr)
+    return np.array(d)
+
+
+def loop_unbin_Y(Y):
+    #the python loop unbin_Y used to run.
+    d = []
+    for y in Y:
+        d.append(np.argmax(y) * (2/14) - 1)
+    return np.array(d)
+
+
+def binning(loops):
+    for batch_size in [1, 128, 100000]:
+        Y = np.random.uniform(-1, 1, batch_size)
+        binned = dk.utils.bin_Y(Y)
+
+        n = loops if batch_size < 100000 else max(1, loops // 10)
+        report('bin_Y', batch_size,
+               timeit(lambda: loop_bin_Y(Y), n),
+               timeit(lambda: dk.utils.bin_Y(Y), n))
+        report('unbin_Y', batch_size,
+               timeit(lambda: loop_unbin_Y(binned), n),
+               timeit(lambda: dk.utils.unbin_Y(binned), n))
+
+
+def augment(loops):
+    X = np.random.randint(0, 255, (128, 120, 160, 3)).astype(np.uint8)
+    angle = np.random.uniform(-1, 1, 128)
+    off = dict(flip=0, shift=0, vshift=0, brightness=0, contrast=0, shadow=0)
+    default = dk.datasets.Augmenter()
+
+    tests = [('copy only', off)]
+    for k in ['flip', 'shift', 'vshift', 'brightness', 'contrast', 'shadow']:
+        tests.append((k, dict(off, **{k: getattr(default, k)})))
+    tests.append(('all', {}))
+
+    norm = timeit(lambda: dk.utils.norm_imgs(X), loops)
+    print('{:<12} batch 128: {:8.2f}ms'.format('norm_imgs', norm * 1000))
+    for name, kwargs in tests:
+        aug = dk.datasets.Augmenter(seed=0, **kwargs)
+        t = timeit(lambda: aug(X, angle), loops)
+        print('{:<12} batch 128: {:8.2f}ms'.format(name, t * 1000))
+
+
+def random_network(conv, dense, input_shape=(120, 160, 3)):
+    ''' Return a numpy Network of the layer configs with random weights. '''
+    spec = dk.inference.spec_from_config(conv, dense)
+    x = np.zeros((1,) + input_shape, dtype=np.float32)
+    weights = []
+    for layer in spec:
+        #run an empty image through the layers to find the size of each input.
+        if layer['type'] == 'conv':
+            kernel = np.random.randn(*(layer['kernal'] + [x.shape[3], layer['filters']])) * .1
+            weights.append((kernel.astype(np.float32), np.zeros(layer['filters'], dtype=np.float32)))
+            x = dk.inference.conv2d(x, *weights[-1], strides=layer['strides'])
+        elif layer['type'] == 'pool':
+            x = dk.inference.max_pool(x, layer['size'], layer['strides'])
+        elif layer['type'] == 'flatten':
+            x = x.reshape(1, -1)
+        else:
+            units = layer.get('units', 15 if layer.get('name') == 'angle_out' else 1)
+            weights.append(((np.random.randn(x.shape[1], units) * .1).astype(np.float32),
+                            np.zeros(units, dtype=np.float32)))
+            if layer['type'] == 'dense':
+                x = dk.inference.dense(x, *weights[-1])
+    return dk.inference.Network(spec, weights)
+
+
+def inference(loops, model=None):
+    X = dk.utils.norm_imgs(np.random.randint(0, 255, (32, 120, 160, 3)).astype(np.uint8))
+    predictors = []
+    if model is None:
+        predictors.append(('numpy', random_network(**dk.models.nvidia_arch).predict))
+    else:
+        import keras
+        model_path = os.path.join(dk.config.models_path, model)
+        keras_model = keras.models.load_model(model_path)
+        network = dk.inference.load_keras(model_path)
+        predictors.append(('keras', keras_model.predict))
+        predictors.append(('numpy', network.predict))
+
+        for name, k, n in zip(network.output_names, keras_model.predict(X), network.predict(X)):
+            print('{:<12} max difference from keras: {:.6f}'.format(name, np.abs(k - n).max()))
+
+    for name, predict in predictors:
+        for batch_size in [1, 8, 32]:
+            t = timeit(lambda: predict(X[:batch_size]), loops)
+            print('{:<8} batch {:>3}: {:8.2f}ms  {:8.2f}ms per frame'.format(
+                name, batch_size, t * 1000, t * 1000 / batch_size))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    loops = int(args['--loops'])
+
+    if args['binning']:
+        binning(loops)
+    elif args['augment']:
+        augment(loops)
+    elif args['inference']:
+        inference(loops, args['--model'])
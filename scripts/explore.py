@@ -3,8 +3,14 @@ explore.py
 
 Used to train and test many different types of models to find the best one.
 
+Trials run concurrently in their own processes and every finished trial is
+appended to <name>.jsonl in the test folder. Running the same test again
+resumes it, skipping the trials already in the results. Trials whose
+validation loss is worse than the median of the other trials at the same
+epoch are stopped early.
+
 Usage:
-    explore.py (--datasets=<dataset>) (--name=<name) [--loops=<loops]
+    explore.py (--datasets=<dataset>) (--name=<name) [--loops=<loops] [--workers=<workers>] [--trials=<trials>] [--threads=<threads>] [--prune-after=<epochs>] [--profile-steps=<steps>] [--no-cache]
 
 
 Options:
@@ -12,30 +18,143 @@ Options:
   --datasets=<datasets>   file path of the hdf5 dataset
   --loops=<loops>   times to loop through the tests [default: 10]
   --name=<name>  name of the test
+  --workers=<workers>   processes prefetching batches, 0 loads them in the training process [default: 0]
+  --trials=<trials>   trials trained at the same time [default: 1]
+  --threads=<threads>   cpu threads used by each trial [default: 2]
+  --prune-after=<epochs>   epochs a trial trains before it can be pruned, 0 never prunes [default: 5]
+  --profile-steps=<steps>   sample the python stacks of the first steps of each trial [default: 0]
+  --no-cache   read batches from the hdf5 files instead of the uint8 training caches
 """
 
 import os
 import sys
 import time
-import itertools
-import random
+import pickle
+import multiprocessing
+from queue import Empty
 
 from docopt import docopt
+import numpy as np
 import pandas as pd
 import keras
 
 import donkey as dk
 
 
-def save_results(results, name):
-    df = pd.DataFrame(all_results)
-    results_path = os.path.join(dk.config.results_path, name + '.csv')
-    df.to_csv(results_path, index=False)
+batch_size = 64
+
+
+def limit_threads(threads):
+    ''' Limit the cpu threads used by tensorflow in this process. '''
+    if keras.backend.backend() == 'tensorflow':
+        import tensorflow as tf
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                inter_op_parallelism_threads=1)
+        keras.backend.set_session(tf.Session(config=config))
+
+
+def run_trial(trial, opts, results_queue):
+    ''' Train and test one model, put its results on the queue. '''
+    limit_threads(opts['threads'])
+
+    with open(opts['split_path'], 'rb') as f:
+        split = pickle.load(f)
+
+    mp = trial['params']
+    results = {'trial': trial['id'], 'dataset': opts['dataset_name']}
+
+    #MODEL
+    model = dk.models.categorical_model_factory(**mp)
+    model_path = os.path.join(opts['test_dir_path'], trial['id'])
+
+    results['conv_layers'] = str(mp['conv'])
+    results['dense_layers'] = str(mp['dense'])
+
+    #DATASET
+    train, val, test = dk.datasets.split_datasets(opts['datasets'],
+                                                  batch_size=batch_size,
+                                                  workers=opts['workers'],
+                                                  split=split,
+                                                  cache=opts['cache'])
+
+    results['training_samples'] = train['n']
+    results['validation_samples'] = val['n']
+    results['test_samples'] = test['n']
+
+    pruner = dk.models.MedianPruner(trial['id'], opts['progress_path'], prune_after=opts['prune_after'])
+    profiler = dk.models.TrainingProfiler(model_path + '_steps.csv', 
+                                          profile_steps=opts['profile_steps'])
+
+    start = time.time()
+
+    #train the model
+    hist = dk.models.train_gen(model, model_path, train_gen=train['gen'],
+                                val_gen=val['gen'] , steps=train['n']/batch_size,
+                                epochs=100, callbacks=[pruner, profiler])
 
+    model = keras.models.load_model(model_path)
+    end = time.time()
+
+    results['training_duration'] = end-start
+    results['batch_size']=batch_size
+    results['pruned'] = pruner.pruned
+    results.update(profiler.summary())
+    results['training_loss'] = model.evaluate_generator(train['gen'],
+                                    steps=1)
+
+    results['training_loss_progress'] = hist.history
+    results['epochs'] = len(hist.history['val_loss'])
+    results['validation_loss'] = model.evaluate_generator(val['gen'],
+                                    steps=val['n']/batch_size)
+
+    results['test_loss'] = model.evaluate_generator(test['gen'],
+                                    steps=test['n']/batch_size)
+    results['model_params'] = model.count_params()
+
+    for d in (train, val, test):
+        d['gen'].close()
+
+    results_queue.put(results)
+
+
+def run_trials(trials, opts, results_path):
+    '''
+    Run the trials in up to opts['trials'] processes at once and append
+    their results as they finish. Each trial gets a new process so
+    the memory of a finished model is given back.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    results_queue = ctx.Queue()
+    pending = list(trials)
+    running = {}
+    done = 0
+
+    while pending or running:
+        while pending and len(running) < opts['trials']:
+            trial = pending.pop(0)
+            p = ctx.Process(target=run_trial, args=(trial, opts, results_queue))
+            p.start()
+            running[trial['id']] = p
+
+        try:
+            results = results_queue.get(timeout=5)
+        except Empty:
+            for trial_id, p in list(running.items()):
+                #trials that finished put their results before exiting.
+                if not p.is_alive() and p.exitcode != 0:
+                    print('trial %s exited without results (%s)' %(trial_id, p.exitcode))
+                    del running[trial_id]
+            continue
+
+        dk.utils.append_jsonl(results_path, results)
+        running.pop(results['trial']).join()
+        done += 1
+        print('finished %s, %s of %s' %(results['trial'], done, len(trials)))
+        sys.stdout.flush()
 
-args = docopt(__doc__)
 
 if __name__ == '__main__':
+    args = docopt(__doc__)
 
     test_name = args['--name']
     loops = int(args['--loops'])
@@ -43,14 +162,34 @@ if __name__ == '__main__':
     test_dir_path = os.path.join(dk.config.results_path, test_name)
     dk.utils.make_dir(test_dir_path)
 
+    opts = {'workers': int(args['--workers']),
+            'trials': int(args['--trials']),
+            'threads': int(args['--threads']),
+            'prune_after': int(args['--prune-after']),
+            'profile_steps': int(args['--profile-steps']),
+            'cache': not args['--no-cache'],
+            'test_dir_path': test_dir_path,
+            'progress_path': os.path.join(test_dir_path, 'progress.jsonl'),
+            'split_path': os.path.join(test_dir_path, 'split.pkl')}
+
+    #trial processes inherit these so their math libraries use --threads cpus.
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(opts['threads'])
+
 
     #load data
-    if args['--datasets'] is not None:
-        datasets = args['--datasets'].split(',')
-        datasets = [os.path.join(dk.config.datasets_path,d) for d in datasets]
-        dataset_name = str(datasets)
-        train, val, test = dk.datasets.split_datasets(datasets)
-    
+    datasets = args['--datasets'].split(',')
+    datasets = [os.path.join(dk.config.datasets_path,d) for d in datasets]
+    opts['datasets'] = datasets
+    opts['dataset_name'] = str(datasets)
+
+    #split once so every trial, also after a resume, uses the same rows.
+    if not os.path.exists(opts['split_path']):
+        split = dk.datasets.split_indexes(datasets)
+        with open(opts['split_path'] + '.tmp', 'wb') as f:
+            pickle.dump(split, f)
+        os.replace(opts['split_path'] + '.tmp', opts['split_path'])
+
 
     #Define the model parameters you'd like to explore.
 
@@ -60,13 +199,13 @@ if __name__ == '__main__':
 
 
     conv1 = [
-            {'filters': 8, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)}, 
+            {'filters': 8, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)},
             {'filters': 16, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)},
             {'filters': 32, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)}
             ]
 
     conv2 = [
-            {'filters': 8, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)}, 
+            {'filters': 8, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)},
             {'filters': 16, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)},
             {'filters': 32, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)},
             {'filters': 32, 'kernal': (3,3), 'strides':(1,1), 'pool':(2,2)}
@@ -78,75 +217,22 @@ if __name__ == '__main__':
             }
 
 
-    batch_size = 64
-
-    
-    #create permutations of the models. 
+    #create permutations of the models.
     model_params = list(dk.utils.param_gen(model_params))
 
-    param_count = len(model_params) * loops
-    print('total params to test: %s' % param_count)
-
-    all_results = []
-    test_count = 0
-
+    trials = []
     for i in range(loops):
-
         for mp in model_params:
-            
-
-            test_count += 1
-
-            print('test %s of %s' %(test_count, param_count))
-
-            results = {}
-            results['dataset'] = dataset_name
-
-            #MODEL
-            model = dk.models.categorical_model_factory(**mp)
-            model_path = os.path.join(test_dir_path, test_name + '_' + str(test_count))
-
-            results['conv_layers'] = str(mp['conv'])
-            results['dense_layers'] = str(mp['dense'])
-            
-
-            #DATASET
-            train, val, test = dk.datasets.split_datasets(datasets, 
-                                                          batch_size=batch_size)
-
-            results['training_samples'] = train['n']
-            results['validation_samples'] = val['n']
-            results['test_samples'] = test['n']
-
-
-            start = time.time()
-
-            #train the model
-            hist = dk.models.train_gen(model, model_path, train_gen=train['gen'], 
-                                        val_gen=val['gen'] , steps=train['n']/batch_size, 
-                                        epochs=100)
-
-            model = keras.models.load_model(model_path)
-            end = time.time()
-
-            results['training_duration'] = end-start
-            results['batch_size']=batch_size
-            results['training_loss'] = model.evaluate_generator(train['gen'], 
-                                            steps=1)
-
-            results['training_loss_progress'] = hist.history
-            results['epochs'] = len(hist.history['val_loss'])
-            results['validation_loss'] = model.evaluate_generator(val['gen'], 
-                                            steps=val['n']/batch_size)
-
-            results['test_loss'] = model.evaluate_generator(test['gen'], 
-                                            steps=test['n']/batch_size)
-            results['model_params'] = model.count_params()
+            trial_id = test_name + '_' + str(len(trials) + 1)
+            trials.append({'id': trial_id, 'params': mp})
 
+    results_path = os.path.join(test_dir_path, test_name + '.jsonl')
+    finished = set(r['trial'] for r in dk.utils.read_jsonl(results_path))
+    todo = [t for t in trials if t['id'] not in finished]
+    print('total params to test: %s, %s already done' % (len(trials), len(trials) - len(todo)))
 
-            all_results.append(results)
-            
-            test_results_path = os.path.join(test_dir_path, test_name)
-            save_results(results, test_results_path)
+    run_trials(todo, opts, results_path)
 
-            sys.stdout.flush()
+    #keep a csv of all the results for spreadsheets.
+    df = pd.DataFrame(dk.utils.read_jsonl(results_path))
+    df.to_csv(os.path.join(dk.config.results_path, test_name + '.csv'), index=False)
@@ -0,0 +1,104 @@
+"""
+export_model.py
+
+Export a trained keras model with int8 or float16 weights for the numpy
+pilot and compare the export with the original model on held-out data.
+
+Usage:
+    export_model.py (--model=<model>) (--datasets=<datasets>) [--dtype=<dtype>] [--prune=<prune>] [--samples=<samples>] [--loops=<loops>]
+
+
+Options:
+  --model=<model>   name of the model in the models folder
+  --datasets=<datasets>   held-out hdf5 datasets the models are compared on
+  --dtype=<dtype>   int8, float16 or float32 weights [default: int8]
+  --prune=<prune>   fraction of the smallest weights set to zero [default: 0]
+  --samples=<samples>   images compared [default: 1000]
+  --loops=<loops>   single frame predictions timed for each model [default: 100]
+"""
+
+import os
+import time
+
+from docopt import docopt
+import numpy as np
+import h5py
+import keras
+
+import donkey as dk
+from donkey import inference
+
+
+def load_samples(h5_paths, samples):
+    ''' Return up to samples random images and labels from the datasets. '''
+    X, Y = [], []
+    per_dataset = samples // len(h5_paths) + 1
+    for p in h5_paths:
+        with h5py.File(p, 'r') as f:
+            n = f['X'].shape[0]
+            ix = np.sort(np.random.choice(n, min(n, per_dataset), replace=False))
+            X.append(f['X'][ix])
+            Y.append(f['Y'][ix])
+    X = np.concatenate(X)[:samples]
+    Y = np.concatenate(Y)[:samples]
+    return dk.utils.norm_imgs(X), Y
+
+
+def time_predictions(predict, X, loops):
+    ''' Return the latency percentiles of predicting one frame at a time. '''
+    stats = dk.utils.LatencyStats(size=loops)
+    predict(X[:1])
+    for i in range(loops):
+        start = time.time()
+        predict(X[i % len(X):i % len(X) + 1])
+        stats.record(time.time() - start)
+    return stats.percentiles()
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    loops = int(args['--loops'])
+
+    model_path = os.path.join(dk.config.models_path, args['--model'])
+    name = os.path.splitext(args['--model'])[0]
+    export_path = os.path.join(dk.config.models_path, '%s_%s.npz' % (name, args['--dtype']))
+
+    datasets = [os.path.join(dk.config.datasets_path, d) for d in args['--datasets'].split(',')]
+    X, Y = load_samples(datasets, int(args['--samples']))
+
+    model, keras_load = timed(keras.models.load_model, model_path)
+    dk.models.export_model(model, export_path, dtype=args['--dtype'], prune=float(args['--prune']))
+    network, numpy_load = timed(inference.load, export_path)
+
+    keras_angle, keras_throttle = model.predict(X)
+    numpy_angle, numpy_throttle = network.predict(X)
+
+    keras_unbinned = dk.utils.unbin_Y(keras_angle)
+    numpy_unbinned = dk.utils.unbin_Y(numpy_angle)
+
+    print('compared on %s images from %s' % (len(X), datasets))
+    print('{:<24} {:>12} {:>12}'.format('', 'keras', 'export'))
+    print('{:<24} {:>12.2f} {:>12.2f}'.format('file size (MB)',
+          os.path.getsize(model_path) / 2**20, os.path.getsize(export_path) / 2**20))
+    print('{:<24} {:>12.3f} {:>12.3f}'.format('load time (s)', keras_load, numpy_load))
+    print('{:<24} {:>12.4f} {:>12.4f}'.format('angle error',
+          np.abs(keras_unbinned - Y[:, 0]).mean(), np.abs(numpy_unbinned - Y[:, 0]).mean()))
+    print('{:<24} {:>12.4f} {:>12.4f}'.format('throttle error',
+          np.abs(keras_throttle[:, 0] - Y[:, 1]).mean(), np.abs(numpy_throttle[:, 0] - Y[:, 1]).mean()))
+
+    keras_latency = time_predictions(model.predict, X, loops)
+    numpy_latency = time_predictions(network.predict, X, loops)
+    for p in ['p50', 'p90', 'p99']:
+        print('{:<24} {:>12.2f} {:>12.2f}'.format('latency %s (ms)' % p, keras_latency[p], numpy_latency[p]))
+
+    print('angle bins agreeing with keras: {:.2%}'.format(
+          (keras_angle.argmax(axis=1) == numpy_angle.argmax(axis=1)).mean()))
+    print('max angle probability difference: {:.5f}'.format(np.abs(keras_angle - numpy_angle).max()))
+    print('max throttle difference: {:.5f}'.format(np.abs(keras_throttle - numpy_throttle).max()))
+    print('saved %s' % export_path)
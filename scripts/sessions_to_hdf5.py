@@ -24,6 +24,4 @@ if __name__ == '__main__':
 
     file_path = os.path.join(dk.config.datasets_path, name)
 
-    X, Y = dk.sessions.sessions_to_dataset(session_names=session_names)
-
-    dk.sessions.dataset_to_hdf5(X, Y, file_path)
+    dk.sessions.sessions_to_hdf5(session_names, file_path)
@@ -3,13 +3,17 @@ Example of how to train a keras model from simulated images or a
 previously recorded session.
 
 Usage:
-    train.py [--datasets=<datasets>] [--sessions=<sessions>] (--name=<name>) 
+    train.py [--datasets=<datasets>] [--sessions=<sessions>] (--name=<name>) [--workers=<workers>] [--augment] [--seed=<seed>] [--no-cache]
 
 
 Options:
   --datasets=<datasets>   file path of dataset
   --sessions=<sessions>   file path of sessions
   --name=<name>   name of model to be saved
+  --workers=<workers>   processes prefetching batches, 0 loads them in the training process [default: 0]
+  --augment   randomly flip, shift, shade and change the brightness of training images
+  --seed=<seed>   seed of the dataset split and batches, for repeatable runs
+  --no-cache   read batches from the hdf5 files instead of the uint8 training caches
 """
 
 import os
@@ -28,20 +32,27 @@ if __name__ == "__main__":
     args = docopt(__doc__)
 
     batch_size = 128
+    workers = int(args['--workers'])
+    augment = {} if args['--augment'] else None
+    seed = None if args['--seed'] is None else int(args['--seed'])
+    cache = not args['--no-cache']
 
     if args['--datasets'] is not None:
         datasets = args['--datasets'].split(',')
         datasets = [os.path.join(dk.config.datasets_path,d) for d in datasets]
         print('loading data from %s' %datasets)
-        train, val, test = dk.datasets.split_datasets(datasets, val_frac=.1, test_frac=.1, batch_size=128)
+        train, val, test = dk.datasets.split_datasets(datasets, val_frac=.1, test_frac=.1, batch_size=128, 
+                                                      workers=workers, augment=augment, seed=seed,
+                                                      cache=cache)
     
     elif args['--sessions'] is not None:
         session_names = args['--sessions'].split(',')
-        X, Y = dk.sessions.sessions_to_dataset(session_names=session_names)
         dataset_path = os.path.join(dk.config.datasets_path, 'temp.h5')
-        dk.sessions.dataset_to_hdf5(X, Y, dataset_path)
+        dk.sessions.sessions_to_hdf5(session_names, dataset_path)
         datasets = [dataset_path]
-        train, val, test = dk.datasets.split_datasets(datasets, val_frac=.1, test_frac=.1, batch_size=128)
+        train, val, test = dk.datasets.split_datasets(datasets, val_frac=.1, test_frac=.1, batch_size=128, 
+                                                      workers=workers, augment=augment, seed=seed,
+                                                      cache=cache)
 
     steps = round(train['n'] / batch_size)
 
@@ -54,5 +65,16 @@ if __name__ == "__main__":
     #path to save the model
     model_path = os.path.join(dk.config.models_path, model_name+".hdf5")
 
-    #train the model
-    dk.models.train_gen(model, model_path, train_gen=train['gen'], val_gen=val['gen'] , steps=steps)
\ No newline at end of file
+    #log the time of each step to see if training waits on the data.
+    #logs go in the results folder since every file in models is loaded as a pilot.
+    os.makedirs(dk.config.results_path, exist_ok=True)
+    profiler = dk.models.TrainingProfiler(os.path.join(dk.config.results_path, model_name + "_steps.csv"))
+
+    #train the model, stopping the prefetch workers when it ends or fails.
+    try:
+        dk.models.train_gen(model, model_path, train_gen=train['gen'], val_gen=val['gen'] , steps=steps,
+                            callbacks=[profiler])
+    finally:
+        for d in (train, val, test):
+            d['gen'].close()
+    print(profiler.summary())
\ No newline at end of file
@@ -1,4 +1,10 @@
+import os
+import time
 import unittest
+import tempfile
+
+import numpy as np
+from PIL import Image
 
 import donkey as dk
 
@@ -18,5 +24,68 @@ class TestBaseCamera(unittest.TestCase):
 
 
 
+class TestFrameRing(unittest.TestCase):
+
+    def test_write_publish(self):
+        ring = dk.sensors.FrameRing((140, 120), slots=2)
+        for columns in [144, 160]:
+            #frames padded to 16 or 32 columns and 16 rows
+            padded = np.random.randint(0, 255, (128, columns, 3)).astype(np.uint8)
+            ring.write(padded[:64].tobytes())
+            ring.write(padded[64:].tobytes())
+            ring.publish(timestamp=1.0)
+
+            frame, timestamp, seq = ring.read()
+            assert frame.shape == (120, 140, 3)
+            assert (frame == padded[:120, :140]).all()
+            assert timestamp == 1.0
+
+        ring.put(np.zeros((120, 140, 3), dtype=np.uint8))
+        assert (frame == padded[:120, :140]).all()
+        frame, timestamp, seq = ring.read()
+        assert seq == 3 and not frame.any()
+
+    def test_read_copies(self):
+        ring = dk.sensors.FrameRing((16, 16), slots=3)
+        ring.put(np.ones((16, 16, 3), dtype=np.uint8))
+        frame, timestamp, seq = ring.read()
+        for i in range(3):
+            ring.put(np.zeros((16, 16, 3), dtype=np.uint8))
+        assert seq == 1 and frame.all()
+
+
+class TestCameras(unittest.TestCase):
+
+    def test_img_array_camera(self):
+        X = np.random.randint(0, 255, (3, 12, 16, 3)).astype(np.uint8)
+        camera = dk.sensors.ImgArrayCamera(X)
+        frame, timestamp, seq = camera.read()
+        assert seq >= 1 and frame.shape == (12, 16, 3)
+        assert camera.capture_arr().shape == (12, 16, 3)
+
+    def make_session(self, folder, colour, frames=3):
+        os.makedirs(folder)
+        for i in range(frames):
+            path = dk.sessions.create_img_filepath(folder, i, 0.0, 0.0, 1000 + i * 50)
+            Image.new('RGB', (16, 12), colour).save(path)
+        return folder
+
+    def test_replay_camera(self):
+        root = tempfile.mkdtemp()
+        cache_dir = os.path.join(root, 'cache')
+        #sessions with the same name in different folders
+        red = self.make_session(os.path.join(root, 'a', 'session'), (255, 0, 0))
+        blue = self.make_session(os.path.join(root, 'b', 'session'), (0, 0, 255))
+
+        for path, channel in [(red, 0), (blue, 2), (red, 0)]:
+            camera = dk.sensors.ReplayCamera(path, speed=None, loop=False, cache_dir=cache_dir)
+            frame, timestamp, seq = camera.wait(2, timeout=1)
+            camera.stop()
+            assert seq == 3 and frame.shape == (12, 16, 3)
+            assert frame[..., channel].min() > 240
+            assert camera.stats()['skipped'] == 2
+        assert len(os.listdir(cache_dir)) == 2
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,4 +1,13 @@
+import os
+import re
 import unittest
+import tempfile
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import h5py
 
 import donkey as dk 
 
@@ -7,5 +16,258 @@ class TestDatasets(unittest.TestCase):
 
     def test_moving_square(self):
         X, Y = dk.datasets.moving_square()
-        
 
+
+class TestTrainingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'data.h5')
+        with h5py.File(self.path, 'w') as f:
+            f['X'] = np.random.randint(0, 255, (50, 12, 16, 3)).astype(np.uint8)
+            f['Y'] = np.random.uniform(-1, 1, (50, 2))
+
+    def test_same_batches(self):
+        split = dk.datasets.split_indexes([self.path])
+        np.random.seed(0)
+        X, Y = next(dk.datasets.batch_gen(split[0], batch_size=16, cache=True))
+        np.random.seed(0)
+        X2, Y2 = next(dk.datasets.batch_gen(split[0], batch_size=16, cache=False))
+        assert X.dtype == np.float32
+        assert np.allclose(X, X2)
+        assert np.allclose(Y['angle_out'], Y2['angle_out'])
+        assert np.allclose(Y['throttle_out'], Y2['throttle_out'])
+
+    def test_epoch_coverage(self):
+        with h5py.File(self.path, 'a') as f:
+            f['Y'][:, 1] = np.arange(50) / 100
+        split = dk.datasets.split_indexes([self.path, self.path], val_frac=.2, test_frac=0)
+        train = split[0]
+        n = sum(d['n'] for d in train)
+        assert n % 8 == 0
+
+        for cache in [True, False]:
+            gen = dk.datasets.batch_gen(train, batch_size=8, cache=cache)
+            for epoch in range(2):
+                rows = np.concatenate([np.rint(next(gen)[1]['throttle_out'] * 100)
+                                       for i in range(n // 8)]).astype(int)
+                expected = np.concatenate([d['ix'] for d in train])
+                assert np.array_equal(np.sort(rows), np.sort(expected))
+
+    def test_read_rows(self):
+        with h5py.File(self.path, 'r') as f:
+            X, Y = dk.datasets.read_rows(f, [40, 3, 3, 10])
+            assert np.array_equal(Y, f['Y'][()][[40, 3, 3, 10]])
+
+    def test_rebuild(self):
+        cache = dk.datasets.open_cache(self.path)
+        assert cache['X'].shape == (50, 12, 16, 3)
+        with h5py.File(self.path, 'a') as f:
+            f['Y'][0] = (0.5, 0.5)
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 10**9))
+        new_cache = dk.datasets.open_cache(self.path)
+        assert new_cache['throttle_out'][0] == .5
+        #maps of the old version stay readable after it is removed.
+        assert cache['X'].sum() == new_cache['X'].sum()
+        assert len([f for f in os.scandir(dk.datasets.cache_path(self.path)) if f.is_dir()]) == 1
+
+    def test_image_types(self):
+        X = np.random.randint(0, 255, (10, 12, 16, 3))
+        with h5py.File(self.path, 'w') as f:
+            f['X'] = X.astype(np.float32)
+            f['Y'] = np.zeros((10, 2))
+        assert np.array_equal(dk.datasets.open_cache(self.path)['X'], X)
+
+        with h5py.File(self.path, 'a') as f:
+            f['X'][0, 0, 0, 0] = .5
+        os.utime(self.path, ns=(0, os.stat(self.path).st_mtime_ns + 10**9))
+        with self.assertRaises(ValueError):
+            dk.datasets.open_cache(self.path)
+
+    def test_float_images(self):
+        with h5py.File(self.path, 'w') as f:
+            f['X'] = np.random.uniform(0, 255, (40, 12, 16, 3)).astype(np.float32)
+            f['Y'] = np.stack([np.random.uniform(-1, 1, 40), np.arange(40) / 100], axis=1)
+        with self.assertRaises(ValueError):
+            dk.datasets.split_datasets([self.path], batch_size=8)
+
+        for workers in [0, 1]:
+            train, val, test = dk.datasets.split_datasets([self.path], batch_size=8, workers=workers, 
+                                                          cache=False, seed=0)
+            try:
+                X, Y = next(train['gen'])
+                assert X.shape == (8, 12, 16, 3) and Y['angle_out'].shape == (8, 15)
+                next(val['gen'])
+            finally:
+                for d in (train, val, test):
+                    d['gen'].close()
+        #the failed build left no cache behind.
+        assert not [f for f in os.scandir(dk.datasets.cache_path(self.path)) if f.is_dir()]
+
+    def test_hdf5_to_dataset(self):
+        X, Y = dk.sessions.hdf5_to_dataset(self.path)
+        assert X.shape == (50, 12, 16, 3) and Y.shape == (50, 2)
+        assert not os.path.exists(dk.datasets.cache_path(self.path))
+        X_map, Y_map = dk.sessions.hdf5_to_dataset(self.path, cache=True)
+        assert np.array_equal(X_map, X) and not X_map.flags.writeable
+
+
+class TestPrefetchLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'data.h5')
+        with h5py.File(self.path, 'w') as f:
+            f['X'] = np.random.randint(0, 255, (20, 12, 16, 3)).astype(np.uint8)
+            f['Y'] = np.stack([np.random.uniform(-1, 1, 20), np.arange(20) / 100], axis=1)
+        dk.datasets.build_cache(self.path)
+        self.datasets = [{'path': self.path, 'ix': np.arange(20), 'n': 20}]
+
+    def test_batches(self):
+        loader = dk.datasets.PrefetchLoader(self.datasets, batch_size=4, workers=1, seed=0)
+        try:
+            with h5py.File(self.path, 'r') as f:
+                X_all, Y_all = f['X'][()], f['Y'][()]
+            for i in range(3):
+                X, Y = next(loader)
+                rows = np.rint(Y['throttle_out'] * 100).astype(int)
+                assert np.allclose(X, dk.utils.norm_imgs(X_all[rows]), atol=1e-5)
+                assert np.array_equal(Y['angle_out'], dk.utils.bin_Y(Y_all[rows, 0]))
+        finally:
+            loader.close()
+
+    def test_lazy_test_loader(self):
+        train, val, test = dk.datasets.split_datasets([self.path], batch_size=4, workers=1, seed=0)
+        try:
+            assert test['gen'].gen is None
+            X, Y = next(test['gen'])
+            assert X.shape == (4, 12, 16, 3)
+            assert isinstance(test['gen'].gen, dk.datasets.PrefetchLoader)
+        finally:
+            for d in (train, val, test):
+                d['gen'].close()
+        assert test['gen'].gen is None and not train['gen'].workers
+
+    def test_dead_worker(self):
+        loader = dk.datasets.PrefetchLoader(self.datasets, batch_size=4, workers=1, slots=2, timeout=.1)
+        loader.workers[0].terminate()
+        loader.workers[0].join()
+        with self.assertRaises(RuntimeError):
+            for i in range(3):
+                next(loader)
+
+
+class TestAugmenter(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.random.randint(0, 255, (8, 12, 16, 3)).astype(np.uint8)
+        self.angle = np.random.uniform(-.5, .5, 8)
+
+    def test_flip(self):
+        aug = dk.datasets.Augmenter(flip=1, shift=0, vshift=0, brightness=0, contrast=0, shadow=0)
+        X, angle = aug(self.X, self.angle)
+        assert X.dtype == np.float32
+        assert np.array_equal(X, self.X[:, :, ::-1])
+        assert np.allclose(angle, -self.angle)
+
+    def test_seed(self):
+        X, angle = dk.datasets.Augmenter(seed=1)(self.X, self.angle)
+        X2, angle2 = dk.datasets.Augmenter(seed=1)(self.X, self.angle)
+        assert np.array_equal(X, X2)
+        assert np.array_equal(angle, angle2)
+        assert X.min() >= 0 and X.max() <= 255
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    ''' Serves the bytes of the server's file with range requests. '''
+
+    def do_GET(self):
+        data = self.server.data
+        self.server.requests.append(self.headers.get('Range'))
+        m = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if m and self.headers.get('If-Range') == '"v1"':
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(data) - 1, len(data)))
+        else:
+            start = 0
+            self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLoadUrl(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'data.h5')
+        with h5py.File(path, 'w') as f:
+            f['X'] = np.random.randint(0, 255, (20, 12, 16, 3)).astype(np.uint8)
+            f['Y'] = np.random.uniform(-1, 1, (20, 2))
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        self.server = HTTPServer(('localhost', 0), RangeHandler)
+        self.server.data = data
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://localhost:%s/data.h5' % self.server.server_port
+        self.checksum = hashlib.sha256(data).hexdigest()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cached(self):
+        X, Y = dk.datasets.load_url(self.url, cache_dir=self.cache_dir)
+        assert X.shape == (20, 12, 16, 3)
+        assert os.path.exists(os.path.join(self.cache_dir, self.checksum + '.h5'))
+        dk.datasets.load_url(self.url, cache_dir=self.cache_dir)
+        dk.datasets.load_url('http://other/url', checksum=self.checksum, cache_dir=self.cache_dir)
+        assert len(self.server.requests) == 1
+
+    def test_resume(self):
+        part = os.path.join(self.cache_dir, hashlib.sha256(self.url.encode()).hexdigest() + '.part')
+        with open(part, 'wb') as f:
+            f.write(self.server.data[:1000])
+        with open(part + '.json', 'w') as f:
+            f.write('{"validator": "\\"v1\\""}')
+        X, Y = dk.datasets.load_url(self.url, checksum=self.checksum, cache_dir=self.cache_dir)
+        assert self.server.requests == ['bytes=1000-']
+        assert Y.shape == (20, 2)
+
+    def test_checksum(self):
+        with self.assertRaises(ValueError):
+            dk.datasets.load_url(self.url, checksum='0' * 64, cache_dir=self.cache_dir)
+
+    def test_evict(self):
+        dk.datasets.load_url(self.url, cache_dir=self.cache_dir)
+        other = os.path.join(self.cache_dir, 'f' * 64 + '.h5')
+        with open(other, 'wb') as f:
+            f.write(b'0' * 100)
+        os.utime(other, (0, 0))
+        dk.datasets.load_url(self.url, cache_dir=self.cache_dir, max_bytes=len(self.server.data))
+        assert not os.path.exists(other)
+
+    def test_evict_caches(self):
+        X, Y = dk.datasets.load_url(self.url, cache_dir=self.cache_dir)
+        X.file.close()
+        other = os.path.join(self.cache_dir, 'f' * 64 + '.h5')
+        with open(other, 'wb') as f:
+            f.write(b'0' * 100)
+        #a training cache much larger than its download
+        os.makedirs(os.path.join(dk.datasets.cache_path(other), 'version'))
+        with open(os.path.join(dk.datasets.cache_path(other), 'version', 'X.npy'), 'wb') as f:
+            f.write(b'0' * 10000)
+        os.utime(other, (0, 0))
+
+        dk.datasets.load_url(self.url, cache_dir=self.cache_dir, max_bytes=len(self.server.data) + 1000)
+        assert not os.path.exists(other)
+        assert not os.path.exists(os.path.join(dk.datasets.cache_path(other), 'version'))
+
+
+if __name__ == '__main__':
+    unittest.main()
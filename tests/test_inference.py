@@ -0,0 +1,147 @@
+import os
+import json
+import unittest
+import tempfile
+
+import numpy as np
+import h5py
+
+from donkey import inference
+
+
+def naive_conv2d(x, kernel, bias, strides):
+    kh, kw, c, filters = kernel.shape
+    oh = (x.shape[1] - kh) // strides[0] + 1
+    ow = (x.shape[2] - kw) // strides[1] + 1
+    out = np.zeros((len(x), oh, ow, filters))
+    for i in range(oh):
+        for j in range(ow):
+            window = x[:, i*strides[0]:i*strides[0]+kh, j*strides[1]:j*strides[1]+kw, :]
+            out[:, i, j, :] = np.tensordot(window, kernel, axes=3) + bias
+    return out
+
+
+class TestLayers(unittest.TestCase):
+
+    def setUp(self):
+        self.x = np.random.rand(2, 13, 17, 3).astype(np.float32)
+
+    def test_conv2d(self):
+        kernel = np.random.randn(5, 3, 3, 4).astype(np.float32)
+        bias = np.random.randn(4).astype(np.float32)
+        for strides in [(1, 1), (2, 2), (2, 1)]:
+            out = inference.conv2d(self.x, kernel, bias, strides)
+            np.testing.assert_allclose(out, naive_conv2d(self.x, kernel, bias, strides), rtol=1e-4, atol=1e-5)
+
+    def test_max_pool(self):
+        out = inference.max_pool(self.x, (2, 2))
+        assert out.shape == (2, 6, 8, 3)
+        assert out[1, 2, 3, 1] == self.x[1, 4:6, 6:8, 1].max()
+
+        out = inference.max_pool(self.x, (3, 3), (2, 2))
+        assert out.shape == (2, 6, 8, 3)
+        assert out[1, 2, 3, 1] == self.x[1, 4:7, 6:9, 1].max()
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = [{'type': 'conv', 'strides': [2, 2], 'activation': 'relu'},
+                     {'type': 'pool', 'size': [2, 2], 'strides': [2, 2]},
+                     {'type': 'flatten'},
+                     {'type': 'dense', 'activation': 'relu'},
+                     {'type': 'output', 'name': 'angle_out', 'activation': 'softmax'},
+                     {'type': 'output', 'name': 'throttle_out', 'activation': 'relu'}]
+        self.weights = [(np.random.randn(3, 3, 3, 8).astype(np.float32) * .1, np.zeros(8, dtype=np.float32)),
+                        (np.random.randn(8 * 7 * 9, 16).astype(np.float32) * .1, np.zeros(16, dtype=np.float32)),
+                        (np.random.randn(16, 15).astype(np.float32), np.zeros(15, dtype=np.float32)),
+                        (np.random.randn(16, 1).astype(np.float32), np.ones(1, dtype=np.float32))]
+        self.X = np.random.rand(4, 30, 38, 3).astype(np.float32)
+
+    def test_quantize(self):
+        w = self.weights[0][0]
+        q = inference.quantize(w, 'int8')
+        assert q['w'].dtype == np.int8
+        error = np.abs(inference.dequantize(q['w'], q['s']) - w)
+        assert (error <= q['s'] / 2 + 1e-7).all()
+
+    def test_save_load(self):
+        network = inference.Network(self.spec, self.weights)
+        angle, throttle = network.predict(self.X)
+        assert angle.shape == (4, 15) and throttle.shape == (4, 1)
+        np.testing.assert_allclose(angle.sum(axis=1), 1, rtol=1e-5)
+
+        for dtype in ['float32', 'float16', 'int8']:
+            path = os.path.join(tempfile.mkdtemp(), 'model.npz')
+            inference.save(path, self.spec, self.weights, dtype=dtype)
+            loaded = inference.load(path)
+            assert loaded.output_names == ['angle_out', 'throttle_out']
+            angle2, throttle2 = loaded.predict(self.X)
+            np.testing.assert_allclose(angle2, angle, atol=.05)
+            np.testing.assert_allclose(throttle2, throttle, atol=.05)
+
+    def test_prune(self):
+        w = inference.prune(self.weights[1][0], .5)
+        assert abs((w == 0).mean() - .5) < .01
+
+
+class TestKerasFile(unittest.TestCase):
+
+    def setUp(self):
+        self.conv = [{'filters': 4, 'kernal': (3, 3), 'strides': (2, 2), 'pool': (2, 2)}]
+        self.dense = [{'units': 8, 'dropout': .1}]
+        self.layers = [('conv2d_1', [np.random.randn(3, 3, 3, 4), np.random.randn(4)]),
+                       ('dense_1', [np.random.randn(4 * 7 * 9, 8) * .1, np.random.randn(8)]),
+                       ('angle_out', [np.random.randn(8, 15), np.random.randn(15)]),
+                       ('throttle_out', [np.random.randn(8, 1), np.random.randn(1)])]
+
+        #a file laid out like the ones saved by keras' model.save
+        self.path = os.path.join(tempfile.mkdtemp(), 'model.hdf5')
+        layers = [{'class_name': 'InputLayer', 'config': {'name': 'img_in'}},
+                  {'class_name': 'Conv2D', 'config': {'name': 'conv2d_1', 'filters': 4, 'kernel_size': [3, 3],
+                                                      'strides': [2, 2], 'padding': 'valid', 'activation': 'relu'}},
+                  {'class_name': 'MaxPooling2D', 'config': {'name': 'max_pooling2d_1', 'pool_size': [2, 2],
+                                                            'strides': [2, 2]}},
+                  {'class_name': 'Flatten', 'config': {'name': 'flattened'}},
+                  {'class_name': 'Dense', 'config': {'name': 'dense_1', 'units': 8, 'activation': 'relu'}},
+                  {'class_name': 'Dropout', 'config': {'name': 'dropout_1'}},
+                  {'class_name': 'Dense', 'config': {'name': 'angle_out', 'units': 15, 'activation': 'softmax'}},
+                  {'class_name': 'Dense', 'config': {'name': 'throttle_out', 'units': 1, 'activation': 'relu'}}]
+        config = {'class_name': 'Model', 'config': {'layers': layers,
+                  'output_layers': [['angle_out', 0, 0], ['throttle_out', 0, 0]]}}
+        with h5py.File(self.path, 'w') as f:
+            f.attrs['model_config'] = json.dumps(config).encode('utf8')
+            group = f.create_group('model_weights')
+            names = ['img_in', 'conv2d_1', 'max_pooling2d_1', 'dense_1', 'angle_out', 'throttle_out']
+            group.attrs['layer_names'] = [n.encode('utf8') for n in names]
+            weights = dict(self.layers)
+            for name in names:
+                g = group.create_group(name)
+                weight_names = [('%s/kernel:0' % name).encode('utf8'), ('%s/bias:0' % name).encode('utf8')]
+                g.attrs['weight_names'] = weight_names if name in weights else []
+                for wn, w in zip(weight_names if name in weights else [], weights.get(name, [])):
+                    g.create_dataset(wn, data=w.astype(np.float32))
+
+        spec = inference.spec_from_config(self.conv, self.dense)
+        self.expected = inference.Network(spec, [tuple(w) for _, w in self.layers])
+        self.X = np.random.rand(2, 32, 40, 3).astype(np.float32)
+
+    def test_from_config(self):
+        network = inference.from_config(self.conv, self.dense, self.path)
+        for out, expected in zip(network.predict(self.X), self.expected.predict(self.X)):
+            np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+    def test_config_from_file(self):
+        network = inference.load_keras(self.path)
+        assert network.output_names == ['angle_out', 'throttle_out']
+        for out, expected in zip(network.predict(self.X), self.expected.predict(self.X)):
+            np.testing.assert_allclose(out, expected, rtol=1e-5)
+
+    def test_wrong_config(self):
+        conv = [dict(self.conv[0], filters=8)]
+        with self.assertRaises(ValueError):
+            inference.from_config(conv, self.dense, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import signal
+import unittest
+import tempfile
+from unittest import mock
+
+import donkey as dk
+
+
+class TestTrainingProfiler(unittest.TestCase):
+
+    def test_steps(self):
+        path = os.path.join(tempfile.mkdtemp(), 'steps.csv')
+        profiler = dk.models.TrainingProfiler(path)
+        times = iter([0.0, 10.0, 10.5, 11.5, 13.0, 13.5, 14.0])
+        with mock.patch('time.time', lambda: next(times)):
+            profiler.on_train_begin()
+            profiler.on_epoch_begin(0)
+            profiler.on_batch_begin(0)
+            profiler.on_batch_end(0, {'size': 4})
+            profiler.on_batch_begin(1)
+            profiler.on_batch_end(1, {'size': 4})
+            profiler.on_train_end()
+
+        summary = profiler.summary()
+        assert summary['steps'] == 2
+        self.assertAlmostEqual(summary['samples_per_sec'], 8 / 3.5)
+        self.assertAlmostEqual(summary['wait_ms_per_step'], 1000)
+        self.assertAlmostEqual(summary['step_ms_per_step'], 750)
+        self.assertAlmostEqual(summary['data_stall_frac'], 2 / 3.5)
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == 'epoch,step,wait_ms,step_ms,samples,peak_rss_mb'
+        assert lines[1].startswith('0,0,500.00,1000.00,4,')
+        assert lines[2].startswith('0,1,1500.00,500.00,4,')
+
+    def test_no_steps(self):
+        summary = dk.models.TrainingProfiler().summary()
+        assert summary['steps'] == 0 and summary['data_stall_frac'] == 0.0
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_sample(self):
+        sampler = dk.models.StackSampler()
+        for i in range(2):
+            sampler.sample(signal.SIGPROF, sys._getframe())
+        (stack, count), = sampler.stacks.items()
+        assert count == 2
+        assert stack.split(';')[-1].startswith('test_sample (test_models.py:')
+
+        path = os.path.join(tempfile.mkdtemp(), 'steps.stacks')
+        sampler.save(path)
+        with open(path) as f:
+            assert f.read() == '%s 2\n' % stack
+
+    def test_timer(self):
+        sampler = dk.models.StackSampler(interval=.001).start()
+        try:
+            end = time.time() + 2
+            while not sampler.stacks and time.time() < end:
+                sum(range(1000))
+        finally:
+            sampler.stop()
+        assert sampler.stacks
+        assert signal.getsignal(signal.SIGPROF) == signal.SIG_DFL
+
+
+class FakeModel():
+    stop_training = False
+
+
+class TestMedianPruner(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'progress.jsonl')
+        for trial, losses in [('a', [1.0, .5]), ('b', [1.0, .7]), ('c', [1.0, .9])]:
+            for epoch, loss in enumerate(losses):
+                dk.utils.append_jsonl(self.path, {'trial': trial, 'epoch': epoch, 'val_loss': loss})
+
+    def pruner(self, **kwargs):
+        pruner = dk.models.MedianPruner('d', self.path, **kwargs)
+        pruner.model = FakeModel()
+        return pruner
+
+    def test_prune(self):
+        pruner = self.pruner(prune_after=2)
+        pruner.on_epoch_end(0, {'val_loss': 2.0})
+        assert not pruner.pruned
+        pruner.on_epoch_end(1, {'val_loss': .8})
+        assert pruner.pruned and pruner.model.stop_training
+        assert dk.utils.read_jsonl(self.path)[-1] == {'trial': 'd', 'epoch': 1, 'val_loss': .8}
+
+    def test_keep(self):
+        pruner = self.pruner(prune_after=1)
+        pruner.on_epoch_end(1, {'val_loss': .6})
+        assert not pruner.pruned and not pruner.model.stop_training
+
+        pruner = self.pruner(prune_after=1, min_trials=4)
+        pruner.on_epoch_end(1, {'val_loss': 2.0})
+        assert not pruner.pruned
+
+
+if __name__ == '__main__':
+    unittest.main()
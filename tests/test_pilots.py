@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+import donkey as dk
+
+
+class SumPilot(dk.pilots.BasePilot):
+    ''' Decides the sum of each image, only for images of shape (2, 2). '''
+
+    def __init__(self):
+        self.batch_sizes = []
+        super().__init__(name='sum')
+
+    def decide_batch(self, img_arrs):
+        img_arrs = np.asarray(img_arrs)
+        if img_arrs.shape[1:] != (2, 2):
+            raise ValueError('wrong image shape')
+        self.batch_sizes.append(len(img_arrs))
+        return [(float(i.sum()), 0.0) for i in img_arrs]
+
+
+class TestBatchingPilot(unittest.TestCase):
+
+    def test_shapes(self):
+        pilot = SumPilot()
+        batching = dk.pilots.BatchingPilot(pilot, max_batch=8, max_wait=.2)
+        good = [batching.submit(np.full((2, 2), i)) for i in range(3)]
+        bad = batching.submit(np.zeros((3, 3)))
+
+        assert [f.result(timeout=5) for f in good] == [(0.0, 0.0), (4.0, 0.0), (8.0, 0.0)]
+        with self.assertRaises(ValueError):
+            bad.result(timeout=5)
+        assert pilot.batch_sizes == [3]
+        assert batching.stats()['frames'] == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
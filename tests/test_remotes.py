@@ -0,0 +1,137 @@
+import os
+import time
+import unittest
+import tempfile
+
+import numpy as np
+from PIL import Image
+import tornado.testing
+import tornado.websocket
+
+import donkey as dk
+
+
+class TestControlMessages(unittest.TestCase):
+
+    def test_frame(self):
+        msg = dk.remotes.pack_frame(7, .25, .5, 1000.0, b'jpeg')
+        seq, angle, throttle, milliseconds, img_bytes = dk.remotes.unpack_frame(msg)
+        assert (seq, angle, throttle, milliseconds, img_bytes) == (7, .25, .5, 1000.0, b'jpeg')
+
+    def test_reply(self):
+        msg = dk.remotes.pack_reply(7, -.25, .5, 'auto_angle')
+        assert dk.remotes.unpack_reply(msg) == (7, -.25, .5, 'auto_angle')
+
+
+class TestFallback(unittest.TestCase):
+
+    def test_fresh(self):
+        answer = (.5, .8, 'auto')
+        assert dk.remotes.decay_answer(answer, .1, .25, 1.0) == answer
+        assert dk.remotes.decay_answer(answer, .25, .25, 1.0) == answer
+
+    def test_decay(self):
+        angle, throttle, mode = dk.remotes.decay_answer((.5, .8, 'auto'), .625, .25, 1.0)
+        assert (angle, mode) == (.5, 'auto')
+        self.assertAlmostEqual(throttle, .4)
+
+    def test_stop(self):
+        assert dk.remotes.decay_answer((.5, .8, 'auto'), 1.0, .25, 1.0) == (.5, 0.0, 'auto')
+        assert dk.remotes.decay_answer((.5, .8, 'auto'), 60, .25, 1.0) == (.5, 0.0, 'auto')
+
+    def test_backoff(self):
+        delays = [dk.remotes.backoff_delay(a, .05, 1.0) for a in range(1, 7)]
+        assert delays[:4] == [.1, .2, .4, .8]
+        assert delays[4:] == [1.0, 1.0]
+
+
+class FakeConnection():
+
+    def __init__(self):
+        self.messages = []
+
+    def write_message(self, msg, binary=False):
+        self.messages.append(msg)
+
+
+class TestRemoteSocketClient(unittest.TestCase):
+
+    def setUp(self):
+        #nothing listens on the discard port, the client never connects.
+        self.client = dk.remotes.RemoteSocketClient('http://127.0.0.1:9', max_in_flight=2,
+                                                    reply_timeout=.05)
+        self.client.conn = FakeConnection()
+        self.img = np.zeros((120, 160, 3), dtype=np.uint8)
+
+    def test_dropped_reply(self):
+        for i in range(3):
+            self.client.decide_threaded(self.img, 0.0, 0.0, 0)
+        assert self.client.seq == 2
+
+        #the first reply never arrives.
+        self.client.on_reply(dk.remotes.pack_reply(2, .1, .5, 'auto'))
+        assert list(self.client.sent) == [1]
+
+        time.sleep(.1)
+        self.client.decide_threaded(self.img, 0.0, 0.0, 0)
+        assert self.client.lost == 1
+        assert list(self.client.sent) == [3]
+
+    def test_stale_reply(self):
+        assert self.client.decide_threaded(self.img, 0.0, 0.0, 0)[1] == 0.0
+
+        self.client.on_reply(dk.remotes.pack_reply(1, .1, .5, 'auto'))
+        angle, throttle, drive_mode = self.client.decide_threaded(self.img, 0.0, 0.0, 0)
+        assert (drive_mode, throttle) == ('auto', .5)
+
+        self.client.state['time'] -= 2
+        assert self.client.decide_threaded(self.img, 0.0, 0.0, 0)[1] == 0.0
+
+
+class TestFrameBroadcaster(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_wait(self):
+        video = dk.remotes.FrameBroadcaster()
+        frame = yield video.wait(0, timeout=.01)
+        assert frame is None
+
+        self.io_loop.call_later(.01, video.publish, b'jpeg')
+        frame = yield video.wait(0, timeout=1)
+        assert frame == (1, b'jpeg')
+
+
+class TestControlSocket(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        path = tempfile.mkdtemp()
+        for d in ['sessions', 'models']:
+            os.mkdir(os.path.join(path, d))
+        self.session = dk.sessions.SessionHandler(os.path.join(path, 'sessions')).new('log')
+        self.session.put(Image.new('RGB', (16, 12)), angle=0.0, throttle=0.0, milliseconds=0.0)
+        return dk.remotes.DonkeyPilotApplication(mydonkey_path=path)
+
+    @tornado.testing.gen_test
+    def test_bad_frame(self):
+        url = 'ws://127.0.0.1:%s/api/vehicles/ws/mycar/' % self.get_http_port()
+        conn = yield tornado.websocket.websocket_connect(url)
+        conn.write_message(dk.remotes.pack_frame(5, 0.0, 1.0, 0.0, b'not a jpeg'), binary=True)
+        reply = yield conn.read_message()
+        assert dk.remotes.unpack_reply(reply) == (5, 0.0, 0.0, 'user')
+        conn.close()
+
+    def test_unknown_video(self):
+        response = self.fetch('/api/vehicles/video/nocar')
+        assert response.code == 404
+        assert self._app.vehicles == {}
+
+    def test_bad_image_name(self):
+        name = os.path.basename(self.session.img_paths()[0])
+        for url in ['/session_image/log/%s', '/session_image/log/%s/thumb']:
+            assert self.fetch(url % name).code == 200
+            for bad in ['foo.jpg', 'frame_abc_x.jpg', 'frame_99999_ttl_0_agl_0_mil_0.jpg']:
+                assert self.fetch(url % bad).code == 404
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import io
+import unittest
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+import donkey as dk
+
+
+class TestSessionLog(unittest.TestCase):
+
+    def setUp(self):
+        self.sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        self.session = self.sh.new('log')
+        for i in range(5):
+            img = Image.fromarray(np.full((120, 160, 3), i * 40, dtype=np.uint8))
+            self.session.put(img, angle=i/10, throttle=.5, milliseconds=0.0)
+
+    def test_backend(self):
+        assert self.session.backend == dk.sessions.LOG_BACKEND
+        assert not any(f.endswith('.jpg') for f in os.listdir(self.session.session_dir))
+
+    def test_load_frame(self):
+        paths = self.session.img_paths()
+        assert len(paths) == 5
+        img_arr, data = dk.sessions.load_frame(paths[2])
+        assert img_arr.shape == (120, 160, 3)
+        assert data['angle'] == .2
+        assert data['throttle'] == .5
+
+    def test_frame_number(self):
+        assert dk.sessions.frame_number('/a/frame_00012_ttl_0.5.jpg') == 12
+        for name in ['foo.jpg', 'frame_abc_x.jpg']:
+            with self.assertRaises(KeyError):
+                dk.sessions.frame_number(name)
+
+    def test_delete(self):
+        paths = self.session.img_paths()
+        dk.sessions.delete_imgs(self.session.session_dir, [os.path.basename(paths[0])])
+        assert self.session.img_count() == 4
+
+    def test_page(self):
+        imgs = self.session.page(1, 3)
+        assert [i['frame'] for i in imgs] == [2, 3]
+        assert imgs[0]['angle'] == .1
+        assert imgs[0]['name'] == os.path.basename(self.session.img_paths()[1])
+
+    def test_reload(self):
+        session = self.sh.load('log')
+        assert session.frame_count == 5
+        X, Y = session.load_dataset()
+        assert X.shape == (5, 120, 160, 3)
+
+
+class TestSessionWriter(unittest.TestCase):
+
+    def test_flush(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        writer = dk.sessions.SessionWriter(sh.new())
+        img = dk.utils.img_to_binary(Image.fromarray(np.zeros((120, 160, 3), dtype=np.uint8)))
+        for i in range(10):
+            writer.put(img, angle=0.0, throttle=0.0, milliseconds=0.0)
+        writer.close()
+        assert writer.stats()['written'] == 10
+        assert writer.img_count() == 10
+
+    def test_drop(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        writer = dk.sessions.SessionWriter(sh.new(), max_queue=1, policy='drop')
+        writer.queue.put(None)  # stop the thread so the queue stays full
+        writer.thread.join()
+        assert writer.put(b'', angle=0.0, throttle=0.0) is True
+        assert writer.put(b'', angle=0.0, throttle=0.0) is False
+        assert writer.dropped == 1
+
+
+class TestJpegSession(unittest.TestCase):
+
+    def test_load_jpeg_folder(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        path = sh.make_session_dir(sh.sessions_path, 'jpeg')
+        img = Image.fromarray(np.zeros((120, 160, 3), dtype=np.uint8))
+        img.save(dk.sessions.create_img_filepath(path, 1, .1, .2, 0), 'jpeg')
+
+        session = sh.load('jpeg')
+        assert session.backend == dk.sessions.JPEG_BACKEND
+        img_arr, data = dk.sessions.load_frame(session.img_paths()[0])
+        assert data['angle'] == .1
+
+        session.put(img, angle=.3, throttle=.4, milliseconds=0)
+        assert session.img_count() == 2
+        assert session.page(1, 2)[0]['angle'] == .3
+
+        dk.sessions.delete_imgs(path, [session.page(0, 1)[0]['name']])
+        assert session.img_count() == 1
+
+    def test_copied_same_tick(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        path = sh.make_session_dir(sh.sessions_path, 'jpeg')
+        img = Image.fromarray(np.zeros((120, 160, 3), dtype=np.uint8))
+        img.save(dk.sessions.create_img_filepath(path, 1, .1, .2, 0), 'jpeg')
+        session = sh.load('jpeg')
+        assert session.img_count() == 1
+
+        #an image copied in without changing the folder's mtime.
+        index_path = os.path.join(path, dk.sessions.JPEG_INDEX_NAME)
+        img.save(dk.sessions.create_img_filepath(path, 2, .1, .2, 0), 'jpeg')
+        mtime = os.stat(index_path).st_mtime_ns
+        os.utime(path, ns=(mtime, mtime))
+        assert session.img_count() == 2
+
+    def test_put_builds_index(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        path = sh.make_session_dir(sh.sessions_path, 'jpeg')
+        session = dk.sessions.Session(path, backend=dk.sessions.JPEG_BACKEND)
+        img = Image.fromarray(np.zeros((120, 160, 3), dtype=np.uint8))
+        session.put(img, angle=.1, throttle=.2, milliseconds=0)
+        assert os.path.exists(os.path.join(path, dk.sessions.JPEG_INDEX_NAME))
+        session.put(img, angle=.3, throttle=.2, milliseconds=0)
+        assert [i['angle'] for i in session.page(0, 2)] == [.1, .3]
+
+
+class TestThumbnailCache(unittest.TestCase):
+
+    def test_evict(self):
+        sh = dk.sessions.SessionHandler(tempfile.mkdtemp())
+        session = sh.new()
+        for i in range(5):
+            img = Image.fromarray(np.random.randint(0, 255, (120, 160, 3), dtype=np.uint8))
+            session.put(img, angle=0.0, throttle=0.0, milliseconds=0.0)
+
+        cache = dk.sessions.ThumbnailCache(tempfile.mkdtemp(), size=(40, 30), max_bytes=2000)
+        futures = cache.build(session.img_paths())
+        data, key, mtime = futures[0].result()
+        assert Image.open(io.BytesIO(data)).size == (40, 30)
+        for f in futures:
+            f.result()
+        assert cache.total_bytes <= 2000 or len(cache.entries) == 1
+        assert len(os.listdir(cache.path)) == len(cache.entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import unittest
+import tempfile
+
+import numpy as np
+
+import donkey as dk
+
+
+class TestNormImgs(unittest.TestCase):
+
+    def test_matches_norm_img(self):
+        X = np.random.randint(0, 255, size=(4, 120, 160, 3)).astype(np.uint8)
+        normed = dk.utils.norm_imgs(X)
+        assert normed.shape == X.shape
+        for x, n in zip(X, normed):
+            assert np.allclose(n, dk.utils.norm_img(x), atol=1e-5)
+
+
+class TestBinning(unittest.TestCase):
+
+    def test_linear_bin(self):
+        assert dk.utils.linear_bin(-1) == 0
+        assert dk.utils.linear_bin(0) == 7
+        assert dk.utils.linear_bin(1) == 14
+        assert list(dk.utils.linear_bin(np.array([-1, 0, 1]))) == [0, 7, 14]
+
+    def test_bin_range(self):
+        binned = dk.utils.bin_Y(np.array([0, .5, 1]), bins=3, low=0, high=1)
+        assert np.array_equal(binned, np.eye(3))
+
+    def test_round_trip(self):
+        Y = np.linspace(-1, 1, 15)
+        binned = dk.utils.bin_Y(Y)
+        assert binned.shape == (15, 15)
+        assert np.allclose(dk.utils.unbin_Y(binned), Y)
+
+
+class TestJsonl(unittest.TestCase):
+
+    def test_resume(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results.jsonl')
+        assert dk.utils.read_jsonl(path) == []
+        dk.utils.append_jsonl(path, {'trial': 'a'})
+        #a run that crashed while writing its record
+        with open(path, 'a') as f:
+            f.write('{"trial": "b", "lo')
+        assert dk.utils.read_jsonl(path) == [{'trial': 'a'}]
+
+        dk.utils.append_jsonl(path, {'trial': 'c'})
+        assert dk.utils.read_jsonl(path) == [{'trial': 'a'}, {'trial': 'c'}]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import queue
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import donkey as dk
+from constants import Constants
+
+
+class FakeClock():
+    ''' time.time and time.sleep of a clock that only moves when slept. '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ClockCamera():
+    ''' Captures a frame every period seconds of the fake clock. '''
+
+    def __init__(self, clock, period):
+        self.clock = clock
+        self.period = period
+
+    def wait(self, last_seq=0, timeout=None):
+        seq = int(self.clock.now / self.period + 1e-9)
+        return np.full((2, 2), seq), seq * self.period, seq
+
+
+class SlowProcessing():
+    ''' Takes duration seconds to process a frame, or slow for the frames in slow_frames. '''
+
+    def __init__(self, clock, duration, slow_frames=(), slow=0.0):
+        self.clock = clock
+        self.duration = duration
+        self.slow_frames = slow_frames
+        self.slow = slow
+        self.frames = 0
+
+    def process(self, frame):
+        self.frames += 1
+        self.clock.now += self.slow if self.frames in self.slow_frames else self.duration
+        return 1.0, 0.0
+
+
+class StoppingMixer():
+    ''' Stops the drive loop after a number of updates. '''
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.loop = None
+        self.count = 0
+
+    def update(self, throttle, angle):
+        self.count += 1
+        if self.count >= self.updates:
+            self.loop.stop()
+
+
+class TestDriveLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.multiple('time', time=self.clock.time, sleep=self.clock.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_loop(self, processing, ticks, period=.025):
+        mixer = StoppingMixer(ticks)
+        loop = dk.vehicles.DriveLoop(ClockCamera(self.clock, period), processing, mixer,
+                                     delay=.05, parallel=False)
+        mixer.loop = loop
+        loop.start()
+        return loop
+
+    def test_ticks(self):
+        loop = self.run_loop(SlowProcessing(self.clock, .01), ticks=10)
+        stats = loop.stats()
+        assert (stats['ticks'], stats['frames']) == (10, 10)
+        #two frames are captured every tick and only the newest is processed.
+        assert stats['dropped'] == 10
+        self.assertAlmostEqual(stats['jitter_ms']['max'], 0)
+        self.assertAlmostEqual(stats['latency_ms']['p50'], 10)
+        self.assertAlmostEqual(self.clock.now, .51)
+
+    def test_late_tick(self):
+        #the third frame takes .17s, so the next tick is .12s late.
+        processing = SlowProcessing(self.clock, .01, slow_frames=[3], slow=.17)
+        loop = self.run_loop(processing, ticks=6)
+        stats = loop.stats()
+        assert (stats['ticks'], stats['frames']) == (6, 6)
+        self.assertAlmostEqual(stats['jitter_ms']['max'], 120)
+        self.assertAlmostEqual(stats['jitter_ms']['p50'], 0)
+        self.assertAlmostEqual(stats['latency_ms']['max'], 170)
+        #the missed ticks are skipped and the loop ticks every .05s again after .32s.
+        self.assertAlmostEqual(self.clock.now, .32 + 2 * .05 + .01)
+        #frames 7 to 11 were captured while the third one was processed.
+        assert stats['dropped'] == 5 + 5
+
+
+class FakePiCamera():
+    ''' Writes the frames put on its queue like picamera's capture_continuous. '''
+
+    frames = queue.Queue()
+
+    def capture_continuous(self, output, format=None, use_video_port=False):
+        while True:
+            output.write(self.frames.get().tobytes())
+            yield output
+
+
+class TestCameraStream(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(dk.vehicles, 'PiCamera', FakePiCamera)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.camera = dk.vehicles.CameraStream(slots=3).start()
+        self.shape = (Constants.res_width, Constants.res_length, 3)
+
+    def put(self, value):
+        FakePiCamera.frames.put(np.full(self.shape, value, dtype=np.uint8))
+
+    def test_wait(self):
+        self.put(1)
+        frame, timestamp, seq = self.camera.wait(0, timeout=1)
+        assert seq == 1 and (frame == 1).all()
+
+        #no newer frame before the timeout
+        frame, timestamp, seq = self.camera.wait(1, timeout=.01)
+        assert seq == 1
+
+        #the newest frame is returned, the ones before it are skipped.
+        self.put(2)
+        self.put(3)
+        frame, timestamp, seq = self.camera.wait(2, timeout=1)
+        assert seq == 3 and (frame == 3).all()
+        assert frame.shape == self.shape
+
+
+class TestBlobTracker(unittest.TestCase):
+
+    def test_mask(self):
+        ranges = [((10, 20, 30), (20, 30, 40)), ((100, 100, 100), (110, 110, 110))]
+        tracker = dk.vehicles.BlobTracker(ranges=ranges)
+        image = np.array([[(15, 25, 35), (100, 110, 105)],
+                          #each channel is in a range, but not the same one
+                          [(15, 105, 35), (0, 0, 0)]], dtype=np.uint8)
+        assert np.array_equal(tracker.mask(image), [[255, 255], [0, 0]])
+
+        for shape in [(12, 16, 3), (6, 8, 3)]:
+            image = np.random.randint(0, 120, shape).astype(np.uint8)
+            expected = np.zeros(shape[:2], dtype=bool)
+            for lower, upper in ranges:
+                expected |= ((image >= lower) & (image <= upper)).all(axis=2)
+            mask = tracker.mask(image)
+            assert mask.dtype == np.uint8
+            assert np.array_equal(mask, expected * 255)
+
+
+if __name__ == '__main__':
+    unittest.main()